@@ -0,0 +1,30 @@
+import sys
+import argparse
+import pytest
+from pathlib import Path
+
+## Command line entry point for the sync benchmarks. The scenarios, sheet sizes and the baseline
+## checks live in test_benchmark_smartsheet_sync.py, this only runs that module under pytest.
+
+BENCHMARK_TESTS = Path(__file__).with_name('test_benchmark_smartsheet_sync.py')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Smartsheet sync paths against an in-process fake API")
+    parser.add_argument("--scenarios", required=False, default=None, help="Comma separated scenarios to run, any of add, update, read, read_sdk")
+    parser.add_argument("--slow", required=False, action="store_true", help="Include the 50000 row sheets")
+    parser.add_argument("--output", required=False, default=None, help="Write the pytest-benchmark results to this json file")
+    parser.add_argument("--update_baseline", required=False, action="store_true", help="Write the measured requests and bytes to benchmark_baseline.json")
+    args = parser.parse_args()
+
+    pytest_args = [str(BENCHMARK_TESTS),'-p','no:cacheprovider','--benchmark-only']
+    if not args.slow:
+        pytest_args += ['-m','not slow']
+    if args.scenarios:
+        pytest_args += ['-k',' or '.join(f"[{scenario}-" for scenario in args.scenarios.split(','))]
+    if args.output:
+        pytest_args += ['--benchmark-json',args.output]
+    if args.update_baseline:
+        pytest_args.append('--update_baseline')
+
+    sys.exit(pytest.main(pytest_args))
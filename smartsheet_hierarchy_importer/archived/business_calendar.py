@@ -0,0 +1,50 @@
+import yaml
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+
+def read_holiday_calendar(holiday_file,site_code):
+    ## Monday to Friday business days, minus the holidays listed for the site in holiday_file
+    ## (a yaml file with a list of YYYY-MM-DD dates per site code). Without a file only weekends are skipped
+    holidays = []
+    if holiday_file!=None:
+        project_dir = Path(__file__).parent
+        holiday_filepath = project_dir.joinpath(holiday_file)
+        site_holidays = yaml.load(open(holiday_filepath), Loader=yaml.FullLoader) or {}
+        holidays = [str(holiday) for holiday in site_holidays.get(site_code) or []]
+
+    return(np.busdaycalendar(weekmask='1111100',holidays=np.array(holidays,dtype='datetime64[D]')))
+
+def to_business_dates(values,date_format='%m/%d/%Y'):
+    ## Date strings to datetime64[D], unparseable values become NaT
+    return(pd.to_datetime(pd.Series(values),format=date_format,errors='coerce').to_numpy(dtype='datetime64[D]'))
+
+def format_business_dates(dates,date_format='%m/%d/%Y'):
+    ## Missing dates (NaT) become None, written to Smartsheet as an empty cell
+    dates = np.asarray(dates,dtype='datetime64[D]')
+    formatted = pd.DatetimeIndex(dates.ravel()).strftime(date_format).to_numpy(dtype=object)
+    formatted[np.isnat(dates.ravel())] = None
+    return(formatted.reshape(dates.shape))
+
+def add_business_days(start_dates,num_days,calendar):
+    ## Vectorized start date + num_days business days. A start date that is not a business day
+    ## counts from the business day before it, so a Saturday + 1 is the following Monday
+    start_dates, num_days = np.broadcast_arrays(np.asarray(start_dates,dtype='datetime64[D]'),np.asarray(num_days,dtype='int64'))
+    result = np.full(start_dates.shape,np.datetime64('NaT'),dtype='datetime64[D]')
+    valid = ~np.isnat(start_dates)
+    result[valid] = np.busday_offset(start_dates[valid],num_days[valid],roll='backward',busdaycal=calendar)
+    return(result)
+
+def subtask_open_dates(open_dates,durations,calendar):
+    ## Open date of every chained sub-task for a batch of deviations, one row per deviation and
+    ## one column per sub-task. The first sub-task opens with the deviation, every next one opens
+    ## the business day after the previous one finished (duration business days later)
+    open_dates = np.asarray(open_dates,dtype='datetime64[D]')
+    durations = np.asarray(durations,dtype='int64')
+    offsets = np.concatenate([[0],np.cumsum(durations[:-1])]) if len(durations)>0 else np.array([],dtype='int64')
+
+    schedule = add_business_days(open_dates[:,None],offsets[None,:],calendar)
+    if len(durations)>0:
+        schedule[:,0] = open_dates
+    return(schedule)
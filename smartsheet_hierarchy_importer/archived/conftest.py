@@ -0,0 +1,6 @@
+def pytest_addoption(parser):
+    parser.addoption("--update_baseline", action="store_true", default=False,
+                     help="Write the measured request counts and bytes to benchmark_baseline.json instead of checking them")
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "slow: large sheets, deselect with -m 'not slow'")
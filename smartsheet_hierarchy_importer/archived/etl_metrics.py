@@ -0,0 +1,168 @@
+import json
+import time
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from contextlib import contextmanager
+
+METRIC_PREFIX = 'smartsheet_etl'
+## Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+
+def format_duration(total_time_s):
+    minutes, seconds = divmod(int(round(total_time_s)),60)
+    return(f"{minutes} minutes {seconds} seconds")
+
+def metric_key(name,labels):
+    return((name,tuple(sorted(labels.items()))))
+
+def format_labels(labels):
+    if len(labels)==0:
+        return('')
+    escaped = [(name,str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')) for name, value in labels]
+    return('{'+','.join(f'{name}="{value}"' for name, value in escaped)+'}')
+
+
+class run_metrics:
+    ## Phase timers, counters and latency histograms of one ETL run, shared by every thread and API
+    ## client of the run. Events are appended to log_file as JSON lines while the run goes, the totals
+    ## are logged and written as a Prometheus textfile (node_exporter textfile collector) by finish().
+
+    def __init__(self,job='etl',labels=None,log_file=None,prometheus_file=None):
+        self.job = job
+        self.labels = dict(labels or {})
+        self.log_file = log_file
+        self.prometheus_file = prometheus_file
+        self.lock = threading.Lock()
+        self.start_time = datetime.now()
+        self.start_counter = time.perf_counter()
+        ## phase name to [seconds, times run]
+        self.phases = {}
+        ## (name, labels) to value
+        self.counters = {}
+        ## (name, labels) to cumulative bucket counts, sum and count
+        self.histograms = {}
+
+    def log(self,event,**fields):
+        if self.log_file==None:
+            return
+        record = {'time': datetime.now(timezone.utc).isoformat(), 'job': self.job}
+        record.update(self.labels)
+        record['event'] = event
+        record.update(fields)
+        line = json.dumps(record,default=str)
+        with self.lock:
+            with open(self.log_file,'a') as f_out:
+                f_out.write(line+'\n')
+
+    @contextmanager
+    def phase(self,name,**fields):
+        ## Phases run by concurrent workers add up, their total can exceed the run time
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_phase(name,time.perf_counter() - start,**fields)
+
+    def record_phase(self,name,duration_s,**fields):
+        ## For phases that do not fit in one block
+        with self.lock:
+            phase_total = self.phases.setdefault(name,[0.0,0])
+            phase_total[0] += duration_s
+            phase_total[1] += 1
+        self.log('phase',phase=name,duration_s=round(duration_s,3),**fields)
+
+    def increment(self,name,value=1,**labels):
+        key = metric_key(name,labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key,0) + value
+
+    def observe(self,name,value,**labels):
+        key = metric_key(name,labels)
+        with self.lock:
+            histogram = self.histograms.setdefault(key,{'buckets': [0]*len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0})
+            for index, upper_bound in enumerate(LATENCY_BUCKETS):
+                if value<=upper_bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def timer(self,name,**labels):
+        ## Observe how long the block took in the name histogram, e.g. db_query_seconds
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration_s = time.perf_counter() - start
+            self.observe(name,duration_s,**labels)
+            self.log('timer',metric=name,duration_s=round(duration_s,3),**labels)
+
+    def summary(self):
+        with self.lock:
+            summary = {'duration_s': round(time.perf_counter() - self.start_counter,3),
+                       'phases': {name: {'seconds': round(seconds,3), 'count': count} for name, (seconds, count) in self.phases.items()},
+                       'counters': {name+format_labels(labels): value for (name, labels), value in self.counters.items()},
+                       'histograms': {name+format_labels(labels): {'count': histogram['count'], 'sum': round(histogram['sum'],3)}
+                                      for (name, labels), histogram in self.histograms.items()}}
+        return(summary)
+
+    def finish(self,exit_code=0):
+        ## Report the run and return exit_code, so a script can end with sys.exit(metrics.finish(exit_code))
+        end_time = datetime.now()
+        summary = self.summary()
+        print(f"Finished At {end_time}")
+        for name, phase_total in sorted(summary['phases'].items(),key=lambda item: -item[1]['seconds']):
+            print(f"{name}: {phase_total['seconds']:.1f}s over {phase_total['count']} runs")
+        print(f"Completed in {format_duration(summary['duration_s'])}")
+
+        self.log('run_finished',exit_code=exit_code,**summary)
+        self.write_prometheus(summary,exit_code,end_time)
+        return(exit_code)
+
+    def write_prometheus(self,summary,exit_code,end_time):
+        if self.prometheus_file==None:
+            return
+        run_labels = tuple(sorted(dict(self.labels,job=self.job).items()))
+        lines = []
+
+        def add_metric(name,metric_type,samples):
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{METRIC_PREFIX}_{name}{format_labels(run_labels+labels)} {value}")
+
+        add_metric('run_duration_seconds','gauge',[((),summary['duration_s'])])
+        add_metric('run_exit_code','gauge',[((),exit_code)])
+        add_metric('last_run_timestamp_seconds','gauge',[((),round(end_time.timestamp()))])
+        add_metric('phase_seconds','gauge',[((('phase',name),),phase_total['seconds']) for name, phase_total in sorted(summary['phases'].items())])
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key,dict(histogram,buckets=list(histogram['buckets']))) for key, histogram in self.histograms.items())
+
+        for name in sorted({name for (name, labels), value in counters}):
+            add_metric(f"{name}_total",'counter',[(labels,value) for (counter_name, labels), value in counters if counter_name==name])
+
+        for name in sorted({name for (name, labels), histogram in histograms}):
+            samples = []
+            for (histogram_name, labels), histogram in histograms:
+                if histogram_name!=name:
+                    continue
+                for upper_bound, bucket_count in zip(LATENCY_BUCKETS,histogram['buckets']):
+                    samples.append((labels+(('le',str(upper_bound)),),bucket_count))
+                samples.append((labels+(('le','+Inf'),),histogram['count']))
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} histogram")
+            for labels, value in samples:
+                lines.append(f"{METRIC_PREFIX}_{name}_bucket{format_labels(run_labels+labels)} {value}")
+            for (histogram_name, labels), histogram in histograms:
+                if histogram_name==name:
+                    lines.append(f"{METRIC_PREFIX}_{name}_sum{format_labels(run_labels+labels)} {round(histogram['sum'],6)}")
+                    lines.append(f"{METRIC_PREFIX}_{name}_count{format_labels(run_labels+labels)} {histogram['count']}")
+
+        ## Written under a temporary name and renamed, the collector never reads a partial file
+        prometheus_filepath = Path(self.prometheus_file)
+        temp_filepath = prometheus_filepath.with_name(prometheus_filepath.name+'.tmp')
+        with open(temp_filepath,'w') as f_out:
+            f_out.write('\n'.join(lines)+'\n')
+        temp_filepath.replace(prometheus_filepath)
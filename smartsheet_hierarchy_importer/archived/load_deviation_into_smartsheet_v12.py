@@ -8,6 +8,8 @@ import pandas as pd
 import numpy as np
 import datetime
 import smartsheet_api as ssa
+import business_calendar as bc
+import etl_metrics as etm
 from pathlib import Path
 from datetime import timedelta
 from datetime import datetime
@@ -16,6 +18,51 @@ import smartsheet
 import time
 import re
 import argparse
+from collections import namedtuple
+from types import MappingProxyType
+
+
+CLOSED_STATUSES = ['Closed - Done', 'Closed - Cancelled']
+TEMPLATE_V2_START_DATE = '2024-03-19'
+ORACLE_IN_LIST_LIMIT = 1000
+## SQL Server caps a statement at 2100 parameters and a VALUES list at 1000 rows
+SQL_SERVER_MAX_PARAMETERS = 2100
+SQL_SERVER_MAX_VALUES_ROWS = 1000
+DEFAULT_OFFLOAD_BATCH_SIZE = 5000
+
+## One sub-task of the template. completed_on_status keeps the template order, its first entry is the
+## status the sub-task is dated against, completed_on_status_set is for membership checks
+subtask_rule = namedtuple('subtask_rule',['version','sub_task','duration','completed_on_status',
+                                          'completed_on_status_set','first_status','auto_populate_status'])
+
+def normalize_sheet_date(values):
+    ## Smartsheet returns dates as YYYY-MM-DD while GTW dates are formatted MM/DD/YYYY
+    dates = pd.to_datetime(values,format='%Y-%m-%d',errors='coerce')
+    values = values.astype(object).where(values.notna(),'')
+    return(values.where(dates.isna(),dates.dt.strftime('%m/%d/%Y')))
+
+### Level 1 columns kept in sync with GTW
+### column: Smartsheet column, field: GTW field, normalizer: applied to the Smartsheet value before comparing,
+### strict: cell strict flag, linked: other cells written together with the column when it changes
+DEVIATION_COLUMN_MAP = [
+    {'column': 'Status', 'field': 'status', 'normalizer': None, 'strict': True},
+    {'column': 'Completion Date', 'field': 'completion_date', 'normalizer': normalize_sheet_date, 'strict': False,
+     'linked': [{'column': 'Finished', 'field': 'complete_checkbox', 'type': 'CHECKBOX', 'strict': True},
+                {'column': 'Finished Date', 'field': 'completion_date', 'strict': False}]},
+    {'column': 'Due Date', 'field': 'due_date', 'normalizer': normalize_sheet_date, 'strict': False},
+    {'column': 'Batch', 'field': 'batch', 'normalizer': None, 'strict': False,
+     'linked': [{'column': 'Tafqar date', 'field': 'tafqar_dt', 'strict': False}]},
+    {'column': 'Responsible Department', 'field': 'responsible_dept', 'normalizer': None, 'strict': False},
+    {'column': 'Client', 'field': 'client', 'normalizer': None, 'strict': False},
+    {'column': 'Reporting To Name', 'field': 'reporting_to', 'normalizer': None, 'strict': False},
+    {'column': 'Reporting To Email', 'field': 'reporting_to_email', 'normalizer': None, 'strict': False},
+    {'column': 'DR Type', 'field': 'dr_type', 'normalizer': None, 'strict': False},
+    {'column': 'Short Description', 'field': 'short_description', 'normalizer': None, 'strict': False},
+    {'column': 'Is Reopened', 'field': 'deviation_reopened_after_closing', 'normalizer': None, 'strict': False},
+    {'column': 'Reopened Date', 'field': 'reopen_date', 'normalizer': normalize_sheet_date, 'strict': False},
+    {'column': 'Current State From Date', 'field': 'date_current_state', 'normalizer': None, 'strict': False},
+    {'column': 'Criticality', 'field': 'criticality', 'normalizer': None, 'strict': False},
+]
 
 
 def read_credentials(cred_file):
@@ -51,6 +98,27 @@ def read_smartsheet_template(smartsheet_template_file):
     smart_template = pd.read_csv(sm_template_filepath)
     return(smart_template)
 
+def compile_subtask_template(smart_template):
+    ## Index the template once. rules: (version, sub_task) -> subtask_rule,
+    ## versions: version -> sub-task rules in template order
+    rules = {}
+    versions = {}
+    for template_row in smart_template.itertuples(index=False):
+        completed_on_status = tuple(str(template_row.Completed_On_Status).split(', '))
+        rule = subtask_rule(version=int(template_row.Version),
+                            sub_task=template_row.Sub_Task,
+                            duration=int(template_row.Duration),
+                            completed_on_status=completed_on_status,
+                            completed_on_status_set=frozenset(completed_on_status),
+                            first_status=completed_on_status[0],
+                            auto_populate_status=str(template_row.Auto_Populate_Status))
+        ## First row wins for a repeated sub-task, as the row by row filter did
+        rules.setdefault((rule.version,rule.sub_task),rule)
+        versions.setdefault(rule.version,[]).append(rule)
+
+    return(MappingProxyType({'rules': MappingProxyType(rules),
+                             'versions': MappingProxyType({version: tuple(version_rules) for version, version_rules in versions.items()})}))
+
 def create_db_connection(creds_db):
 
     dbtype = creds_db['dbtype']
@@ -77,47 +145,50 @@ def create_db_connection(creds_db):
         print(e)
     return(dbcon,engine)
 
-def add_business_days(start_date, num_days):
-    end_date = start_date
-    business_days_added = 0
-    while business_days_added < num_days:
-        end_date += timedelta(days=1)
-        weekday = end_date.weekday()
-        if weekday >= 5:  # Saturday is 5 and Sunday is 6
-            continue
-        business_days_added += 1
-    return end_date
-
-def save_rows_to_df(rows,column_map_idtoname):
-    data = []
-    qr_id = None
-    parent_row_id = None
-
-    for row in rows:
-        row_dict = {}
-        row_level = 3
-        row_dict["Smartsheet_Row_Id"] = row.id
-        if row.parent_id == None:
-            qr_id = row.cells[0].value
-            parent_row_id = row.id
-            row_level = 1
-        elif row.parent_id == parent_row_id:
-            row_level = 2
-        
-        row_dict['Task_Level'] = row_level
-        row_dict['QR_Id'] = qr_id
-    
-        for cell in row.cells:
-            row_dict[column_map_idtoname[cell.column_id]] = cell.value
-        data.append(row_dict)
+def save_frame_to_df(sheet_df):
+    ## Rows come in sheet order: a row without parent is a QR (level 1) and starts a block, rows under
+    ## it are its tasks (level 2) and anything deeper is level 3. The QR_Id of every row is the primary
+    ## column of the QR above it
+    if len(sheet_df)==0:
+        return(pd.DataFrame())
 
-    df = pd.DataFrame(data)
+    is_qr = sheet_df["Smartsheet_Parent_Id"].isna()
+    ## Kept as nullable integers, row ids do not fit in a float
+    qr_row_id = sheet_df["Smartsheet_Row_Id"].astype('Int64').where(is_qr).ffill()
+    is_task = (sheet_df["Smartsheet_Parent_Id"]==qr_row_id).fillna(False).astype(bool)
+    primary_column = sheet_df.columns[2]
+
+    df = sheet_df.drop(columns=["Smartsheet_Parent_Id"])
+    df.insert(1,'Task_Level',np.where(is_qr,1,np.where(is_task,2,3)))
+    df.insert(2,'QR_Id',sheet_df[primary_column].astype(object).where(is_qr).ffill().infer_objects())
 
     return(df)
 
+def bulk_insert_dataframe(**kwargs):
+    ## Append a dataframe to a SQL Server table, committing every batch_size rows in its own transaction.
+    ## Rows are sent as multi row INSERT statements sized to stay under the parameter limit whatever
+    ## the number of columns
+    sql_engine = kwargs['sql_engine']
+    dataframe = kwargs['dataframe']
+    table_name = kwargs['table_name']
+    schema = kwargs.get('schema','dbo')
+    batch_size = kwargs.get('batch_size',DEFAULT_OFFLOAD_BATCH_SIZE)
+
+    table = sqlalchemy.table(table_name,*[sqlalchemy.column(column) for column in dataframe.columns],schema=schema)
+    records = dataframe.to_dict('records')
+    rows_per_statement = max(1,min(SQL_SERVER_MAX_VALUES_ROWS,(SQL_SERVER_MAX_PARAMETERS-1)//max(1,len(dataframe.columns))))
+
+    for batch_start in range(0,len(records),batch_size):
+        batch = records[batch_start:batch_start+batch_size]
+        with sql_engine.begin() as con:
+            for statement_start in range(0,len(batch),rows_per_statement):
+                con.execute(sqlalchemy.insert(table).values(batch[statement_start:statement_start+rows_per_statement]))
+        print(f"Inserted {batch_start+len(batch)}/{len(records)} rows into {schema}.{table_name}")
+
 def save_data_to_sql(**kwargs):
     sql_engine = kwargs['sql_engine']
     export_df = kwargs['dataframe']
+    batch_size = kwargs.get('batch_size',DEFAULT_OFFLOAD_BATCH_SIZE)
     ## Drop unwanted columns
     #export_df = export_df.drop(['Started','Finished','Baseline Start','Baseline Finish','Variance'], axis=1)
     ## Reformat columns
@@ -136,9 +207,123 @@ def save_data_to_sql(**kwargs):
     
     ## Insert data into SQl table
     if export_df['DR_Type'].values[0]=='Product Complaint':
-        export_df.to_sql(name='PY_ProductComplaint_Deviation',con=sql_engine,if_exists='append',schema='dbo',index=False,method='multi',chunksize=50)
+        bulk_insert_dataframe(sql_engine=sql_engine,dataframe=export_df,table_name='PY_ProductComplaint_Deviation',schema='dbo',batch_size=batch_size)
     else:
-        export_df.to_sql(name='PY_Deviation',con=sql_engine,if_exists='append',schema='dbo',index=False,method='multi',chunksize=50)
+        bulk_insert_dataframe(sql_engine=sql_engine,dataframe=export_df,table_name='PY_Deviation',schema='dbo',batch_size=batch_size)
+
+def join_unique_values(dataframe,key,column):
+    ## ','.join of the distinct values of column per key, in order of first appearance. Rows are
+    ## deduplicated and stably sorted by key, then every group is concatenated with one reduceat
+    unique_values = dataframe.drop_duplicates(subset=[key,column]).sort_values(key,kind='stable')
+    if unique_values.empty:
+        return(pd.Series(dtype=object))
+    keys = unique_values[key].to_numpy()
+    values = (','+unique_values[column]).to_numpy(dtype=object)
+    group_starts = np.flatnonzero(np.r_[True,keys[1:]!=keys[:-1]])
+    return(pd.Series(np.add.reduceat(values,group_starts),index=keys[group_starts]).str[1:])
+
+def aggregate_tafqar(df_sql_tafqar):
+    ## One row per open DMR with its distinct batches joined in order of first appearance and the
+    ## earliest TAFQAR date
+    df_sql_tafqar = df_sql_tafqar.assign(open_dmrs=df_sql_tafqar.open_dmrs.str.split(','))
+    df_sql_tafqar = df_sql_tafqar.explode('open_dmrs')
+    df_sql_tafqar = df_sql_tafqar[~df_sql_tafqar.open_dmrs.isna()]
+    df_sql_tafqar = df_sql_tafqar.astype({"open_dmrs":int})
+
+    tafqar_df = df_sql_tafqar.groupby(by=['open_dmrs'])['tafqar_dt'].min().to_frame()
+    for column in ['m_batch','batch']:
+        tafqar_df[column] = join_unique_values(df_sql_tafqar,'open_dmrs',column)
+
+    return(tafqar_df.reset_index()[['open_dmrs','m_batch','batch','tafqar_dt']])
+
+def read_status_history(**kwargs):
+    status_sql = kwargs['sql_string']
+    oracle_engine = kwargs['oracle_engine']
+    qr_id = kwargs['qr_id']
+    metrics = kwargs['metrics']
+
+    ## Get the Status update date based on QR-ID and Iteration Number
+    query_sql = status_sql["multi_iteration"]
+    query_sql = query_sql.format(QR_ID=qr_id)
+    with metrics.timer('db_query_seconds',query='multi_iteration'):
+        gtw_status_df = pd.read_sql(query_sql,oracle_engine)
+
+    if len(gtw_status_df) == 0:
+        query_sql = status_sql["first_iteration"]
+        query_sql = query_sql.format(QR_ID=qr_id)
+        with metrics.timer('db_query_seconds',query='first_iteration'):
+            gtw_status_df = pd.read_sql(query_sql,oracle_engine)
+
+    return(gtw_status_df)
+
+def read_status_history_batch(**kwargs):
+    status_sql = kwargs['sql_string']
+    oracle_engine = kwargs['oracle_engine']
+    query_name = kwargs['query_name']
+    qr_ids = kwargs['qr_ids']
+    metrics = kwargs['metrics']
+    status_frames = []
+
+    ## Oracle allows at most 1000 expressions in an IN list
+    for start in range(0,len(qr_ids),ORACLE_IN_LIST_LIMIT):
+        qr_id_list = ','.join(str(qr_id) for qr_id in qr_ids[start:start+ORACLE_IN_LIST_LIMIT])
+        query_sql = status_sql[query_name]
+        query_sql = query_sql.format(QR_IDS=qr_id_list)
+        with metrics.timer('db_query_seconds',query=query_name):
+            status_frames.append(pd.read_sql(query_sql,oracle_engine))
+
+    return(pd.concat(status_frames,ignore_index=True))
+
+def prefetch_status_history(**kwargs):
+    ## Status history for every QR-ID keyed by qr_id, using the batched multi_iteration_batch and
+    ## first_iteration_batch queries ({QR_IDS} placeholder, result must include qr_id).
+    ## Falls back to one query per QR-ID when the batched queries are not configured.
+    status_sql = kwargs['sql_string']
+    oracle_engine = kwargs['oracle_engine']
+    qr_ids = sorted({int(qr_id) for qr_id in kwargs['qr_ids']})
+    metrics = kwargs['metrics']
+    status_history = {}
+
+    if len(qr_ids)==0:
+        return(status_history)
+
+    if 'multi_iteration_batch' not in status_sql or 'first_iteration_batch' not in status_sql:
+        for qr_id in qr_ids:
+            status_history[qr_id] = read_status_history(sql_string=status_sql,oracle_engine=oracle_engine,qr_id=qr_id,metrics=metrics)
+        return(status_history)
+
+    gtw_status_df = read_status_history_batch(sql_string=status_sql,oracle_engine=oracle_engine,
+                                              query_name='multi_iteration_batch',qr_ids=qr_ids,metrics=metrics)
+    for qr_id, qr_status_df in gtw_status_df.groupby('qr_id'):
+        status_history[int(qr_id)] = qr_status_df.reset_index(drop=True)
+
+    first_iteration_ids = [qr_id for qr_id in qr_ids if qr_id not in status_history]
+    if len(first_iteration_ids)>0:
+        first_status_df = read_status_history_batch(sql_string=status_sql,oracle_engine=oracle_engine,
+                                                    query_name='first_iteration_batch',qr_ids=first_iteration_ids,metrics=metrics)
+        for qr_id, qr_status_df in first_status_df.groupby('qr_id'):
+            status_history[int(qr_id)] = qr_status_df.reset_index(drop=True)
+        gtw_status_df = first_status_df
+
+    for qr_id in qr_ids:
+        if qr_id not in status_history:
+            status_history[qr_id] = gtw_status_df.iloc[0:0]
+
+    return(status_history)
+
+def derive_deviation_fields(new_data_df):
+    ## One GTW record per QR-ID with the derived values compared against level 1 rows
+    gtw_df = new_data_df.drop_duplicates(subset='qr_id').set_index('qr_id')
+    is_closed = gtw_df['status'].isin(CLOSED_STATUSES)
+
+    last_closed_date = gtw_df['date_closed'].where(gtw_df['date_closed'].astype(str).str.contains(r'\d{2}/\d{2}/\d{2}'),'N/A')
+    gtw_df['last_closed_date'] = last_closed_date
+    gtw_df['completion_date'] = last_closed_date.where(is_closed,'')
+    gtw_df['complete_checkbox'] = is_closed
+    gtw_df['batch'] = gtw_df['batch'].where(gtw_df['batch'].map(lambda x: isinstance(x,str)),'N/A')
+    gtw_df['tafqar_dt'] = gtw_df['tafqar_dt'].where(gtw_df['tafqar_dt'].map(lambda x: isinstance(x,str)),'N/A')
+
+    return(gtw_df)
 
 def run_smartsheet_update_data(**kwargs):
     sm = kwargs['smartsheet']
@@ -146,400 +331,206 @@ def run_smartsheet_update_data(**kwargs):
     old_data_df = kwargs['old_data_df']
     new_data_df = kwargs['new_data_df']
     column_map = kwargs['column_map']
-    subtask_map_all = kwargs['subtask']
+    subtask_rules = kwargs['subtask']['rules']
     status_sql = kwargs['sql_string']
     oracle_engine = kwargs['oracle_engine']
-    today_date = date.today().strftime("%m/%d/%Y")
+    calendar = kwargs['calendar']
     delete_row_id = []
     closed_deviation = []
-    updated_deviation = []
-    update_row_cells = []
     update_sheet = None
+    ## Comparing includes the status history queries, those are also observed in db_query_seconds
+    diff_started = time.perf_counter()
 
     old_data_df = old_data_df[(old_data_df.QR_Id.isin(new_data_df.qr_id.unique().tolist()))]
 
     date_pattern= re.compile(r'\d{4}-\d{2}-\d{2}')
-    date_pattern_gtw= re.compile(r'\d{2}\/\d{2}\/\d{2}')
-    
-    for index, sm_row in old_data_df.iterrows():
-
-        qr_id = int(sm_row['QR_Id'])
-
-        update_check = 0
-
-        new_qr_record = new_data_df[new_data_df.qr_id==qr_id].copy()
-
-        gtw_responsible_email = new_qr_record['responsible_email'].values[0]
-        gtw_responsible_name = new_qr_record['responsible_name'].values[0]
-        gtw_status = new_qr_record['status'].values[0]
-        gtw_due_date = new_qr_record['due_date'].values[0]
-        gtw_batch = new_qr_record['batch'].values[0]
-        gtw_tafqar = new_qr_record['tafqar_dt'].values[0]
-        gtw_respo_dept = new_qr_record['responsible_dept'].values[0]
-        gtw_client = new_qr_record['client'].values[0]
-        gtw_report_to_name = new_qr_record['reporting_to'].values[0]
-        gtw_report_to_email = new_qr_record['reporting_to_email'].values[0]
-        gtw_dr_type = new_qr_record['dr_type'].values[0]
-        gtw_desc = new_qr_record['short_description'].values[0]
-        gtw_max_iteration = new_qr_record['deviation_iteration_num'].values[0]
-        gtw_is_reopened = new_qr_record['deviation_reopened_after_closing'].values[0]
-        gtw_reopened_date = new_qr_record['reopen_date'].values[0]
-        gtw_closed_date = new_qr_record['date_closed'].values[0]
-        gtw_current_state_date = new_qr_record['date_current_state'].values[0]
-        gtw_criticality = new_qr_record['criticality'].values[0]
-
-        if sm_row['Task_Level'] == 1:
-            ## Get the Status update date based on QR-ID and Iteration Number
-            query_sql = status_sql["multi_iteration"]
-            query_sql = query_sql.format(QR_ID=qr_id)    
-            gtw_status_df = pd.read_sql(query_sql,oracle_engine)
-            record_in_smartsheet_date = datetime.strptime(sm_row['Started Date'],'%Y-%m-%d')
-
-            print(record_in_smartsheet_date)
-            print(datetime.strptime('2024-03-19','%Y-%m-%d'))
 
-            if record_in_smartsheet_date < datetime.strptime('2024-03-19','%Y-%m-%d'):
-                subtask_map = subtask_map_all[subtask_map_all.Version==1]
-            else:
-                subtask_map = subtask_map_all[subtask_map_all.Version==2]
-
-            if len(gtw_status_df) == 0:
-                query_sql = status_sql["first_iteration"]
-                query_sql = query_sql.format(QR_ID=qr_id)
-                gtw_status_df = pd.read_sql(query_sql,oracle_engine)
-
-            last_closed_date = gtw_closed_date
+    gtw_df = derive_deviation_fields(new_data_df)
+    qr_keys = pd.to_numeric(old_data_df['QR_Id']).astype('int64')
+
+    ## Cells to update grouped per Smartsheet row, update_smartsheet_cell expects them row by row
+    row_cells = {row_id: [] for row_id in old_data_df['Smartsheet_Row_Id'].tolist()}
+
+    ### Level 1 deviation rows, compare every mapped column for all rows at once
+    level1 = old_data_df[old_data_df.Task_Level==1]
+    gtw_level1 = gtw_df.reindex(qr_keys[level1.index])
+    level1_row_ids = level1['Smartsheet_Row_Id'].tolist()
+    gtw_level1_values = {field: gtw_level1[field].tolist() for field in gtw_level1.columns}
+
+    for column_spec in DEVIATION_COLUMN_MAP:
+        sm_values = level1[column_spec['column']]
+        if column_spec['normalizer']!=None:
+            sm_values = column_spec['normalizer'](sm_values)
+        change_mask = sm_values.to_numpy(dtype=object) != gtw_level1[column_spec['field']].to_numpy(dtype=object)
+
+        for position in np.flatnonzero(change_mask):
+            row_id = level1_row_ids[position]
+            for cell_spec in [column_spec] + column_spec.get('linked',[]):
+                update_cell = {
+                    'row_id': row_id,
+                    'column_id': column_map[cell_spec['column']],
+                    'value': gtw_level1_values[cell_spec['field']][position],
+                    'strict': cell_spec['strict']
+                }
+                if 'type' in cell_spec:
+                    update_cell['type'] = cell_spec['type']
+                row_cells[row_id].append(update_cell)
+
+    ### Closed deviations are offloaded 30 business days after completion
+    sm_completion_date = normalize_sheet_date(level1['Completion Date']).to_numpy(dtype=object)
+    offload_mask = ((sm_completion_date!='')
+                    & (sm_completion_date==gtw_level1['last_closed_date'].to_numpy(dtype=object))
+                    & gtw_level1['status'].isin(CLOSED_STATUSES).to_numpy())
+
+    offload_positions = np.flatnonzero(offload_mask)
+    offload_dates = bc.add_business_days(bc.to_business_dates(sm_completion_date[offload_positions]),30,calendar)
+    for position in offload_positions[offload_dates <= np.datetime64(date.today())]:
+        delete_row_id.append(level1_row_ids[position])
+        closed_deviation.append(level1['QR_Id'].iat[position])
+
+    ## Sub-task template version is chosen by the date the deviation was added to Smartsheet
+    record_in_smartsheet_date = pd.to_datetime(level1['Started Date'],format='%Y-%m-%d',errors='coerce')
+    template_version = np.where(record_in_smartsheet_date < pd.Timestamp(TEMPLATE_V2_START_DATE),1,2)
+    version_by_qr = dict(zip(qr_keys[level1.index].tolist(),template_version.tolist()))
+
+    ### Level 2 sub-task rows, auto populate task start and finish based on status
+    level2 = old_data_df[old_data_df.Task_Level==2]
+    status_history = prefetch_status_history(sql_string=status_sql,
+                                             oracle_engine=oracle_engine,
+                                             qr_ids=qr_keys[level2.index].unique().tolist(),
+                                             metrics=sm.metrics)
+
+    for index, sm_row in level2.iterrows():
+        qr_id = int(qr_keys[index])
+        gtw_status = gtw_df.at[qr_id,'status']
+        gtw_closed_date = gtw_df.at[qr_id,'date_closed']
+        gtw_status_df = status_history[qr_id]
+
+        sub_task_name = sm_row['Task Name']
+        ## A task renamed or added by hand in the sheet has no template rule, its dates are left as they are
+        rule = subtask_rules.get((version_by_qr.get(qr_id,2),sub_task_name))
+        if rule==None:
+            print(f"Sub-task '{sub_task_name}' of {qr_id} is not in the Smartsheet template, skipping status dates")
+        subtask_start_date = None
+        subtask_end_date = None
+        current_subtask_start_date = None
+        current_subtask_end_date = None
+        checkbox = False
 
-            if not date_pattern_gtw.search(str(last_closed_date)):
-                last_closed_date = 'N/A'
+        if rule!=None and gtw_status in rule.completed_on_status_set:
+            first_status_start_date = gtw_status_df[(gtw_status_df.name==rule.first_status)]['date_entry'].min()
+            subtask_dates = gtw_status_df[(gtw_status_df.name==rule.auto_populate_status) & (gtw_status_df.date_exit<=first_status_start_date)].copy()
+            subtask_dates =  subtask_dates[(subtask_dates.iteration_num==subtask_dates.iteration_num.min())]
+           
+            #print(qr_id," ",sub_task_name," ",gtw_status," ",first_status," ",auto_populate_task, " ",first_status_start_date)
+            #print(gtw_status_df)
+            #print(subtask_dates)
+            if not subtask_dates.empty:
+                checkbox = True
+                subtask_start_date = datetime.strptime(str(subtask_dates['date_entry'].iat[0]),'%Y-%m-%d %H:%M:%S').strftime('%m/%d/%Y')
+                subtask_end_date = datetime.strptime(str(subtask_dates['date_exit'].iat[-1]),'%Y-%m-%d %H:%M:%S').strftime('%m/%d/%Y')
+                completion_percent = "100%"
 
-            if not sm_row['Completion Date']==None:
-                completion_date = datetime.strptime(sm_row['Completion Date'],'%Y-%m-%d').strftime('%m/%d/%Y')
+        if 'Done or Cancelled' in sub_task_name:
+            if gtw_status in CLOSED_STATUSES:
+                checkbox = True
+                subtask_start_date = gtw_closed_date
+                subtask_end_date = gtw_closed_date
+                completion_percent = "100%"
             else:
-                completion_date = None
+                checkbox = False
+                subtask_start_date = ''
+                subtask_end_date = ''
+                completion_percent = ''
 
-            if not sm_row['Reopened Date']==None:
-                previous_reopen_date = datetime.strptime(sm_row['Reopened Date'],'%Y-%m-%d').strftime('%m/%d/%Y')
-            else:
-                previous_reopen_date = None
+        if date_pattern.search(str(sm_row['Started Date'])):
+            current_subtask_start_date = datetime.strptime(str(sm_row['Started Date']),'%Y-%m-%d').strftime('%m/%d/%Y')
 
-            if not completion_date==None and completion_date==last_closed_date and gtw_status in ['Closed - Done', 'Closed - Cancelled']:
-                offload_date = add_business_days(datetime.strptime(completion_date,'%m/%d/%Y'),30).strftime('%m/%d/%Y')
-                if today_date >= offload_date:
-                    delete_row_id.append(sm_row['Smartsheet_Row_Id'])
-                    closed_deviation.append(sm_row['QR_Id'])
-           
-            if not type(gtw_batch)==str:
-                gtw_batch = "N/A"
-            if not type(gtw_tafqar)==str:
-                gtw_tafqar = "N/A"
+        if date_pattern.search(str(sm_row['Finished Date'])):
+            current_subtask_end_date = datetime.strptime(str(sm_row['Finished Date']),'%Y-%m-%d').strftime('%m/%d/%Y')
 
-            if isinstance(sm_row['Due Date'],datetime):
-                sm_due_date = datetime.strptime(sm_row['Due Date'],'%Y-%m-%d').strftime('%m/%d/%Y')
-            else:
-                sm_due_date = "N/A"
+        if subtask_start_date!=None and subtask_end_date!=None:
+            if current_subtask_start_date!=subtask_start_date or current_subtask_end_date!=subtask_end_date:
+                row_cells[sm_row['Smartsheet_Row_Id']].extend([  
+                    {
+                        'row_id': sm_row['Smartsheet_Row_Id'],
+                        'column_id': column_map["Started Date"],
+                        'value': subtask_start_date,
+                        'strict': False
+                    },
+                    {
+                        'row_id': sm_row['Smartsheet_Row_Id'],
+                        'column_id': column_map["Finished Date"],
+                        'value': subtask_end_date,
+                        'strict': False
+                    },
+                    {
+                        'row_id': sm_row['Smartsheet_Row_Id'],
+                        'column_id': column_map["% Complete"],
+                        'value': completion_percent,
+                        'strict': False
+                    },
+                    {
+                        'row_id': sm_row['Smartsheet_Row_Id'],
+                        'column_id': column_map["Started"],
+                        'type': 'CHECKBOX',
+                        'value': checkbox,
+                        'strict': True
+                    },
+                    {
+                        'row_id': sm_row['Smartsheet_Row_Id'],
+                        'column_id': column_map["Finished"],
+                        'type': 'CHECKBOX',
+                        'value': checkbox,
+                        'strict': True
+                    }
+                ])
 
-            if gtw_status in ['Closed - Done', 'Closed - Cancelled']:
-                gtw_completion_date = last_closed_date
-                complete_checkbox = True
-            else:
-                gtw_completion_date = ''
-                complete_checkbox = False
-
-            if sm_row['Status'] != gtw_status:
-                update_check = 1
-                update_row_cells.extend([
-                        {   
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["Status"],
-                            'value': gtw_status,
-                            'strict': True
-                        }
-                    ])
-
-            if completion_date != gtw_completion_date:
-                update_check = 1
-                update_row_cells.extend([
-                        {   
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["Completion Date"],
-                            'value': gtw_completion_date,
-                            'strict': False
-                        },
-                        {   
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["Finished"],
-                            'type': ' CHECKBOX',
-                            'value': complete_checkbox,
-                            'strict': True
-                        },
-                        {   
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["Finished Date"],
-                            'value': gtw_completion_date,
-                            'strict': False
-                        }
-                    ])
-
-            if sm_due_date != gtw_due_date:
-                update_check = 1
-                update_row_cells.extend([
-                        {   
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["Due Date"],
-                            'value': gtw_due_date,
-                            'strict': False
-                        }
-                    ])
-                
-                
-            if sm_row['Batch'] != gtw_batch:
-                update_check = 1
-                update_row_cells.extend([
-                        {   
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["Batch"],
-                            'value': gtw_batch,
-                            'strict': False
-                        },
-                        {
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["Tafqar date"],
-                            'value': gtw_tafqar,
-                            'strict': False
-                        }           
-                    ])
-
-            if sm_row['Responsible Department'] != gtw_respo_dept:
-                update_check = 1
-                update_row_cells.extend([
-                        {
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["Responsible Department"],
-                            'value': gtw_respo_dept,
-                            'strict': False
-                        }
-                    ])
-
-            if sm_row['Client'] != gtw_client:
-                update_check = 1
-                update_row_cells.extend([
-                        {
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["Client"],
-                            'value': gtw_client,
-                            'strict': False
-                        }
-                    ])
-
-            if sm_row['Reporting To Name'] != gtw_report_to_name:
-                update_check = 1
-                update_row_cells.extend([
-                        {
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["Reporting To Name"],
-                            'value': gtw_report_to_name,
-                            'strict': False
-                        }
-                    ])
-
-            if sm_row['Reporting To Email'] != gtw_report_to_email:
-                update_check = 1
-                update_row_cells.extend([
-                        {
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["Reporting To Email"],
-                            'value': gtw_report_to_email,
-                            'strict': False
-                        }
-                    ])
-
-            if sm_row['DR Type'] != gtw_dr_type:
-                update_check = 1
-                update_row_cells.extend([
-                        {
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["DR Type"],
-                            'value': gtw_dr_type,
-                            'strict': False
-                        }
-                    ])
-
-            if sm_row['Short Description'] != gtw_desc:
-                update_check = 1
-                update_row_cells.extend([
-                        {
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["Short Description"],
-                            'value': gtw_desc,
-                            'strict': False
-                        }
-                    ])
-
-            if sm_row['Is Reopened'] != gtw_is_reopened:
-                update_check = 1
-                update_row_cells.extend([
-                        {
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["Is Reopened"],
-                            'value': gtw_is_reopened,
-                            'strict': False
-                        }
-                    ])
-                
-            if previous_reopen_date!= gtw_reopened_date:
-                update_check = 1
-                update_row_cells.extend([
-                        {
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["Reopened Date"],
-                            'value': gtw_reopened_date,
-                            'strict': False
-                        }
-                    ])
-
-            if sm_row['Current State From Date'] != gtw_current_state_date:
-                update_check = 1
-                update_row_cells.extend([
-                        {
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["Current State From Date"],
-                            'value': gtw_current_state_date,
-                            'strict': False
-                        }
-                    ])
-
-            if sm_row['Criticality'] != gtw_criticality:
-                update_check = 1
-                update_row_cells.extend([
-                        {
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["Criticality"],
-                            'value': gtw_criticality,
-                            'strict': False
-                        }
-                    ])
-
-        elif sm_row['Task_Level'] == 2:
-            ### Auto populate task start and finish based on status for Level 2 sub-task
-            sub_task_name = sm_row['Task Name']
-            print(sub_task_name)
-            print(subtask_map)
-            completed_on_status = subtask_map[subtask_map.Sub_Task==sub_task_name]['Completed_On_Status'].values[0]
-            auto_populate_task = subtask_map[subtask_map.Sub_Task==sub_task_name]['Auto_Populate_Status'].values[0]
-            completed_on_status = str(completed_on_status).split(', ')
-            subtask_start_date = None
-            subtask_end_date = None
-            current_subtask_start_date = None
-            current_subtask_end_date = None
-            checkbox = False
-
-            if gtw_status in completed_on_status:
-                first_status = completed_on_status[0]
-                first_status_start_date = gtw_status_df[(gtw_status_df.name==first_status)]['date_entry'].min()
-                subtask_dates = gtw_status_df[(gtw_status_df.name==auto_populate_task) & (gtw_status_df.date_exit<=first_status_start_date)].copy()
-                subtask_dates =  subtask_dates[(subtask_dates.iteration_num==subtask_dates.iteration_num.min())]
-               
-                #print(qr_id," ",sub_task_name," ",gtw_status," ",first_status," ",auto_populate_task, " ",first_status_start_date)
-                #print(gtw_status_df)
-                #print(subtask_dates)
-                if not subtask_dates.empty:
-                    checkbox = True
-                    subtask_start_date = datetime.strptime(str(subtask_dates['date_entry'].iat[0]),'%Y-%m-%d %H:%M:%S').strftime('%m/%d/%Y')
-                    subtask_end_date = datetime.strptime(str(subtask_dates['date_exit'].iat[-1]),'%Y-%m-%d %H:%M:%S').strftime('%m/%d/%Y')
-                    completion_percent = "100%"
-
-            if 'Done or Cancelled' in sub_task_name:
-                if gtw_status in ['Closed - Done', 'Closed - Cancelled']:
-                    checkbox = True
-                    subtask_start_date = gtw_closed_date
-                    subtask_end_date = gtw_closed_date
-                    completion_percent = "100%"
-                else:
-                    checkbox = False
-                    subtask_start_date = ''
-                    subtask_end_date = ''
-                    completion_percent = ''
-
-            if date_pattern.search(str(sm_row['Started Date'])):
-                current_subtask_start_date = datetime.strptime(str(sm_row['Started Date']),'%Y-%m-%d').strftime('%m/%d/%Y')
-
-            if date_pattern.search(str(sm_row['Finished Date'])):
-                current_subtask_end_date = datetime.strptime(str(sm_row['Finished Date']),'%Y-%m-%d').strftime('%m/%d/%Y')
-
-            if subtask_start_date!=None and subtask_end_date!=None:
-                if current_subtask_start_date!=subtask_start_date or current_subtask_end_date!=subtask_end_date:
-                    update_check = 1
-                    update_row_cells.extend([  
-                        {
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["Started Date"],
-                            'value': subtask_start_date,
-                            'strict': False
-                        },
-                        {
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["Finished Date"],
-                            'value': subtask_end_date,
-                            'strict': False
-                        },
-                        {
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["% Complete"],
-                            'value': completion_percent,
-                            'strict': False
-                        },
-                        {
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["Started"],
-                            'type': 'CHECKBOX',
-                            'value': checkbox,
-                            'strict': True
-                        },
-                        {
-                            'row_id': sm_row['Smartsheet_Row_Id'],
-                            'column_id': column_map["Finished"],
-                            'type': 'CHECKBOX',
-                            'value': checkbox,
-                            'strict': True
-                        }
-                    ])
-
-        ### Update contact for all parent and child rows
-        if sm_row['Assigned To'] != gtw_responsible_email and gtw_responsible_email!="N/A":
-            update_check = 1
-            new_contact = {
-                'objectType': 'CONTACT',
-                'email': gtw_responsible_email, 
-                'name': gtw_responsible_name
+    ### Update contact for all parent and child rows
+    gtw_all = gtw_df.reindex(qr_keys)
+    gtw_responsible_email = gtw_all['responsible_email'].to_numpy(dtype=object)
+    gtw_responsible_name = gtw_all['responsible_name'].tolist()
+    contact_mask = (old_data_df['Assigned To'].to_numpy(dtype=object) != gtw_responsible_email) & (gtw_responsible_email != "N/A")
+    all_row_ids = old_data_df['Smartsheet_Row_Id'].tolist()
+
+    for position in np.flatnonzero(contact_mask):
+        new_contact = {
+            'objectType': 'CONTACT',
+            'email': gtw_responsible_email[position],
+            'name': gtw_responsible_name[position]
+        }
+
+        row_cells[all_row_ids[position]].extend([
+            {
+                'row_id': all_row_ids[position],
+                'column_id': column_map["Assigned To"],
+                'object_value': new_contact,
+                'strict': True
             }
+        ])
 
-            update_row_cells.extend([
-                {
-                    'row_id': sm_row['Smartsheet_Row_Id'],
-                    'column_id': column_map["Assigned To"],
-                    'object_value': new_contact,
-                    'strict': True
-                }
-            ])
-
-        if update_check==1:
-            updated_deviation.append(qr_id)
+    update_row_cells = [update_cell for row_id in row_cells for update_cell in row_cells[row_id]]
+    updated_deviation = {qr_id for qr_id, row_id in zip(qr_keys.tolist(),all_row_ids) if len(row_cells[row_id])>0}
+    sm.metrics.record_phase('diff',time.perf_counter() - diff_started)
 
     if len(update_row_cells) > 0 :
-        update_sheet = sm.update_smartsheet_cell(sheet_id=sheet_id,
-                                                update_row_cells=update_row_cells)
+        with sm.metrics.phase('update'):
+            update_sheet = sm.update_smartsheet_cell(sheet_id=sheet_id,
+                                                    update_row_cells=update_row_cells)
     if len(updated_deviation) > 0:
         print(f'{len(updated_deviation)} records updated in smartsheet')
 
     ## Offload data to SQL database and Delete Record from Smartsheet
     if len(closed_deviation)>0:
         export_df = old_data_df[old_data_df.QR_Id.isin(closed_deviation)]
-        save_data_to_sql(dataframe=export_df,sql_engine=kwargs['sql_engine'])
+        with sm.metrics.phase('offload'):
+            save_data_to_sql(dataframe=export_df,sql_engine=kwargs['sql_engine'],batch_size=kwargs.get('offload_batch_size',DEFAULT_OFFLOAD_BATCH_SIZE))
+        sm.metrics.increment('rows_offloaded',len(export_df))
         print(f'Inserted {len(closed_deviation)} closed deviation records into sql database')
     
     if len(delete_row_id)>0: 
-        update_sheet = sm.delete_rows_from_sheet(sheet_id=sheet_id,row_ids=delete_row_id)
+        with sm.metrics.phase('delete'):
+            update_sheet = sm.delete_rows_from_sheet(sheet_id=sheet_id,row_ids=delete_row_id)
         print(f'Deleted {len(delete_row_id)} deviation records from smartsheet')
 
     return(update_sheet)
@@ -550,28 +541,32 @@ def run_smartsheet_add_data(**kwargs):
     sheet_id = kwargs['sheet_id']
     new_data_df = kwargs['new_data_df']
     column_map = kwargs['column_map']
-    subtask_map = kwargs['subtask']
+    subtask_rules = kwargs['subtask']
     status_sql = kwargs['sql_string']
     oracle_engine = kwargs['oracle_engine']
-    predecessor_value = None
+    calendar = kwargs['calendar']
     predecessor_type = "FS"
-    update_sheet = None
+    parent_row_specs = []
+    child_row_specs = []
+
+    ## Get the Status update dates for all new deviations up front
+    status_history = prefetch_status_history(sql_string=status_sql,
+                                             oracle_engine=oracle_engine,
+                                             qr_ids=new_data_df['qr_id'].tolist(),
+                                             metrics=sm.metrics)
 
-    for parent_index, parent_row in new_data_df.iterrows():
+    ## Chained sub-task open dates for every new deviation, one row per deviation
+    subtask_schedule = bc.format_business_dates(bc.subtask_open_dates(bc.to_business_dates(new_data_df['date_opened']),
+                                                                      [rule.duration for rule in subtask_rules],
+                                                                      calendar))
+
+    for parent_position, (parent_index, parent_row) in enumerate(new_data_df.iterrows()):
 
         open_date = parent_row["date_opened"]
         today_date = date.today().strftime("%m/%d/%Y")
 
         iteration_num = int(parent_row['deviation_iteration_num'])
-        ## Get the Status update date based on QR-ID and Iteration Number
-        query_sql = status_sql["multi_iteration"]
-        query_sql = query_sql.format(QR_ID=parent_row['qr_id'])
-        gtw_status_df = pd.read_sql(query_sql,oracle_engine)
-
-        if len(gtw_status_df) == 0:
-            query_sql = status_sql["first_iteration"]
-            query_sql = query_sql.format(QR_ID=parent_row['qr_id'])
-            gtw_status_df = pd.read_sql(query_sql,oracle_engine)
+        gtw_status_df = status_history[int(parent_row['qr_id'])]
 
         contact = {'objectType': 'CONTACT',
                    'email': parent_row['responsible_email'], 
@@ -684,37 +679,31 @@ def run_smartsheet_add_data(**kwargs):
 
         ]
 
-        ## Add parent rows
-        update_sheet = sm.add_row_into_sheet(sheet_id=sheet_id,
-                                             parent_row_id=None,
-                                             add_cells=parent_row_cells,
-                                             to_bottom=True,
-                                             add_predecessor=False)
+        ## Queue parent row
+        parent_row_specs.append({'add_cells': parent_row_cells,
+                                 'parent_row_id': None,
+                                 'to_bottom': True})
 
-        parent_row_id = update_sheet.rows[-1].id
-        subtask_open_date = open_date
-        predecessor_value = None
+        child_rows = []
         checkbox = False
         completion_percent = None
         subtask_start_date = None
         subtask_end_date = None
 
         ## Add child rows
-        for child_index, child_row in subtask_map.iterrows():
+        for child_position, rule in enumerate(subtask_rules):
 
             status = parent_row['status']
-            subtask = child_row['Sub_Task']
-            duration = child_row['Duration']
-            completed_on_status = str(child_row['Completed_On_Status']).split(', ')
-            auto_populate_task = str(child_row['Auto_Populate_Status'])
+            subtask_open_date = subtask_schedule[parent_position][child_position]
+            subtask = rule.sub_task
+            duration = rule.duration
 
             child_row_cells = []
 
-            if status in completed_on_status:
+            if status in rule.completed_on_status_set:
 
-                first_status = completed_on_status[0]
-                first_status_start_date = gtw_status_df[(gtw_status_df.name==first_status)]['date_entry'].min()
-                subtask_dates = gtw_status_df[(gtw_status_df.name==auto_populate_task) & (gtw_status_df.date_exit<=first_status_start_date)].copy()
+                first_status_start_date = gtw_status_df[(gtw_status_df.name==rule.first_status)]['date_entry'].min()
+                subtask_dates = gtw_status_df[(gtw_status_df.name==rule.auto_populate_status) & (gtw_status_df.date_exit<=first_status_start_date)].copy()
                 subtask_dates =  subtask_dates[(subtask_dates.iteration_num==subtask_dates.iteration_num.min())]
 
                 checkbox = True
@@ -782,22 +771,24 @@ def run_smartsheet_add_data(**kwargs):
                     }
                 ])
                 
-            update_sheet = sm.add_row_into_sheet(sheet_id=sheet_id,
-                                                 parent_row_id=parent_row_id,
-                                                 add_cells=child_row_cells,
-                                                 to_bottom=True,
-                                                 add_predecessor=True,
-                                                 predecessor_column_id=column_map['Predecessors'],
-                                                 predecessor_value=predecessor_value,
-                                                 predecessor_type=predecessor_type)
-
-            predecessor_value = update_sheet.rows[-1].id
-            subtask_close_date = add_business_days(datetime.strptime(subtask_open_date,'%m/%d/%Y'),duration-1)
-            subtask_open_date = add_business_days(subtask_close_date,1).strftime('%m/%d/%Y')
+            ## Queue child row, predecessors are linked once the row ids are known
+            child_rows.append({'add_cells': child_row_cells,
+                               'to_bottom': True})
 
+        child_row_specs.append(child_rows)
         #break
 
-    return(update_sheet)
+    ## Add all parent rows and their sub-task rows in bulk
+    parent_row_ids = []
+    if len(parent_row_specs)>0:
+        with sm.metrics.phase('add'):
+            parent_row_ids, child_row_ids = sm.add_row_tree(sheet_id=sheet_id,
+                                                            parent_row_specs=parent_row_specs,
+                                                            child_row_specs=child_row_specs,
+                                                            predecessor_column_id=column_map['Predecessors'],
+                                                            predecessor_type=predecessor_type)
+
+    return(parent_row_ids)
 
 
 
@@ -809,12 +800,20 @@ if __name__ == "__main__":
     parser.add_argument("--smartsheet_template", required=True, default="../data/smartsheet_template.csv", help="Template file for auto-populating sub-tasks within Smartsheet")
     parser.add_argument("--credential", required=False, default="../conf/credentials.yml", help="File with database and smartsheet credentials")
     parser.add_argument("--sql_query", required=False,default="../data/sql_query.yml", help="File with SQL queries")
+    parser.add_argument("--holiday_file", required=False, default=None, help="Yaml file with the holiday dates per site code, skipped when scheduling sub-tasks and offloading closed deviations")
+    parser.add_argument("--offload_batch_size", required=False, type=int, default=DEFAULT_OFFLOAD_BATCH_SIZE, help="Rows committed per transaction when offloading closed deviations to SQL")
     parser.add_argument("--show_product_complaint", action="store_true", help="If true, only product complaint deviations will be inputed within smartsheet")
+    parser.add_argument("--metrics_log", required=False, default=None, help="Append phase timings, API counters and query latencies to this file as JSON lines")
+    parser.add_argument("--prometheus_file", required=False, default=None, help="Write the run metrics to this Prometheus textfile when the run ends")
 
     args = parser.parse_args()
 
     start_time = datetime.now()
     print(f"Started At {start_time}")
+    metrics = etm.run_metrics(job='load_deviation_into_smartsheet',
+                              labels={'site': args.site_code},
+                              log_file=args.metrics_log,
+                              prometheus_file=args.prometheus_file)
 
     ### Read SQL Credentials
     print("Read Credentials")
@@ -839,37 +838,35 @@ if __name__ == "__main__":
         query_string = read_sql_query(args.sql_query,args.site_code,args.show_product_complaint)
         ### Read GTW SQL data into Dataframe
         print("Read Deviation data from GTW")
-        df_sql = pd.read_sql(query_string["GTW"],discdev_dbcon)
-
-        df_sql['date_opened'] = df_sql['date_opened'].dt.strftime('%m/%d/%Y')
-        df_sql['date_closed'] = df_sql['date_closed'].dt.strftime('%m/%d/%Y')
-        df_sql['reopen_date'] = df_sql['reopen_date'].dt.strftime('%m/%d/%Y')
-        df_sql['due_date'] = df_sql['due_date'].dt.strftime('%m/%d/%Y')
-        df_sql['date_last_activity'] = df_sql['date_last_activity'].dt.strftime('%m/%d/%Y')
-        df_sql['date_current_state'] = df_sql['date_current_state'].dt.strftime('%m/%d/%Y')
-        df_sql['responsible_name'] = df_sql.responsible_name.str.title()
-        df_sql['responsible_email'] = df_sql.responsible_email.str.lower()
-        df_sql['reporting_to'] = df_sql.reporting_to.str.title()
-        df_sql['reporting_to_email'] = df_sql.reporting_to_email.str.lower()
+        with metrics.phase('extract'), metrics.timer('db_query_seconds',query='GTW'):
+            df_sql = pd.read_sql(query_string["GTW"],discdev_dbcon)
+
+        with metrics.phase('normalize'):
+            df_sql['date_opened'] = df_sql['date_opened'].dt.strftime('%m/%d/%Y')
+            df_sql['date_closed'] = df_sql['date_closed'].dt.strftime('%m/%d/%Y')
+            df_sql['reopen_date'] = df_sql['reopen_date'].dt.strftime('%m/%d/%Y')
+            df_sql['due_date'] = df_sql['due_date'].dt.strftime('%m/%d/%Y')
+            df_sql['date_last_activity'] = df_sql['date_last_activity'].dt.strftime('%m/%d/%Y')
+            df_sql['date_current_state'] = df_sql['date_current_state'].dt.strftime('%m/%d/%Y')
+            df_sql['responsible_name'] = df_sql.responsible_name.str.title()
+            df_sql['responsible_email'] = df_sql.responsible_email.str.lower()
+            df_sql['reporting_to'] = df_sql.reporting_to.str.title()
+            df_sql['reporting_to_email'] = df_sql.reporting_to_email.str.lower()
 
         print("Read TAFQAR data from IMOST")
-        df_sql_tafqar = pd.read_sql(query_string["IMOST"],discdev_dbcon)
-        df_sql_tafqar = df_sql_tafqar.assign(open_dmrs=df_sql_tafqar.open_dmrs.str.split(','))
-        df_sql_tafqar = df_sql_tafqar.explode('open_dmrs')
-        df_sql_tafqar = df_sql_tafqar[~df_sql_tafqar.open_dmrs.isna()]
-        df_sql_tafqar = df_sql_tafqar.astype({"open_dmrs":int})
-        df_sql_tafqar = df_sql_tafqar.groupby(by=['open_dmrs'], as_index=False).agg({'m_batch': lambda x: ','.join(x.unique()),
-                                                                                     'batch': lambda x: ','.join(x.unique()),
-                                                                                     'tafqar_dt': np.min})
-        df_sql_tafqar['tafqar_dt'] = df_sql_tafqar['tafqar_dt'].dt.strftime('%m/%d/%Y')
-
-        print("Add Tafqar information into Deviation data")
-        df_sql = df_sql.merge(df_sql_tafqar, how='left', left_on=['qr_id'], right_on=['open_dmrs'])
+        with metrics.phase('extract'), metrics.timer('db_query_seconds',query='IMOST'):
+            df_sql_tafqar = pd.read_sql(query_string["IMOST"],discdev_dbcon)
+        with metrics.phase('normalize'):
+            df_sql_tafqar = aggregate_tafqar(df_sql_tafqar)
+            df_sql_tafqar['tafqar_dt'] = df_sql_tafqar['tafqar_dt'].dt.strftime('%m/%d/%Y')
+
+            print("Add Tafqar information into Deviation data")
+            df_sql = df_sql.merge(df_sql_tafqar, how='left', left_on=['qr_id'], right_on=['open_dmrs'])
 
         #discdev_dbcon.close()
     else:
         print("Unable to create connection with DISCDEV Global Track Wise Database")
-        sys.exit(1)
+        sys.exit(metrics.finish(1))
 
     print("Build SITE SQL Database Connection")
     sitesql_dbcon,sitesql_engine = create_db_connection(creds['USGRE_SITE_SQL_GTW_DEVIATION'])
@@ -885,16 +882,20 @@ if __name__ == "__main__":
     
     if not sitesql_dbcon:
         print("Unable to create connection with Site SQL Database")
-        sys.exit(1)
+        sys.exit(metrics.finish(1))
 
     ### Read Smartsheet Template Json File
     print("Read Template for Smartsheet")
     smart_template = read_smartsheet_template(args.smartsheet_template)
+    subtask_index = compile_subtask_template(smart_template)
+
+    ### Business day calendar of the site
+    calendar = bc.read_holiday_calendar(args.holiday_file,args.site_code)
 
     ### Smartsheet API
 
     print("Initialize Smartsheet API")
-    sm = ssa.smartsheet_api(creds['SMARTSHEET'])
+    sm = ssa.smartsheet_api(creds['SMARTSHEET'],metrics=metrics)
     print("Get Smartsheet Id")
     sheet_id = sm.get_sheet_by_name_in_folder()
     print("Map Column Names To Column Id in Smartsheet")
@@ -903,10 +904,11 @@ if __name__ == "__main__":
     ## Get current data in smartsheet
     print("Check for existing data in Smartsheet")
     current_smartsheet_df = pd.DataFrame()
-    print("Get Row data From Smartsheet")
-    rows = sm.get_rows_from_sheet(sheet_id=sheet_id)
-    print("Save Smartsheet data into Dataframe")
-    current_smartsheet_df = save_rows_to_df(rows,column_map['id_to_name'])
+    with metrics.phase('read_sheet'):
+        print("Get Row data From Smartsheet")
+        sheet_df = sm.get_rows_frame(sheet_id=sheet_id)
+        print("Save Smartsheet data into Dataframe")
+        current_smartsheet_df = save_frame_to_df(sheet_df)
 
     df_sql = df_sql.fillna("N/A")
         
@@ -918,10 +920,12 @@ if __name__ == "__main__":
                                                    old_data_df=current_smartsheet_df,
                                                    new_data_df=df_sql,
                                                    column_map=column_map['name_to_id'],
-                                                   subtask=smart_template,
+                                                   subtask=subtask_index,
                                                    sql_string=query_string["GTW_STATUS_DATE"],
                                                    oracle_engine=discdev_dbcon,
-                                                   sql_engine=sitesql_engine)
+                                                   sql_engine=sitesql_engine,
+                                                   offload_batch_size=args.offload_batch_size,
+                                                   calendar=calendar)
         ## Filter to keep only new records
         df_sql_temp = df_sql[~df_sql.qr_id.isin(current_smartsheet_df.QR_Id.unique().tolist())]
 
@@ -941,10 +945,12 @@ if __name__ == "__main__":
     ## Add new data to smartsheets
     print("Add New Records in Smartsheet")
     print(f"Adding {len(df_sql)} new deviation records")
-    if datetime.strptime(date.today().strftime("%Y-%m-%d"),'%Y-%m-%d') < datetime.strptime('2024-03-19','%Y-%m-%d'):
-        smart_template = smart_template[smart_template.Version==1]
-    else:
-        smart_template = smart_template[smart_template.Version==2]
+    template_version = 2
+    if date.today() < date.fromisoformat(TEMPLATE_V2_START_DATE):
+        template_version = 1
+    if template_version not in subtask_index['versions']:
+        raise ValueError(f"Smartsheet template {args.smartsheet_template} has no sub-tasks for version {template_version}")
+    subtask_rules = subtask_index['versions'][template_version]
 
     df_sql = df_sql.head(10)
     
@@ -952,14 +958,9 @@ if __name__ == "__main__":
                                             sheet_id=sheet_id,
                                             new_data_df=df_sql,
                                             column_map=column_map['name_to_id'],
-                                            subtask=smart_template,
+                                            subtask=subtask_rules,
                                             sql_string=query_string["GTW_STATUS_DATE"],
-                                            oracle_engine=discdev_dbcon)
-
-    end_time = datetime.now()
-    print(f"Finished At {end_time}")
-    total_time = end_time - start_time
-    total_time_s = total_time.total_seconds()
-    total_time_h = divmod(total_time_s, 60)[0]
-    print(f"Completed in {total_time_h} minutes")
-    sys.exit(1)
\ No newline at end of file
+                                            oracle_engine=discdev_dbcon,
+                                            calendar=calendar)
+
+    sys.exit(metrics.finish(0))
\ No newline at end of file
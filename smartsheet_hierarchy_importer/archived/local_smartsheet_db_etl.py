@@ -8,6 +8,10 @@ import pandas as pd
 import numpy as np
 import datetime
 import smartsheet_api as ssa
+import smartsheet_diff as ssd
+import smartsheet_changeset as sscs
+import smartsheet_journal as ssj
+import etl_metrics as etm
 from pathlib import Path
 from datetime import timedelta
 from datetime import datetime
@@ -16,6 +20,8 @@ import smartsheet
 import time
 import re
 import argparse
+import itertools
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 
 def read_credentials(cred_file):
@@ -33,9 +39,38 @@ def read_sql_query(query_file,site_code,datasource):
     site_tag = site_code+"_"+datasource
 
     query_string[datasource] = sql_query.get(site_tag).get("sql_query")
+    ## Optional incremental query with a {WATERMARK} placeholder and the column the watermark is taken from
+    query_string[datasource+"_INCREMENTAL"] = sql_query.get(site_tag).get("incremental_sql_query")
+    query_string[datasource+"_WATERMARK_COLUMN"] = sql_query.get(site_tag).get("watermark_column")
 
     return(query_string)
 
+def read_state_file(state_file):
+    project_dir = Path(__file__).parent
+    state_filepath = project_dir.joinpath(state_file)
+    state = {}
+    if state_filepath.exists():
+        with open(state_filepath) as f_in:
+            state = json.load(f_in)
+    return(state)
+
+def save_state_file(state_file,state):
+    project_dir = Path(__file__).parent
+    state_filepath = project_dir.joinpath(state_file)
+    temp_filepath = state_filepath.with_suffix('.tmp')
+    with open(temp_filepath,'w') as f_out:
+        json.dump(state,f_out,indent=2)
+    temp_filepath.replace(state_filepath)
+
+def update_watermark(watermark,df_chunk):
+    ## Track the highest watermark column value seen, on the raw (not yet stringified) chunk
+    watermark_columns = [column for column in df_chunk.columns if column.upper()==watermark['column'].upper()]
+    if len(watermark_columns)==0:
+        return
+    chunk_max = df_chunk[watermark_columns[0]].max()
+    if pd.notna(chunk_max) and (watermark['value'] is None or chunk_max > watermark['value']):
+        watermark['value'] = chunk_max
+
 def create_db_connection(creds_db):
 
     dbtype = creds_db['dbtype']
@@ -62,123 +97,253 @@ def create_db_connection(creds_db):
         print(e)
     return(dbcon,engine)
 
-def save_rows_to_df(rows,column_map_idtoname,primary_key):
-    data = []
-    qr_id = None
-    parent_row_id = None
-
-    for row in rows:
-        row_dict = {}
-        row_dict["Smartsheet_Row_Id"] = row.id
-        for cell in row.cells:
-            row_dict[column_map_idtoname[cell.column_id]] = cell.value
-        data.append(row_dict)
-
+def normalize_sql_chunk(df_chunk,db_name):
+    df_chunk = df_chunk.astype(str)
+    if db_name == 'GTW':
+        df_chunk.columns = df_chunk.columns.str.upper()
+    return(df_chunk)
+
+def read_sql_chunks(**kwargs):
+    ## Yields the query result as string typed dataframes. Without a chunksize the whole result is
+    ## read at once, otherwise rows are streamed from a server side cursor chunksize rows at a time
+    dbcon = kwargs['dbcon']
+    sql_query = kwargs['sql_query']
+    db_name = kwargs['db_name']
+    chunksize = kwargs.get('chunksize')
+    watermark = kwargs.get('watermark')
+    metrics = kwargs['metrics']
+
+    if chunksize==None:
+        with metrics.phase('extract'), metrics.timer('db_query_seconds',query=db_name):
+            df_sql = pd.read_sql(sqlalchemy.text(sql_query),dbcon)
+        metrics.increment('db_rows_read',len(df_sql),query=db_name)
+        with metrics.phase('normalize'):
+            if watermark!=None:
+                update_watermark(watermark,df_sql)
+            df_sql = normalize_sql_chunk(df_sql,db_name)
+        yield df_sql
+        return
+
+    ## Every chunk fetched from the cursor is observed on its own
+    stream_con = dbcon.execution_options(stream_results=True)
+    sql_chunks = iter(pd.read_sql(sqlalchemy.text(sql_query),stream_con,chunksize=chunksize))
+    chunk_index = 0
+    while True:
+        with metrics.phase('extract'), metrics.timer('db_query_seconds',query=db_name):
+            df_chunk = next(sql_chunks,None)
+        if df_chunk is None:
+            return
+        chunk_index += 1
+        print(f"Read chunk {chunk_index} with {len(df_chunk)} rows")
+        metrics.increment('db_rows_read',len(df_chunk),query=db_name)
+        with metrics.phase('normalize'):
+            if watermark!=None:
+                update_watermark(watermark,df_chunk)
+            df_chunk = normalize_sql_chunk(df_chunk,db_name)
+        yield df_chunk
+
+def iter_partitions(**kwargs):
+    ## Group streamed chunks into (partition key, dataframe) pairs. When the query is ordered by the
+    ## partition field (partition_sorted) each partition is released as soon as the next one starts,
+    ## so it can be synced while the rest of the result is still being read
+    sql_chunks = kwargs['sql_chunks']
+    partition_by = kwargs['partition_by']
+    partition_sorted = kwargs.get('partition_sorted',False)
+
+    if partition_by==None:
+        yield kwargs['out_file_name'], pd.concat(sql_chunks,ignore_index=True)
+        return
+
+    pending_partitions = {}
+    for df_chunk in sql_chunks:
+        for partition_key, df_partition in df_chunk.groupby(partition_by,sort=False,dropna=False):
+            if partition_sorted==True and partition_key not in pending_partitions:
+                for completed_key in list(pending_partitions):
+                    yield completed_key, pd.concat(pending_partitions.pop(completed_key),ignore_index=True)
+            pending_partitions.setdefault(partition_key,[]).append(df_partition)
+
+    for partition_key in list(pending_partitions):
+        yield partition_key, pd.concat(pending_partitions.pop(partition_key),ignore_index=True)
+
+def sheet_frame_to_df(sheet_df,primary_key):
+    ## Sheet rows read with get_rows_frame, typed as strings for the comparison with the source data
     df = pd.DataFrame()
-    if len(data)>0:
-        df = pd.DataFrame(data)
-        df = df.astype(str)
-        df["Smartsheet_Row_Id"] = df["Smartsheet_Row_Id"].astype(int)
+    if len(sheet_df)>0:
+        df = sheet_df.drop(columns=["Smartsheet_Parent_Id"]).astype(str)
+        df["Smartsheet_Row_Id"] = sheet_df["Smartsheet_Row_Id"]
         df[primary_key] = df[primary_key].replace('\.0$','',regex=True)
 
     return(df)
 
-def run_smartsheet_update_data(**kwargs):
+def plan_partition_sheet(**kwargs):
+    ## Work out every write needed to bring one partition sheet in line with the source data,
+    ## without writing anything. Returns a change set entry, see smartsheet_changeset
     sm = kwargs['smartsheet']
-    sheet_id = kwargs['sheet_id']
-    old_data_df = kwargs['old_data_df']
-    new_data_df = kwargs['new_data_df']
-    column_map = kwargs['column_map']
-    pk_field = kwargs['pk_field']
+    sheet_name = kwargs['sheet_name']
+    data_df = kwargs['data_df']
+    sheet_dict = kwargs['sheet_dict']
+    primary_key = kwargs['primary_key']
+    sheet_template = kwargs['sheet_template']
+    smartsheet_column_type = kwargs['smartsheet_column_type']
     delete_flag = kwargs['delete_flag']
-    updated_records = {}
-    update_row_cells = []
-    delete_row_id = []
-    update_sheet = None
-    
-    column_map = {key: value for key, value in column_map.items() if key in new_data_df.columns}
-
-    for index, sm_row in old_data_df.iterrows():
-
-        pk_id = sm_row[pk_field]    
-        row_id = sm_row['Smartsheet_Row_Id']
-
-        ### Delete Records if Flag is True and PK ID from old record is no longer present in new record dataframe
-        if delete_flag==True:
-            if not pk_id in new_data_df[pk_field].values:
-                delete_row_id.append(row_id)
-                continue
+    ## Fingerprints stored for this sheet by the last sync, None when row hashing is not used
+    row_hash_state = kwargs.get('row_hash_state')
+
+    sheet_change = sscs.new_sheet_change(sheet_name=sheet_name,sheet_template=sheet_template,primary_key=primary_key)
+
+    row_hashes = None
+    previous_hashes = None
+    if row_hash_state!=None:
+        hash_columns = sorted(column for column in data_df.columns if column != primary_key)
+        with sm.metrics.phase('diff',sheet_name=sheet_name):
+            row_hashes = ssd.hash_rows(data_df,hash_columns,primary_key)
+        sheet_change['row_hashes'] = {'columns': hash_columns, 'hashes': row_hashes}
+        ## Hashes taken over a different set of columns can not be compared
+        if row_hash_state.get('columns')==hash_columns:
+            previous_hashes = row_hash_state.get('hashes')
+
+    ## Get row ids for current data in smartsheet
+    if sheet_name in sheet_dict:
+        with sm.metrics.phase('read_sheet',sheet_name=sheet_name):
+            ## Get smartsheet id for the current sheet
+            print(f"Get Sheet ID for {sheet_name} Smartsheet")
+            sheet_id = sm.get_sheet_by_name_in_folder(sheet_name=sheet_name)
+            sheet_change['sheet_id'] = sheet_id
+
+            print(f"Map Column Names To Column Id in {sheet_name} Smartsheet")
+            column_map = dict(sm.get_column_name_id_map(sheet_id=sheet_id)['name_to_id'])
+
+            print(f"Get Row data From {sheet_name} Smartsheet")
+            ## Only the columns present in the source data are compared, the rest are not downloaded
+            compare_column_ids = [column_map[column] for column in data_df.columns if column in column_map]
+            sheet_df = sm.get_rows_frame(sheet_id=sheet_id,column_ids=compare_column_ids)
+            print(f"Check for existing data in {sheet_name} Smartsheet")
+            current_smartsheet_df = sheet_frame_to_df(sheet_df,primary_key)
+            current_smartsheet_df = current_smartsheet_df.fillna("")
 
-        for column_name in column_map:
-            if column_name == pk_field:
+        ### New columns in the source data, planned columns get a placeholder id for the diff
+        for index, column in enumerate(data_df.columns):
+            if column not in column_map:
+                sheet_change['add_columns'].append({'title': column, 'type': smartsheet_column_type[column], 'index': index})
+                column_map[column] = -(index+1)
+                if not current_smartsheet_df.empty:
+                    current_smartsheet_df[column] = ''
+
+        if not current_smartsheet_df.empty:
+            with sm.metrics.phase('diff',sheet_name=sheet_name):
+                sheet_diff = ssd.diff_sheet_data(old_data_df=current_smartsheet_df,
+                                                 new_data_df=data_df,
+                                                 column_map=column_map,
+                                                 pk_field=primary_key,
+                                                 delete_flag=delete_flag,
+                                                 previous_hashes=previous_hashes,
+                                                 row_hashes=row_hashes)
+            if sheet_diff['skipped_count']>0:
+                print(f"{sheet_diff['skipped_count']} records unchanged since last sync, skipped comparison")
+
+            column_titles = {column_id: column for column, column_id in column_map.items()}
+            sheet_change['update_row_cells'] = [{'row_id': cell['row_id'],
+                                                 'column': column_titles[cell['column_id']],
+                                                 'value': cell['value'],
+                                                 'strict': cell['strict']}
+                                                for cell in sheet_diff['update_row_cells']]
+            sheet_change['delete_row_ids'] = sheet_diff['delete_row_ids']
+            print(f"{len(sheet_diff['updated_keys'])} records to update and {len(sheet_diff['delete_row_ids'])} to delete in {sheet_name} Smartsheet")
+
+            ## Filter to add only new record
+            data_df = data_df[~data_df[primary_key].isin(current_smartsheet_df[primary_key].unique().tolist())]
+
+    print(f"{len(data_df)} new records to add in {sheet_name} Smartsheet")
+    sheet_change['add_rows'] = data_df.to_dict('records')
+
+    return(sheet_change)
+
+def sync_partition_sheet(**kwargs):
+    ## Plan the partition and, unless only planning, apply it straight away with the same client
+    sheet_change = plan_partition_sheet(**kwargs)
+    if kwargs.get('plan_only')==True:
+        return(sheet_change)
+    return(sscs.apply_sheet_change(smartsheet=kwargs['smartsheet'],sheet_change=sheet_change))
+
+def save_sync_state(**kwargs):
+    ## Store the row fingerprints of every sheet that synced and move the watermark forward
+    ## when all of them did. Shared by normal runs and runs applying a saved change set
+    sheet_results = kwargs['sheet_results']
+    watermark_key = kwargs['watermark_key']
+    row_hash_file = kwargs.get('row_hash_file')
+    watermark_file = kwargs.get('watermark_file')
+    watermark_value = kwargs.get('watermark_value')
+    is_full_run = kwargs['is_full_run']
+    start_time = kwargs['start_time']
+
+    ### An incremental run only read the changed records so their hashes are merged into the stored ones
+    if row_hash_file!=None:
+        row_hash_state = read_state_file(row_hash_file)
+        site_row_hashes = row_hash_state.get(watermark_key,{})
+        for sheet_result in sheet_results:
+            if 'row_hashes' not in sheet_result:
                 continue
-            
-            new_col_val = str(new_data_df[new_data_df[pk_field]==pk_id][column_name].values[0])
-            sm_col_val = str(sm_row[column_name])
-
-            date_pattern= re.compile(r'^\d{4}-\d{2}-\d{2}$')
-            numeric_pattern = re.compile(r'\.0$')
-
-            if date_pattern.search(sm_col_val):
-                sm_col_val = datetime.strptime(sm_col_val,'%Y-%m-%d').strftime('%m/%d/%Y')
-            elif numeric_pattern.search(sm_col_val):
-                sm_col_val = sm_col_val.replace('.0','')
-            elif numeric_pattern.search(new_col_val):
-                new_col_val = new_col_val.replace('.0','')
-                
-            if sm_col_val != new_col_val:
-                updated_records[pk_id] = 1
-                update_row_cells.extend([
-                        {   'row_id': row_id,
-                            'column_id': column_map[column_name],
-                            'value': new_col_val,
-                            'strict': False
-                        }
-                    ])
-
-    ### Update Records
-    if len(update_row_cells)>0:
-        update_sheet = sm.update_smartsheet_cell(sheet_id=sheet_id,
-                                                 update_row_cells=update_row_cells)
-                                                 
-        print(f'{len(updated_records)} records updated in smartsheet')
-
-    if len(delete_row_id)>0:
-        update_sheet = sm.delete_rows_from_sheet(sheet_id=sheet_id,row_ids=delete_row_id)
-    
-        print(f'{len(delete_row_id)} records deleted in smartsheet')
-
-    return(update_sheet)
-
-def run_smartsheet_add_data(**kwargs):
-
-    sm = kwargs['smartsheet']
-    sheet_id = kwargs['sheet_id']
-    new_data_df = kwargs['new_data_df']
-    column_map = kwargs['column_map']
-    update_sheet = None
-
-    column_map = {key: value for key, value in column_map.items() if key in new_data_df.columns}
-    
-    for index, row in new_data_df.iterrows():
-        sm_row_cells = []
-        for column_name in column_map:
-            sm_cell_model = {
-                'column_id': column_map[column_name],
-                'value': row[column_name],
-                'strict': False
-            }
-            sm_row_cells.append(sm_cell_model)  
-
-        ## Add parent rows
-        update_sheet = sm.add_row_into_sheet(sheet_id=sheet_id,
-                                             parent_row_id=None,
-                                             add_cells=sm_row_cells,
-                                             to_bottom=True,
-                                             add_predecessor=False)
-
-    return(update_sheet)
-
+            sheet_hashes = sheet_result['row_hashes']
+            stored_hashes = site_row_hashes.get(sheet_result['sheet_name'],{})
+            if not is_full_run and stored_hashes.get('columns')==sheet_hashes['columns']:
+                sheet_hashes['hashes'] = {**stored_hashes.get('hashes',{}), **sheet_hashes['hashes']}
+            site_row_hashes[sheet_result['sheet_name']] = sheet_hashes
+        row_hash_state[watermark_key] = site_row_hashes
+        save_state_file(row_hash_file,row_hash_state)
+
+    ### Move the watermark forward only when every partition synced
+    if watermark_file!=None and all('error' not in sheet_result for sheet_result in sheet_results):
+        watermark_state = read_state_file(watermark_file)
+        site_watermark = dict(watermark_state.get(watermark_key,{}))
+        if watermark_value is not None:
+            site_watermark['watermark'] = str(watermark_value)
+        if is_full_run:
+            site_watermark['last_full_reconcile'] = start_time.isoformat()
+        watermark_state[watermark_key] = site_watermark
+        save_state_file(watermark_file,watermark_state)
+        print(f"Saved watermark {site_watermark.get('watermark')} for {watermark_key}")
+
+def apply_planned_change_set(**kwargs):
+    ## Apply a change set, store the sync state planned with it and return the exit code.
+    ## With a journal, batches already written by an earlier attempt at the same change set are skipped
+    change_set = kwargs['change_set']
+    ss_creds = kwargs['ss_creds']
+    args = kwargs['args']
+    journal = kwargs.get('journal')
+    metrics = kwargs['metrics']
+
+    sscs.print_change_set_summary(change_set)
+    if journal!=None:
+        resumed_steps = journal.begin(change_set)
+        if resumed_steps>0:
+            print(f"Resuming from journal {args.journal_file}, {resumed_steps} batches already written")
+
+    sheet_results = sscs.apply_change_set(change_set=change_set,ss_creds=ss_creds,workers=args.workers,journal=journal,metrics=metrics)
+    print_sheet_results(sheet_results)
+    save_sync_state(sheet_results=sheet_results,
+                    watermark_key=change_set['watermark_key'],
+                    row_hash_file=args.row_hash_file,
+                    watermark_file=args.watermark_file if change_set['incremental'] else None,
+                    watermark_value=change_set['watermark'],
+                    is_full_run=change_set['is_full_run'],
+                    start_time=datetime.fromisoformat(change_set['start_time']))
+
+    if any('error' in sheet_result for sheet_result in sheet_results):
+        if journal!=None:
+            print(f"Run again with --journal_file {args.journal_file} to resume")
+        return(1)
+    if journal!=None:
+        journal.clear()
+    return(0)
+
+def print_sheet_results(sheet_results):
+    print("Partition Results")
+    for sheet_result in sorted(sheet_results,key=lambda result: result['sheet_name']):
+        if 'error' in sheet_result:
+            print(f"{sheet_result['sheet_name']}: FAILED - {sheet_result['error']}")
+        else:
+            print(f"{sheet_result['sheet_name']}: {sheet_result['rows_updated']} rows updated, {sheet_result['rows_deleted']} deleted, "
+                  f"{sheet_result['rows_added']} added in {sheet_result['duration_s']:.1f}s")
 
 
 if __name__ == "__main__":
@@ -191,22 +356,60 @@ if __name__ == "__main__":
     parser.add_argument("--db_name", required=True,choices=['GTW','GSM','MAXIMO'], help="Name of the Data Source")
     parser.add_argument("--primary_key", required=True, help="Name of the primary key field in the sql data")
     parser.add_argument("--delete_closed", action="store_true", help="If true, delete closed records from Smartsheet")
+    parser.add_argument("--chunksize", required=False, type=int, default=None, help="Stream the query result in chunks of this many rows instead of loading it at once")
+    parser.add_argument("--partition_sorted", action="store_true", help="Query result is ordered by the partition_by field, sync each partition as soon as it has been read")
+    parser.add_argument("--incremental", action="store_true", help="If true, only read records changed since the last run using the incremental_sql_query and watermark_column of the site")
+    parser.add_argument("--watermark_file", required=False, default="../data/watermark_state.json", help="File storing the high-water mark per site and data source")
+    parser.add_argument("--full_reconcile_hours", required=False, type=float, default=24, help="Run a full reconcile, including deletes, when the last one is older than this many hours")
+    parser.add_argument("--row_hash_file", required=False, default=None, help="File storing a fingerprint per synced record, records unchanged since the last sync are not compared cell by cell. Manual edits in Smartsheet to such records are not reverted")
+    parser.add_argument("--workers", required=False, type=int, default=1, help="Number of partition sheets to sync concurrently")
+    parser.add_argument("--plan_file", required=False, default=None, help="Only plan the run, write every add, update, delete and new column to this change set file (.json or .json.gz) with the expected API calls")
+    parser.add_argument("--apply_file", required=False, default=None, help="Apply a change set written with --plan_file instead of reading the database")
+    parser.add_argument("--journal_file", required=False, default=None, help="Progress journal, the run is planned first and every written batch is recorded. A failed run started again with the same journal resumes without reading the database")
+    parser.add_argument("--metrics_log", required=False, default=None, help="Append phase timings, API counters and query latencies to this file as JSON lines")
+    parser.add_argument("--prometheus_file", required=False, default=None, help="Write the run metrics to this Prometheus textfile when the run ends")
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--partition_by", help="Name of the Key Field based on which data will be partitioned in different files")
     group.add_argument("--out_file_name", help="Name of the output file for storing data")
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
     
     site_code = args.site_code.upper()
     db_name = args.db_name.upper()
     primary_key = args.primary_key
+    watermark_key = site_code+"_"+db_name
 
     start_time = datetime.now()
     print(f"Started At {start_time}")
+    metrics = etm.run_metrics(job='local_smartsheet_db_etl',
+                              labels={'site': site_code, 'db': db_name},
+                              log_file=args.metrics_log,
+                              prometheus_file=args.prometheus_file)
 
     ### Read SQL Credentials
     print("Read Credentials")
     creds = read_credentials(args.credential)
 
+    journal = None
+    if args.journal_file:
+        journal = ssj.progress_journal(args.journal_file)
+
+    ### Apply a planned change set, the diff was done when it was planned.
+    ### A journal left by a failed run holds its change set, which is resumed
+    change_set = None
+    if args.apply_file:
+        print(f"Apply change set {args.apply_file}")
+        change_set = sscs.load_change_set(args.apply_file)
+    elif journal!=None:
+        change_set = journal.load_change_set()
+        if change_set!=None:
+            print(f"Resume the unfinished run recorded in {args.journal_file}")
+
+    if change_set!=None:
+        exit_code = apply_planned_change_set(change_set=change_set,ss_creds=creds['SMARTSHEET'],args=args,journal=journal,metrics=metrics)
+        sys.exit(metrics.finish(exit_code))
+
     ### Build SQL connection
     print("Build Database Connection")
     dbcon,engine = create_db_connection(creds[args.dbcon_name])
@@ -224,155 +427,194 @@ if __name__ == "__main__":
     if dbcon:
         print(f"Read SQL Queries for {db_name}")
         query_string = read_sql_query(args.sql_query, site_code, db_name)
-        
-        ### Read SQL data into Dataframe
+
+        ### Incremental runs only read records changed since the stored watermark
+        ### A full run is still done when there is no watermark yet or the last full reconcile is too old
+        sql_query = query_string[db_name]
+        delete_flag = args.delete_closed
+        watermark = None
+        is_full_run = True
+
+        if args.incremental:
+            if query_string[db_name+"_INCREMENTAL"]==None or query_string[db_name+"_WATERMARK_COLUMN"]==None:
+                print(f"Missing incremental_sql_query or watermark_column for {site_code}_{db_name}")
+                sys.exit(metrics.finish(1))
+            watermark_state = read_state_file(args.watermark_file)
+            site_watermark = watermark_state.get(watermark_key,{})
+            watermark = {'column': query_string[db_name+"_WATERMARK_COLUMN"], 'value': None}
+            last_full_reconcile = site_watermark.get('last_full_reconcile')
+
+            if site_watermark.get('watermark')!=None and last_full_reconcile!=None \
+                and datetime.now() - datetime.fromisoformat(last_full_reconcile) < timedelta(hours=args.full_reconcile_hours):
+                print(f"Incremental run, reading records changed since {site_watermark['watermark']}")
+                sql_query = query_string[db_name+"_INCREMENTAL"].format(WATERMARK=site_watermark['watermark'])
+                ## Partial data can not be used to detect deleted records
+                delete_flag = False
+                is_full_run = False
+            else:
+                print("Full reconcile run")
+
+        ### Read SQL data into Dataframe, in chunks of --chunksize rows when streaming
         print("Read data from database using SQL query into dataframe")
-        df_sql = pd.read_sql(sqlalchemy.text(query_string[db_name]),dbcon)
-        df_sql = df_sql.astype(str)
-        if db_name == 'GTW':
-            df_sql.columns = df_sql.columns.str.upper()
-        dbcon.close()
+        sql_chunks = read_sql_chunks(dbcon=dbcon,
+                                     sql_query=sql_query,
+                                     db_name=db_name,
+                                     chunksize=args.chunksize,
+                                     watermark=watermark,
+                                     metrics=metrics)
+        first_chunk = next(sql_chunks, None)
     else:
         print(f"Unable to create connection with {args.dbcon_name}")
-        sys.exit(1)
+        sys.exit(metrics.finish(1))
+
+    if first_chunk is None and not is_full_run:
+        print("No records changed since the last run")
+        dbcon.close()
+        sys.exit(metrics.finish(0))
+
+    if first_chunk is None:
+        print(f"No data returned from {db_name}")
+        dbcon.close()
+        sys.exit(metrics.finish(1))
+
+    print(first_chunk.columns)
 
-    print(df_sql.shape)
-    print(df_sql.columns)
-    
     ## Build Column Template for Smartsheet
     print("Get Smartsheet Template")
-    new_smartsheet_column = []
+    sheet_template = []
     smartsheet_column_type = {}
     set_primary_column=1
 
-    for column in df_sql.columns:
-        if df_sql[column].dtype.name =='datetime64[ns]':
-            new_smartsheet_column.append(smartsheet.models.Column({
+    for column in first_chunk.columns:
+        if first_chunk[column].dtype.name =='datetime64[ns]':
+            sheet_template.append({
                 'title': column,
                 'type': 'DATE'
-            }))
-            df_sql[column] = df_sql[column].dt.strftime('%m/%d/%Y')
+            })
+            first_chunk[column] = first_chunk[column].dt.strftime('%m/%d/%Y')
             smartsheet_column_type[column] = 'DATE'
         else:
             if set_primary_column==1:
-                new_smartsheet_column.append(smartsheet.models.Column({
+                sheet_template.append({
                     'title': column,
                     'type': 'TEXT_NUMBER',
                     'primary': True
-                }))
+                })
                 set_primary_column=0
             else:
-                new_smartsheet_column.append(smartsheet.models.Column({
+                sheet_template.append({
                     'title': column,
                     'type': 'TEXT_NUMBER'
-                })) 
+                })
             smartsheet_column_type[column] = 'TEXT_NUMBER'
 
 
     ### Smartsheet API
     print("Initialize Smartsheet API")
-    sm = ssa.smartsheet_api(creds['SMARTSHEET'])
+    sm = ssa.smartsheet_api(creds['SMARTSHEET'],metrics=metrics)
 
-    ### Get list of value for split field
-    ### Data will be split into different files based on this field values
+    ### Data will be split into different files based on the partition_by field values
     ### Each smartsheet will be named as per the value in the list
-    partition_key_list = list()
+    partition_by = None
     if args.partition_by:
         partition_by = args.partition_by.upper()
-        partition_key_list = df_sql[partition_by].unique().tolist()
-    elif args.out_file_name:
-        partition_key_list = [args.out_file_name]
-    else:
+    elif not args.out_file_name:
         print(f"Missing partition_by or out_file_name parameter values")
-        sys.exit(1)
+        sys.exit(metrics.finish(1))
 
     ### Get name and smartsheet id for all sheets in the folder
     print("Get all Smartsheet Name as Key and ID and Value in a Folder")
     sheet_dict = sm.get_all_sheets_in_folder()
 
-    for partition_key in partition_key_list:
+    ### Each partition is an independent sheet, sync them concurrently with a shared request budget
+    ### Every worker gets its own API client, all of them draw from the same rate limiter
+    ### and share the folder index and column maps already fetched
+    limiter = sm.limiter
+    metadata_cache = sm.cache
+    partition_results = []
+
+    row_hash_state = None
+    if args.row_hash_file:
+        row_hash_state = read_state_file(args.row_hash_file)
+    site_row_hashes = {} if row_hash_state==None else row_hash_state.get(watermark_key,{})
+
+    def collect_partition_result(future,sheet_name):
+        try:
+            partition_results.append(future.result())
+        except Exception as ex:
+            print(f"Failed to sync {sheet_name} Smartsheet: {ex}")
+            partition_results.append({'sheet_name': sheet_name, 'error': str(ex)})
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {}
+        partitions = iter_partitions(sql_chunks=itertools.chain([first_chunk],sql_chunks),
+                                     partition_by=partition_by,
+                                     out_file_name=args.out_file_name,
+                                     partition_sorted=args.partition_sorted)
+
+        for partition_key, data_df in partitions:
+
+            sheet_name = re.sub('/',' ',partition_key)
+
+            if args.partition_by:
+                sheet_name = re.sub('\s+','_',sheet_name)
+                data_df = data_df.fillna("None")
+
+            ## At most one partition per worker is held in memory, reading waits for a worker to finish
+            while len(futures)>=args.workers:
+                done_futures, _ = wait(futures,return_when=FIRST_COMPLETED)
+                for done_future in done_futures:
+                    collect_partition_result(done_future,futures.pop(done_future))
+
+            future = executor.submit(sync_partition_sheet,
+                                     smartsheet=ssa.smartsheet_api(creds['SMARTSHEET'],limiter=limiter,cache=metadata_cache,metrics=metrics),
+                                     sheet_name=sheet_name,
+                                     data_df=data_df,
+                                     sheet_dict=sheet_dict,
+                                     primary_key=primary_key,
+                                     sheet_template=sheet_template,
+                                     smartsheet_column_type=smartsheet_column_type,
+                                     delete_flag=delete_flag,
+                                     row_hash_state=None if row_hash_state==None else site_row_hashes.get(sheet_name,{}),
+                                     plan_only=args.plan_file!=None or journal!=None)
+            futures[future] = sheet_name
 
-        sheet_name = re.sub('/',' ',partition_key)
-        
-        if args.partition_by:
-            sheet_name = re.sub('\s+','_',sheet_name)
-            data_df = df_sql[df_sql[partition_by]==partition_key]
-            data_df = data_df.fillna("None")
-        else:
-            data_df = df_sql.copy()
-
-        is_new_sheet = 0
-
-        ## If sheet is not present in the folder
-        if sheet_name not in sheet_dict:
-            print(f"Creating new Smartsheet for {sheet_name}")
-            response = sm.create_sheet_in_folder(new_sheet_name=sheet_name,new_sheet_template=new_smartsheet_column)
-            is_new_sheet = 1
-
-        ## Get smartsheet id for the current sheet
-        print("Get Sheet ID for the current Smartsheet")
-        sheet_id = sm.get_sheet_by_name_in_folder(sheet_name=sheet_name)
-
-        print("Map Column Names To Column Id in current Smartsheet")
-        column_map = sm.get_column_name_id_map(sheet_id=sheet_id)
-
-        ## Get row ids for current data in smartsheet
-        if is_new_sheet == 0:
-            print("Get Row data From Smartsheet")
-            rows = sm.get_rows_from_sheet(sheet_id=sheet_id)
-            print("Check for existing data in Smartsheet")
-            current_smartsheet_df = pd.DataFrame()
-            current_smartsheet_df = save_rows_to_df(rows,column_map['id_to_name'],primary_key)
-            current_smartsheet_df = current_smartsheet_df.fillna("")
-            
-            ### Add new column in existing smartsheet
-            
-            if all(column in data_df.columns for column in current_smartsheet_df.columns)==False:
-                print("Add New Column to the Smartsheet")
-                for index, column in enumerate(data_df.columns):
-                    if column not in current_smartsheet_df.columns:
-                        column_type = smartsheet_column_type[column]
-                        response = sm.add_column_to_smartsheet(sheet_id=sheet_id, column_name=column, column_type=column_type, column_index=index)
-                        current_smartsheet_df[column] = ''
-                        print(f'{column} column added to the Smartsheet')
-
-                print("Re-Map Column Names To Column Id in current Smartsheet")
-                column_map = sm.get_column_name_id_map(sheet_id=sheet_id)
-
-            
-            if not current_smartsheet_df.empty:
-                print(f"Update Records in {sheet_name} Smartsheet")
-                updated_sheet = run_smartsheet_update_data(smartsheet=sm,
-                                                           sheet_id=sheet_id,
-                                                           old_data_df=current_smartsheet_df,
-                                                           new_data_df=data_df,
-                                                           column_map=column_map['name_to_id'],
-                                                           pk_field=primary_key,
-                                                           delete_flag=args.delete_closed
-                                                           )
-
-                ## Filter to add only new record
-                data_df = data_df[~data_df[primary_key].isin(current_smartsheet_df[primary_key].unique().tolist())]
-                
-
-        ## Add new data to smartsheets
-        print(f"Add New Records in {sheet_name} Smartsheet")
-        print(f"Adding {len(data_df)} new records")
-        updated_sheet = run_smartsheet_add_data(smartsheet=sm,
-                                                sheet_id=sheet_id,
-                                                new_data_df=data_df,
-                                                column_map=column_map['name_to_id'])
-        
-        #sys.exit(1)
-        
-
-    end_time = datetime.now()
-    print(f"Finished At {end_time}")
-    total_time = end_time - start_time
-    total_time_s = total_time.total_seconds()
-    total_time_h = divmod(total_time_s, 60)[0]
-    print(f"Completed in {total_time_h} minutes")
-    sys.exit(1)
+        dbcon.close()
+
+        for future in as_completed(futures):
+            collect_partition_result(future,futures[future])
+
+    ### Plan only, write the change set and leave the sync state as it is until it is applied.
+    ### With a journal the whole run is planned first, then applied batch by batch
+    if args.plan_file or journal!=None:
+        failed_results = [partition_result for partition_result in partition_results if 'error' in partition_result]
+        if len(failed_results)>0:
+            print(f"Planning failed for {len(failed_results)} partitions, no change set written")
+            sys.exit(metrics.finish(1))
+        change_set = {'watermark_key': watermark_key,
+                      'incremental': args.incremental,
+                      'is_full_run': is_full_run,
+                      'watermark': None if watermark==None or watermark['value'] is None else str(watermark['value']),
+                      'start_time': start_time.isoformat(),
+                      'sheets': sorted(partition_results,key=lambda sheet_change: sheet_change['sheet_name'])}
+        if journal!=None:
+            exit_code = apply_planned_change_set(change_set=change_set,ss_creds=creds['SMARTSHEET'],args=args,journal=journal,metrics=metrics)
+            sys.exit(metrics.finish(exit_code))
+        sscs.save_change_set(args.plan_file,change_set)
+        sscs.print_change_set_summary(change_set)
+        print(f"Change set written to {args.plan_file}")
+        sys.exit(metrics.finish(0))
+
+    print_sheet_results(partition_results)
+    save_sync_state(sheet_results=partition_results,
+                    watermark_key=watermark_key,
+                    row_hash_file=args.row_hash_file,
+                    watermark_file=args.watermark_file if args.incremental else None,
+                    watermark_value=None if watermark==None else watermark['value'],
+                    is_full_run=is_full_run,
+                    start_time=start_time)
+
+    sys.exit(metrics.finish(0 if all('error' not in partition_result for partition_result in partition_results) else 1))
 
 
 
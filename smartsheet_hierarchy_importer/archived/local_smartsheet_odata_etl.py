@@ -6,11 +6,15 @@ import pandas as pd
 import numpy as np
 import datetime
 import smartsheet_api as ssa
+import smartsheet_diff as ssd
+import etl_metrics as etm
 from pathlib import Path
 from datetime import timedelta
 from datetime import datetime
 from datetime import date
 from requests.auth import HTTPBasicAuth
+from urllib.parse import urljoin
+import xml.etree.ElementTree as ET
 import smartsheet
 import time
 import re
@@ -35,58 +39,118 @@ def read_sql_query(query_file,site_code,datasource):
 
     return(query_string)
 
-def connect_odata(creds_db):
+ODATA_NAMESPACES = {
+    'd': 'http://schemas.microsoft.com/ado/2007/08/dataservices',
+    'm': 'http://schemas.microsoft.com/ado/2007/08/dataservices/metadata',
+    'atom': 'http://www.w3.org/2005/Atom'
+}
 
+def connect_odata(**kwargs):
+    odata_url = kwargs['odata_url']
+    auth = kwargs['auth']
+    params = kwargs.get('params')
+    retry_count = 3
+    retry_delay = 5
+    response = None
+
+    while True:
+        try:
+            response = requests.get(odata_url, auth=auth, params=params, stream=True)
+            if response.status_code == 200:
+                response.raw.decode_content = True
+                return(response)
+            print(f'Failed to fetch data. Status code: {response.status_code}')
+        except Exception as e:
+            print(e)
+
+        if retry_count == 0:
+            return(response)
+        print(f"Retrying Connection with ODATA Feed")
+        retry_count -= 1
+        time.sleep(retry_delay)
+
+def parse_xml_page(xml_stream):
+    ## Stream one Atom page, returning its entry properties as records and the next page link if any
+    atom_link = '{'+ODATA_NAMESPACES['atom']+'}link'
+    atom_entry = '{'+ODATA_NAMESPACES['atom']+'}entry'
+    m_properties = '{'+ODATA_NAMESPACES['m']+'}properties'
+    m_null = '{'+ODATA_NAMESPACES['m']+'}null'
+    records = []
+    next_link = None
+
+    for event, element in ET.iterparse(xml_stream, events=('end',)):
+        if element.tag == m_properties:
+            record = {}
+            for field in element:
+                field_name = field.tag.split('}')[-1]
+                record[field_name] = None if field.get(m_null) == 'true' else field.text
+            records.append(record)
+        elif element.tag == atom_entry:
+            element.clear()
+        elif element.tag == atom_link and element.get('rel') == 'next':
+            next_link = element.get('href')
+
+    return(records,next_link)
+
+def read_odata_pages(creds_db,metrics,page_size=None):
+    ## Yield the feed as dataframe chunks, one per page. Server driven paging (next links) is always
+    ## followed, with a page_size the feed is also requested page by page using $top/$skip.
+    ## The time to fetch and parse each page is observed in odata_page_seconds
     odata_url = creds_db['odata_url']
-    username = creds_db['username']
-    password = creds_db['password']
-
-    try:
-        response = requests.get(odata_url, auth=HTTPBasicAuth(username, password))
-    except Exception as e:
-        print(e)
-    return(response)
-
-def parse_xml_response(response,primary_key):
-    if response.status_code == 200:
-        xml_data = response.content
-    
-        ns = {
-                'd': 'http://schemas.microsoft.com/ado/2007/08/dataservices',
-                'm': 'http://schemas.microsoft.com/ado/2007/08/dataservices/metadata',
-                'atom': 'http://www.w3.org/2005/Atom'
-            }
-        
-        df_xml = pd.read_xml(xml_data,xpath='.//atom:entry/atom:content/m:properties', namespaces=ns)
-        df_xml.rename(columns=lambda x: x.replace('-', ''), inplace=True)
-        df_xml.rename(columns=lambda x: re.sub('_x.{4}_','_',x), inplace=True)
-        df_xml.replace({np.nan: "None"}, inplace=True)
-        # Deduplicate on all columns except primary key
-        dedup_columns = df_xml.drop(columns=primary_key).columns.tolist()
-        df_xml = df_xml.drop_duplicates(subset=dedup_columns)
+    auth = HTTPBasicAuth(creds_db['username'], creds_db['password'])
+    params = None
+    if page_size!=None:
+        params = {'$top': page_size, '$skip': 0}
+
+    page_number = 0
+    while odata_url!=None:
+        with metrics.timer('odata_page_seconds'):
+            response = connect_odata(odata_url=odata_url, auth=auth, params=params)
+            if response==None or response.status_code != 200:
+                raise RuntimeError(f'Unable to read ODATA page {page_number+1} from {odata_url}')
+
+            records, next_link = parse_xml_page(response.raw)
+            response.close()
+        page_number += 1
+        print(f"Read ODATA page {page_number} with {len(records)} records")
+        metrics.increment('odata_records_read',len(records))
+
+        if len(records)>0:
+            yield pd.DataFrame.from_records(records)
+
+        if next_link!=None:
+            odata_url = urljoin(odata_url, next_link)
+            params = None
+        elif params!=None and len(records)==page_size:
+            params['$skip'] += page_size
+        else:
+            odata_url = None
+
+def parse_xml_response(page_chunks,primary_key):
+    if len(page_chunks)==0:
+        return(pd.DataFrame())
+    df_xml = pd.concat(page_chunks, ignore_index=True)
+    ## Same numeric typing pd.read_xml used to apply to the whole document
+    for column in df_xml.columns:
+        try:
+            df_xml[column] = pd.to_numeric(df_xml[column])
+        except (ValueError, TypeError):
+            pass
+    df_xml.rename(columns=lambda x: x.replace('-', ''), inplace=True)
+    df_xml.rename(columns=lambda x: re.sub('_x.{4}_','_',x), inplace=True)
+    df_xml.replace({np.nan: "None"}, inplace=True)
+    # Deduplicate on all columns except primary key
+    dedup_columns = df_xml.drop(columns=primary_key).columns.tolist()
+    df_xml = df_xml.drop_duplicates(subset=dedup_columns)
 
-    else:
-        print(f'Failed to fetch data. Status code: {response.status_code}')
-    
     return(df_xml)
 
-def save_rows_to_df(rows,column_map_idtoname,primary_key):
-    data = []
-    qr_id = None
-    parent_row_id = None
-
-    for row in rows:
-        row_dict = {}
-        row_dict["Smartsheet_Row_Id"] = row.id
-        for cell in row.cells:
-            row_dict[column_map_idtoname[cell.column_id]] = cell.value
-        data.append(row_dict)
-
+def sheet_frame_to_df(sheet_df,primary_key):
+    ## Sheet rows read with get_rows_frame, typed as strings for the comparison with the source data
     df = pd.DataFrame()
-    if len(data)>0:
-        df = pd.DataFrame(data)
-        df = df.astype(str)
-        df["Smartsheet_Row_Id"] = df["Smartsheet_Row_Id"].astype(int)
+    if len(sheet_df)>0:
+        df = sheet_df.drop(columns=["Smartsheet_Parent_Id"]).astype(str)
+        df["Smartsheet_Row_Id"] = sheet_df["Smartsheet_Row_Id"]
         df[primary_key] = df[primary_key].replace('\.0$','',regex=True)
 
     return(df)
@@ -99,65 +163,29 @@ def run_smartsheet_update_data(**kwargs):
     column_map = kwargs['column_map']
     pk_field = kwargs['pk_field']
     delete_flag = kwargs['delete_flag']
-    updated_records = {}
-    update_row_cells = []
-    delete_row_id = []
     update_sheet = None
-    
-    column_map = {key: value for key, value in column_map.items() if key in new_data_df.columns}
-
-    for index, sm_row in old_data_df.iterrows():
 
-        pk_id = sm_row[pk_field]    
-        row_id = sm_row['Smartsheet_Row_Id']
-
-        ### Delete Records if Flag is True and PK ID from old record is no longer present in new record dataframe
-        if delete_flag==True:
-            if not pk_id in new_data_df[pk_field].values:
-                delete_row_id.append(row_id)
-                continue
-
-        for column_name in column_map:
-            if column_name == pk_field:
-                continue
-            
-            # print(new_data_df)
-            # print(pk_field)
-            # print(pk_id)
-            # print(column_name)
-            # print(new_data_df[new_data_df[pk_field]==1])
-            new_col_val = str(new_data_df[new_data_df[pk_field]==int(pk_id)][column_name].values[0])
-            sm_col_val = str(sm_row[column_name])
-
-            date_pattern= re.compile(r'^\d{4}-\d{2}-\d{2}$')
-            numeric_pattern = re.compile(r'\.0$')
-
-            if date_pattern.search(sm_col_val):
-                sm_col_val = datetime.strptime(sm_col_val,'%Y-%m-%d').strftime('%m/%d/%Y')
-            elif numeric_pattern.search(sm_col_val):
-                sm_col_val = sm_col_val.replace('.0','')
-            elif numeric_pattern.search(new_col_val):
-                new_col_val = new_col_val.replace('.0','')
-                
-            if sm_col_val != new_col_val:
-                updated_records[pk_id] = 1
-                update_row_cells.extend([
-                        {   'row_id': row_id,
-                            'column_id': column_map[column_name],
-                            'value': new_col_val,
-                            'strict': False
-                        }
-                    ])
+    with sm.metrics.phase('diff'):
+        sheet_diff = ssd.diff_sheet_data(old_data_df=old_data_df,
+                                         new_data_df=new_data_df,
+                                         column_map=column_map,
+                                         pk_field=pk_field,
+                                         delete_flag=delete_flag)
+    update_row_cells = sheet_diff['update_row_cells']
+    delete_row_id = sheet_diff['delete_row_ids']
+    updated_records = sheet_diff['updated_keys']
 
     ### Update Records
     if len(update_row_cells)>0:
-        update_sheet = sm.update_smartsheet_cell(sheet_id=sheet_id,
-                                                 update_row_cells=update_row_cells)
+        with sm.metrics.phase('update'):
+            update_sheet = sm.update_smartsheet_cell(sheet_id=sheet_id,
+                                                     update_row_cells=update_row_cells)
                                                  
         print(f'{len(updated_records)} records updated in smartsheet')
 
     if len(delete_row_id)>0:
-        update_sheet = sm.delete_rows_from_sheet(sheet_id=sheet_id,row_ids=delete_row_id)
+        with sm.metrics.phase('delete'):
+            update_sheet = sm.delete_rows_from_sheet(sheet_id=sheet_id,row_ids=delete_row_id)
     
         print(f'{len(delete_row_id)} records deleted in smartsheet')
 
@@ -169,28 +197,17 @@ def run_smartsheet_add_data(**kwargs):
     sheet_id = kwargs['sheet_id']
     new_data_df = kwargs['new_data_df']
     column_map = kwargs['column_map']
-    update_sheet = None
+    new_row_ids = []
 
-    column_map = {key: value for key, value in column_map.items() if key in new_data_df.columns}
-    
-    for index, row in new_data_df.iterrows():
-        sm_row_cells = []
-        for column_name in column_map:
-            sm_cell_model = {
-                'column_id': column_map[column_name],
-                'value': row[column_name],
-                'strict': False
-            }
-            sm_row_cells.append(sm_cell_model)  
-
-        ## Add parent rows
-        update_sheet = sm.add_row_into_sheet(sheet_id=sheet_id,
-                                             parent_row_id=None,
-                                             add_cells=sm_row_cells,
-                                             to_bottom=True,
-                                             add_predecessor=False)
+    ## Add parent rows in bulk
+    if len(new_data_df)>0:
+        with sm.metrics.phase('add'):
+            new_row_ids = sm.add_rows(sheet_id=sheet_id,
+                                      new_data_df=new_data_df,
+                                      column_map=column_map,
+                                      to_bottom=True)
 
-    return(update_sheet)
+    return(new_row_ids)
 
 
 
@@ -205,6 +222,9 @@ if __name__ == "__main__":
     parser.add_argument("--primary_key", required=True, help="Name of the primary key field in the sql data")
     parser.add_argument("--delete_closed", action="store_true", help="If true, delete closed records from Smartsheet")
     parser.add_argument("--out_file_name", help="Name of the output file for storing data")
+    parser.add_argument("--page_size", required=False, type=int, default=None, help="Request the ODATA feed in pages of this many records using $top/$skip")
+    parser.add_argument("--metrics_log", required=False, default=None, help="Append phase timings, API counters and page latencies to this file as JSON lines")
+    parser.add_argument("--prometheus_file", required=False, default=None, help="Write the run metrics to this Prometheus textfile when the run ends")
     args = parser.parse_args()
     
     site_code = args.site_code.upper()
@@ -212,25 +232,28 @@ if __name__ == "__main__":
 
     start_time = datetime.now()
     print(f"Started At {start_time}")
+    metrics = etm.run_metrics(job='local_smartsheet_odata_etl',
+                              labels={'site': site_code, 'odata': args.odata_name},
+                              log_file=args.metrics_log,
+                              prometheus_file=args.prometheus_file)
 
     ### Read SQL Credentials
     print("Read Credentials")
     creds = read_credentials(args.credential)
 
-    retry_count = 3
-    retry_delay = 5
-
-    response = ''
-
-    ## Connect to Odata and read data
-    while not response and retry_count > 0:
-        print(f"Establishing Connection with ODATA Feed")
-        time.sleep(retry_delay)
-        response = connect_odata(creds[args.odata_connection])
-        retry_count -= 1
+    ## Connect to Odata and read data page by page
+    print(f"Establishing Connection with ODATA Feed")
+    with metrics.phase('extract'):
+        page_chunks = list(read_odata_pages(creds[args.odata_connection], metrics, page_size=args.page_size))
 
     ## Parse Odata Response
-    df_data = parse_xml_response(response,primary_key)
+    with metrics.phase('normalize'):
+        data_df = parse_xml_response(page_chunks,primary_key)
+
+    ## An empty feed has no columns to build or compare sheets with, and must not delete every row
+    if data_df.empty:
+        print("No records read from the ODATA feed, nothing to sync")
+        sys.exit(metrics.finish(0))
     
     ## Build Column Template for Smartsheet
     print("Get Smartsheet Template")
@@ -238,13 +261,13 @@ if __name__ == "__main__":
     smartsheet_column_type = {}
     set_primary_column=1
 
-    for column in df_data.columns:
-        if df_data[column].dtype.name =='datetime64[ns]':
+    for column in data_df.columns:
+        if data_df[column].dtype.name =='datetime64[ns]':
             new_smartsheet_column.append(smartsheet.models.Column({
                 'title': column,
                 'type': 'DATE'
             }))
-            df_data[column] = df_data[column].dt.strftime('%m/%d/%Y')
+            data_df[column] = data_df[column].dt.strftime('%m/%d/%Y')
             smartsheet_column_type[column] = 'DATE'
         else:
             if set_primary_column==1:
@@ -264,7 +287,7 @@ if __name__ == "__main__":
 
     ### Smartsheet API
     print("Initialize Smartsheet API")
-    sm = ssa.smartsheet_api(creds['SMARTSHEET'])
+    sm = ssa.smartsheet_api(creds['SMARTSHEET'],metrics=metrics)
 
     ### Get list of value for split field
     ### Data will be split into different files based on this field values
@@ -300,12 +323,14 @@ if __name__ == "__main__":
 
         ## Get row ids for current data in smartsheet
         if is_new_sheet == 0:
-            print("Get Row data From Smartsheet")
-            rows = sm.get_rows_from_sheet(sheet_id=sheet_id)
-            print("Check for existing data in Smartsheet")
-            current_smartsheet_df = pd.DataFrame()
-            current_smartsheet_df = save_rows_to_df(rows,column_map['id_to_name'],primary_key)
-            current_smartsheet_df = current_smartsheet_df.fillna("")
+            with metrics.phase('read_sheet',sheet_name=sheet_name):
+                print("Get Row data From Smartsheet")
+                ## Only the columns present in the source data are compared, the rest are not downloaded
+                compare_column_ids = [column_map['name_to_id'][column] for column in data_df.columns if column in column_map['name_to_id']]
+                sheet_df = sm.get_rows_frame(sheet_id=sheet_id,column_ids=compare_column_ids)
+                print("Check for existing data in Smartsheet")
+                current_smartsheet_df = sheet_frame_to_df(sheet_df,primary_key)
+                current_smartsheet_df = current_smartsheet_df.fillna("")
             
             ### Add new column in existing smartsheet
             
@@ -347,13 +372,7 @@ if __name__ == "__main__":
         #sys.exit(1)
         
 
-    end_time = datetime.now()
-    print(f"Finished At {end_time}")
-    total_time = end_time - start_time
-    total_time_s = total_time.total_seconds()
-    total_time_h = divmod(total_time_s, 60)[0]
-    print(f"Completed in {total_time_h} minutes")
-    sys.exit(1)
+    sys.exit(metrics.finish(0))
 
 
 
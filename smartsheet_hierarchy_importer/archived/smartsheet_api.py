@@ -1,15 +1,156 @@
 import smartsheet
 import time
-import sys
+import threading
+import random
+import json
+import email.utils
+import numpy as np
+import pandas as pd
 from smartsheet.models import Contact
 import requests
+from urllib3.util import Retry
+import smartsheet_mirror as ssm
+import smartsheet_cache as ssc
+import etl_metrics as etm
+from datetime import datetime, timedelta, timezone
+
+## Smartsheet accepts at most this many rows in a single add/update request
+MAX_ROWS_PER_REQUEST = 500
+## Row ids are sent in the query string on delete, so keep batches small enough for the URL
+MAX_ROWS_PER_DELETE = 400
+## Smartsheet request budget per API token
+DEFAULT_REQUESTS_PER_MINUTE = 300
+MAX_RETRY_ATTEMPTS = 6
+BASE_RETRY_DELAY = 2
+MAX_RETRY_DELAY = 60
+SYNC_CLOCK_SKEW_MINUTES = 5
+## Writes that create something. When one of them times out or gets a 5xx it may still have been
+## applied, so it is not sent again
+NON_IDEMPOTENT_ENDPOINTS = frozenset(['add_rows','add_columns','create_sheet_in_folder'])
+## Seconds to wait for a sheet download on the raw read path
+RAW_READ_TIMEOUT = 300
+
+## orjson decodes large sheets several times faster, the standard library is used when it is not installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+class SmartsheetApiError(Exception):
+
+    def __init__(self,message,status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+class SmartsheetRetryError(SmartsheetApiError):
+    pass
+
+def parse_retry_after(retry_after):
+    ## Retry-After is either a number of seconds or an HTTP-date, None when it is neither
+    try:
+        return(max(0.0, float(retry_after)))
+    except (TypeError, ValueError):
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return(None)
+    if retry_at.tzinfo==None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return(max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds()))
+
+class rate_limiter:
+    ## Token bucket shared by every smartsheet_api instance using the same API token
+
+    def __init__(self,requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE,burst=10):
+        self.rate = requests_per_minute/60.0
+        self.capacity = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def pause(self,seconds):
+        ## Stop handing out requests for a while, e.g. after a 429 with Retry-After
+        with self.lock:
+            self.tokens = 0
+            self.updated_at = max(self.updated_at, time.monotonic() + seconds)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now > self.updated_at:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated_at)*self.rate)
+                    self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = max(0, self.updated_at - now) + (1 - self.tokens)/self.rate
+            time.sleep(wait_time)
+
+def build_sheet_frame(column_titles,rows):
+    ## Columnar DataFrame of sheet rows in one pass over the API JSON: every cell value goes straight
+    ## into a preallocated array of its column, found by column id. column_titles maps column id to
+    ## title in sheet order, rows are JSON rows (id, parentId, cells with columnId and value).
+    ## Dtypes are inferred the way pd.DataFrame does for a list of row dicts
+    row_count = len(rows)
+    column_positions = {column_id: position for position, column_id in enumerate(column_titles)}
+    column_values = [np.full(row_count,None,dtype=object) for _ in column_titles]
+    row_ids = np.empty(row_count,dtype='int64')
+    parent_ids = np.full(row_count,None,dtype=object)
+
+    for row_index, row in enumerate(rows):
+        row_ids[row_index] = row['id']
+        parent_ids[row_index] = row.get('parentId')
+        for cell in row.get('cells',()):
+            position = column_positions.get(cell['columnId'])
+            if position!=None:
+                column_values[position][row_index] = cell.get('value')
+
+    frame = pd.DataFrame(dict(zip(column_titles.values(),column_values))).infer_objects()
+    frame.insert(0,'Smartsheet_Row_Id',row_ids)
+    ## Nullable integers, row ids do not fit in a float
+    frame.insert(1,'Smartsheet_Parent_Id',pd.array(parent_ids,dtype='Int64'))
+    return(frame)
+
+def build_rows_frame(column_titles,rows):
+    ## build_sheet_frame for SDK Row objects, e.g. rows read from the mirror
+    return(build_sheet_frame(column_titles,[{'id': row.id,
+                                             'parentId': row.parent_id,
+                                             'cells': [{'columnId': cell.column_id, 'value': cell.value} for cell in row.cells]}
+                                            for row in rows]))
+
 
 class smartsheet_api:
 
-    def __init__(self,ss_creds):
+    def __init__(self,ss_creds,limiter=None,mirror=None,cache=None,metrics=None):
 
         self.api_token = ss_creds['api_token']
-        self.ss_client = smartsheet.Smartsheet(self.api_token)
+        ## The SDK's own retries are turned off, retry() is the only retry layer so throttling pauses the
+        ## shared limiter straight away and ambiguous add failures are never sent again
+        self.ss_client = smartsheet.Smartsheet(self.api_token,max_retry_time=0)
+        ## Its HTTP adapter would also send a POST again after a read error
+        for http_adapter in self.ss_client._session.adapters.values():
+            http_adapter.max_retries = Retry(total=0,read=False)
+        ## Pooled connection for the raw JSON read path, which bypasses the SDK models
+        self.api_base = ss_creds.get('api_base',smartsheet.__api_base__)
+        self.http_session = requests.Session()
+        self.limiter = limiter
+        if self.limiter==None:
+            self.limiter = rate_limiter(ss_creds.get('requests_per_minute',DEFAULT_REQUESTS_PER_MINUTE))
+        ## Optional local copy of sheet state, see smartsheet_mirror
+        self.mirror = mirror
+        if self.mirror==None and 'mirror_file' in ss_creds:
+            self.mirror = ssm.sheet_mirror(ss_creds['mirror_file'])
+        ## Folder index and column maps, pass the same cache to every instance of a run to share it
+        self.cache = cache
+        if self.cache==None:
+            self.cache = ssc.metadata_cache()
+        ## API call, retry and row counters, pass the run's metrics to every instance to report them
+        self.metrics = metrics
+        if self.metrics==None:
+            self.metrics = etm.run_metrics()
         self.folder_id = None
         self.sheet_id = None
         self.sheet_name = None
@@ -21,45 +162,82 @@ class smartsheet_api:
         if 'sheet_name' in ss_creds:
             self.sheet_name = ss_creds['sheet_name']
 
+    def call_api(self,func,*args,**kwargs):
+        if len(args)>0 and len(kwargs)==0:
+            response = func(*args)
+        elif len(kwargs)>0 and len(args)==0:
+            response = func(**kwargs)
+        elif len(args)>0 and len(kwargs)>0:
+            response = func(*args)
+        else:
+            response = func()
+        return(response)
+
     def retry(self,func,*args,**kwargs):
-        retry_count = 1
-        retry_delay = 5
+        ## Call the API through the shared rate limiter. Throttled (429), server side (5xx) and
+        ## connection errors are retried with exponential backoff and jitter, honouring Retry-After.
+        ## Other errors raise SmartsheetApiError, exhausted retries raise SmartsheetRetryError.
+        ## Only throttled requests are retried for NON_IDEMPOTENT_ENDPOINTS, a 5xx or connection error
+        ## there raises SmartsheetApiError straight away as the write may have gone through.
+        attempt = 1
+        endpoint = getattr(func,'__name__','unknown')
 
         while True:
+            self.limiter.acquire()
+            self.metrics.increment('api_calls',endpoint=endpoint)
+            retry_after = None
+            throttled = False
             try:
-                if len(args)>0 and len(kwargs)==0:
-                    response = func(*args)
-                    if response.request_response.status_code == requests.codes.ok:
-                        return(response)
-                elif len(kwargs)>0 and len(args)==0:
-                    response = func(**kwargs)
-                    if response.request_response.status_code == requests.codes.ok:
-                        return(response)
-                elif len(args)>0 and len(kwargs)>0:
-                    response = func(*args)
-                    if response.request_response.status_code == requests.codes.ok:
-                        return(response)
-                else:
-                    response = func()
-                    if response.request_response.status_code == requests.codes.ok:
-                        return(response)
+                response = self.call_api(func,*args,**kwargs)
             except Exception as ex:
-                if retry_count <= 5:
-                    print(f"Failed Attempt {retry_count}/5")
-                    retry_count += 1
-                    time.sleep(retry_delay)
-                    continue
+                last_error = ex
+            else:
+                request_response = getattr(response,'request_response',None)
+                if isinstance(response,smartsheet.models.Error):
+                    ## The SDK Error model drops the HTTP response, its status is kept in the error result
+                    status_code = response.result.status_code
+                    response_headers = {} if request_response==None else request_response.headers
+                elif request_response==None:
+                    self.metrics.increment('api_failures',endpoint=endpoint)
+                    raise SmartsheetApiError(f"Smartsheet {endpoint} returned no response status")
                 else:
-                    print(f"Maximum attempts reached, exiting program due to an error {ex}")
-                    ## Remove Parent and Child deviation record if error occurs during adding new data row.
-                    if 'parent_row_id' in  kwargs:
-                        parent_row_id = kwargs['parent_row_id']
-                        sheet_id = args[0]
-                        if not parent_row_id == None:
-                            print("Rolling back due to error - Removing incomplete deviation task")
-                            self.retry(self.delete_rows_from_sheet,sheet_id=sheet_id,row_ids=[parent_row_id])
-                    sys.exit(1)
-            break
+                    status_code = request_response.status_code
+                    response_headers = request_response.headers
+                if 200 <= status_code < 300:
+                    return(response)
+
+                last_error = SmartsheetApiError(f"Smartsheet request failed with status {status_code}",status_code=status_code)
+                if status_code == requests.codes.too_many_requests:
+                    self.metrics.increment('api_throttled',endpoint=endpoint)
+                    throttled = True
+                    retry_after = parse_retry_after(response_headers.get('Retry-After'))
+                elif status_code < 500:
+                    raise last_error
+
+            if not throttled and endpoint in NON_IDEMPOTENT_ENDPOINTS:
+                print(f"Smartsheet {endpoint} failed and may have been applied, not retrying: {last_error}")
+                self.metrics.increment('api_failures',endpoint=endpoint)
+                raise SmartsheetApiError(f"Smartsheet {endpoint} failed and may have been applied: {last_error}",
+                                         status_code=getattr(last_error,'status_code',None)) from last_error
+
+            if attempt >= MAX_RETRY_ATTEMPTS:
+                break
+
+            retry_delay = min(MAX_RETRY_DELAY, BASE_RETRY_DELAY*(2**(attempt-1)))
+            retry_delay = random.uniform(retry_delay/2, retry_delay)
+            if retry_after!=None:
+                ## Throttled, every client sharing the token waits before the next request
+                retry_delay = max(retry_delay, retry_after)
+                self.limiter.pause(retry_delay)
+
+            print(f"Failed Attempt {attempt}/{MAX_RETRY_ATTEMPTS}, retrying in {retry_delay:.1f}s: {last_error}")
+            self.metrics.increment('api_retries',endpoint=endpoint)
+            attempt += 1
+            time.sleep(retry_delay)
+
+        print(f"Maximum attempts reached due to an error {last_error}")
+        self.metrics.increment('api_failures',endpoint=endpoint)
+        raise SmartsheetRetryError(f"Maximum attempts reached due to an error {last_error}") from last_error
 
     def create_sheet_in_folder(self,**kwargs):
         smartsheet_folder = self.folder_id
@@ -72,6 +250,7 @@ class smartsheet_api:
         })
 
         ss_sheet = self.retry(self.ss_client.Folders.create_sheet_in_folder,smartsheet_folder, new_sheet)
+        self.cache.add_folder_sheet(smartsheet_folder,ss_sheet.result.name,ss_sheet.result.id)
 
         return(ss_sheet)
 
@@ -88,6 +267,9 @@ class smartsheet_api:
         })
 
         ss_sheet = self.retry(self.ss_client.Sheets.add_columns,self.sheet_id, new_column)
+        if self.mirror!=None:
+            self.mirror.invalidate(self.sheet_id)
+        self.cache.invalidate(self.sheet_id)
 
         return(ss_sheet)
 
@@ -99,10 +281,11 @@ class smartsheet_api:
         else:
             sheet_name = kwargs['sheet_name']
 
-        folder = self.retry(self.ss_client.Folders.get_folder,smartsheet_folder)
-        for sheet in folder.sheets:
-            if sheet.name == sheet_name:
-                return(sheet.id)
+        ## The folder listing is only downloaded again when the sheet is not in the cached index
+        sheet_dict = self.cache.get_folder_sheets(smartsheet_folder)
+        if sheet_dict==None or sheet_name not in sheet_dict:
+            sheet_dict = self.get_all_sheets_in_folder()
+        return(sheet_dict.get(sheet_name))
 
     def get_all_sheets_in_folder(self):
         smartsheet_folder = self.folder_id
@@ -112,86 +295,343 @@ class smartsheet_api:
         for sheet in folder.sheets:
             sheet_dict[sheet.name] = sheet.id
 
+        self.cache.set_folder_sheets(smartsheet_folder,sheet_dict)
         return(sheet_dict)
 
     def get_column_name_id_map(self,**kwargs):
 
         self.sheet_id = kwargs['sheet_id']
-        sheet = self.retry(self.ss_client.Sheets.get_sheet,self.sheet_id)
+        columns = self.cache.get_columns(self.sheet_id)
+
+        if columns==None:
+            ## Only the column definitions are requested, not the sheet data
+            response = self.retry(self.ss_client.Sheets.get_columns,sheet_id=self.sheet_id,include_all=True)
+            columns = [{'id': column.id, 'title': column.title, 'type': str(column.type), 'index': column.index} for column in response.data]
+            self.cache.set_columns(self.sheet_id,columns)
+            if self.mirror!=None:
+                self.mirror.save_columns(self.sheet_id,columns)
 
         column_map= {}
         column_map_name_to_id = {}
         column_map_id_to_name = {}
+        column_map_name_to_type = {}
 
-        for column in sheet.columns:
-            column_map_name_to_id[column.title] = column.id
-            column_map_id_to_name[column.id] = column.title
+        for column in columns:
+            column_map_name_to_id[column['title']] = column['id']
+            column_map_id_to_name[column['id']] = column['title']
+            column_map_name_to_type[column['title']] = column['type']
         column_map['name_to_id'] = column_map_name_to_id
         column_map['id_to_name'] = column_map_id_to_name
+        column_map['name_to_type'] = column_map_name_to_type
 
         return(column_map)
     
     def get_rows_from_sheet(self,**kwargs):
+        ## With a mirror only the rows changed since the last sync are downloaded, without one
+        ## column_ids can restrict the download to the columns the caller compares
         self.sheet_id = kwargs['sheet_id']
-        sheet = self.retry(self.ss_client.Sheets.get_sheet,self.sheet_id)
+        if self.mirror!=None:
+            return(self.get_rows_from_mirror(sheet_id=self.sheet_id))
+        if kwargs.get('column_ids')!=None:
+            sheet = self.get_sheet_filtered(sheet_id=self.sheet_id,column_ids=kwargs['column_ids'])
+        else:
+            sheet = self.get_sheet(sheet_id=self.sheet_id)
         return(sheet.rows)
+
+    def get_rows_frame(self,**kwargs):
+        ## The rows get_rows_from_sheet returns, as a DataFrame with Smartsheet_Row_Id, Smartsheet_Parent_Id
+        ## and one column per sheet column. Without a mirror the sheet JSON is read directly
+        self.sheet_id = kwargs['sheet_id']
+        if self.mirror==None:
+            return(self.get_sheet_frame(sheet_id=self.sheet_id,column_ids=kwargs.get('column_ids')))
+
+        rows = self.get_rows_from_mirror(sheet_id=self.sheet_id)
+        column_titles = self.get_column_name_id_map(sheet_id=self.sheet_id)['id_to_name']
+        return(build_rows_frame(column_titles,rows))
+
+    def get_sheet_frame(self,**kwargs):
+        ## Raw read path, the sheet JSON is decoded once and turned into columns without creating SDK
+        ## Row and Cell objects. Takes the same filters as get_sheet_filtered
+        self.sheet_id = kwargs['sheet_id']
+        query_params = {}
+        if kwargs.get('rows_modified_since')!=None:
+            query_params['rowsModifiedSince'] = kwargs['rows_modified_since']
+        if kwargs.get('column_ids')!=None:
+            query_params['columnIds'] = ','.join(str(column_id) for column_id in kwargs['column_ids'])
+        if kwargs.get('row_ids')!=None:
+            query_params['rowIds'] = ','.join(str(row_id) for row_id in kwargs['row_ids'])
+
+        response = self.retry(self.get_json,f"sheets/{self.sheet_id}",query_params)
+        sheet_json = json_loads(response.content)
+        column_titles = {column['id']: column['title'] for column in sheet_json.get('columns',[])}
+        return(build_sheet_frame(column_titles,sheet_json.get('rows',[])))
+
+    def get_json(self,path,query_params=None):
+        ## Plain GET on the REST API, the body is left undecoded. The response is its own
+        ## request_response, so retry() handles its status code and Retry-After header
+        response = self.http_session.get(f"{self.api_base}/{path}",
+                                         params=query_params,
+                                         headers={'Authorization': f"Bearer {self.api_token}"},
+                                         timeout=RAW_READ_TIMEOUT)
+        response.request_response = response
+        return(response)
+
+    def get_rows_from_mirror(self,**kwargs):
+        sheet_id = kwargs['sheet_id']
+        mirror_version, synced_at = self.mirror.get_sync_state(sheet_id)
+
+        if self.mirror_is_current(sheet_id):
+            print(f"Sheet {sheet_id} unchanged since last sync, reading rows from local mirror")
+        elif synced_at==None:
+            sheet = self.get_sheet(sheet_id=sheet_id)
+            return(sheet.rows)
+        else:
+            print(f"Reading rows of sheet {sheet_id} modified since {synced_at}")
+            sync_started_at = self.sync_timestamp()
+            delta_sheet = self.get_sheet_filtered(sheet_id=sheet_id,rows_modified_since=synced_at)
+            self.mirror.merge_rows(sheet_id=sheet_id,
+                                   rows=[self.row_to_mirror(row) for row in delta_sheet.rows],
+                                   version=delta_sheet.version,
+                                   synced_at=sync_started_at)
+
+            ## Deleted rows do not show up as modified, the row count tells whether any are gone
+            if self.mirror.row_count(sheet_id)!=delta_sheet.total_row_count:
+                primary_column_id = self.mirror.load_columns(sheet_id)[0]['id']
+                id_sheet = self.get_sheet_filtered(sheet_id=sheet_id,column_ids=[primary_column_id])
+                self.mirror.prune_rows(sheet_id,[row.id for row in id_sheet.rows])
+
+        return(self.mirror_to_rows(self.mirror.load_rows(sheet_id),self.mirror.load_columns(sheet_id)))
+
+    def get_sheet_filtered(self,**kwargs):
+        ## Partial sheet read, rows_modified_since (ISO 8601 UTC), column_ids and row_ids are passed
+        ## through to the API so only the requested rows and cells are downloaded
+        self.sheet_id = kwargs['sheet_id']
+        query_params = {'sheet_id': self.sheet_id}
+        if kwargs.get('rows_modified_since')!=None:
+            query_params['rows_modified_since'] = kwargs['rows_modified_since']
+        if kwargs.get('column_ids')!=None:
+            query_params['column_ids'] = ','.join(str(column_id) for column_id in kwargs['column_ids'])
+        if kwargs.get('row_ids')!=None:
+            query_params['row_ids'] = ','.join(str(row_id) for row_id in kwargs['row_ids'])
+
+        sheet = self.retry(self.ss_client.Sheets.get_sheet,**query_params)
+        return(sheet)
+
+    def sync_timestamp(self):
+        ## Taken before a read and stepped back a little to cover clock skew with the server
+        return((datetime.now(timezone.utc) - timedelta(minutes=SYNC_CLOCK_SKEW_MINUTES)).strftime('%Y-%m-%dT%H:%M:%SZ'))
     
-    def delete_rows_from_sheet(self,**kwargs):
+    def get_sheet(self,**kwargs):
         self.sheet_id = kwargs['sheet_id']
-        row_ids = kwargs['row_ids']
-        self.retry(self.ss_client.Sheets.delete_rows,self.sheet_id,row_ids)
+        sync_started_at = self.sync_timestamp()
         sheet = self.retry(self.ss_client.Sheets.get_sheet,self.sheet_id)
+        if self.mirror!=None:
+            self.mirror.save_sheet(sheet_id=self.sheet_id,
+                                   version=sheet.version,
+                                   modified_at=str(sheet.modified_at),
+                                   synced_at=sync_started_at,
+                                   columns=[{'id': column.id, 'title': column.title, 'type': str(column.type), 'index': column.index} for column in sheet.columns],
+                                   rows=[self.row_to_mirror(row) for row in sheet.rows])
         return(sheet)
 
+    def get_sheet_version(self,**kwargs):
+        self.sheet_id = kwargs['sheet_id']
+        response = self.retry(self.ss_client.Sheets.get_sheet_version,self.sheet_id)
+        return(response.version)
+
+    def mirror_is_current(self,sheet_id):
+        ## Cheap version check, only the sheet version is requested from the API
+        if self.mirror==None or self.mirror.get_version(sheet_id)==None:
+            return(False)
+        return(self.mirror.is_current(sheet_id,self.get_sheet_version(sheet_id=sheet_id)))
+
+    def row_to_mirror(self,row):
+        return({'id': row.id,
+                'parent_id': row.parent_id,
+                'cells': {cell.column_id: cell.value for cell in row.cells}})
+
+    def mirror_to_rows(self,mirror_rows,mirror_columns):
+        ## Same shape as a sheet download, one cell per column in column order
+        rows = []
+        for mirror_row in mirror_rows:
+            rows.append(smartsheet.models.Row({
+                'id': mirror_row['id'],
+                'parentId': mirror_row['parent_id'],
+                'cells': [{'columnId': column['id'], 'value': mirror_row['cells'].get(column['id'])} for column in mirror_columns]
+            }))
+        return(rows)
+
+    def mirror_write(self,**kwargs):
+        if self.mirror==None:
+            return
+        response = kwargs['response']
+        self.mirror.apply_write(sheet_id=kwargs['sheet_id'],
+                                version=getattr(response,'version',None),
+                                added_rows=[self.row_to_mirror(row) for row in kwargs.get('added_rows',[])],
+                                updated_rows=[self.row_to_mirror(row) for row in kwargs.get('updated_rows',[])],
+                                deleted_row_ids=kwargs.get('deleted_row_ids',[]))
+
+    def delete_rows_from_sheet(self,**kwargs):
+        ## Returns the ids of the deleted rows, or a fresh sheet snapshot when return_sheet=True
+        self.sheet_id = kwargs['sheet_id']
+        row_ids = kwargs['row_ids']
+        deleted_row_ids = []
+
+        for start in range(0,len(row_ids),MAX_ROWS_PER_DELETE):
+            response = self.retry(self.ss_client.Sheets.delete_rows,self.sheet_id,row_ids[start:start+MAX_ROWS_PER_DELETE])
+            deleted_row_ids.extend(response.result)
+            self.metrics.increment('rows_deleted',len(response.result))
+            self.mirror_write(sheet_id=self.sheet_id,response=response,deleted_row_ids=response.result)
+
+        if kwargs.get('return_sheet')==True:
+            return(self.get_sheet(sheet_id=self.sheet_id))
+
+        return(deleted_row_ids)
+
 
     def add_cell_to_row(self,cell_dict, new_row):
         cell = smartsheet.models.Cell(cell_dict)
         new_row.cells.append(cell)
         return(new_row)
 
-    def add_row_into_sheet(self,**kwargs):
-        self.sheet_id = kwargs['sheet_id']
-        sheet = self.retry(self.ss_client.Sheets.get_sheet,self.sheet_id)
-
+    def build_row(self,**kwargs):
         new_row = smartsheet.models.Row()
-        new_row.to_bottom = kwargs['to_bottom']
+        new_row.to_bottom = kwargs.get('to_bottom',True)
         add_cells = kwargs['add_cells']
-        parent_row_id = None
 
-        if not kwargs['parent_row_id']==None:
+        if not kwargs.get('parent_row_id')==None:
             new_row.parent_id = kwargs['parent_row_id']
-            parent_row_id = kwargs['parent_row_id']
-        else:
-            new_row.parent_id = None
-            parent_row_id = new_row.id
 
         for cell_dict in add_cells:
             new_row = self.add_cell_to_row(cell_dict,new_row)
-        
-        if kwargs['add_predecessor']==True:
-            if kwargs['predecessor_value']!=None:
-                pred = smartsheet.models.Predecessor()
-                pred.row_id = kwargs['predecessor_value']
-                pred.type = kwargs['predecessor_type']
 
-                pred_list = smartsheet.models.PredecessorList()
-                pred_list.predecessors.append(pred)
+        if kwargs.get('add_predecessor')==True:
+            if kwargs.get('predecessor_value')!=None:
+                pred_cell_dict = self.build_predecessor_cell(predecessor_column_id=kwargs['predecessor_column_id'],
+                                                             predecessor_value=kwargs['predecessor_value'],
+                                                             predecessor_type=kwargs['predecessor_type'])
+                new_row = self.add_cell_to_row(pred_cell_dict,new_row)
 
-                pred_cell_dict = {
-                    'column_id': kwargs['predecessor_column_id']
-                    ,'object.value.object_type': 'PREDECESSOR_LIST'
-                    ,'object_value': pred_list
-                }
+        return(new_row)
 
-                new_row = self.add_cell_to_row(pred_cell_dict,new_row)
+    def build_predecessor_cell(self,**kwargs):
+        pred = smartsheet.models.Predecessor()
+        pred.row_id = kwargs['predecessor_value']
+        pred.type = kwargs['predecessor_type']
 
-        self.retry(self.ss_client.Sheets.add_rows,self.sheet_id, new_row, parent_row_id = parent_row_id)
-        sheet = self.retry(self.ss_client.Sheets.get_sheet,self.sheet_id, parent_row_id = parent_row_id)
+        pred_list = smartsheet.models.PredecessorList()
+        pred_list.predecessors.append(pred)
 
-        return(sheet)
+        pred_cell_dict = {
+            'column_id': kwargs['predecessor_column_id']
+            ,'object.value.object_type': 'PREDECESSOR_LIST'
+            ,'object_value': pred_list
+        }
+
+        return(pred_cell_dict)
 
+    def add_rows(self,**kwargs):
+        ## Add many rows with as few requests as possible and return the new row ids in input order.
+        ## Accepts either new_data_df + column_map (one row per dataframe record) or row_specs,
+        ## a list of dicts with the keys build_row takes (add_cells, parent_row_id, to_bottom, ...)
+        self.sheet_id = kwargs['sheet_id']
+        chunk_size = kwargs.get('chunk_size',MAX_ROWS_PER_REQUEST)
+
+        if 'new_data_df' in kwargs:
+            new_data_df = kwargs['new_data_df']
+            column_map = {key: value for key, value in kwargs['column_map'].items() if key in new_data_df.columns}
+            row_specs = []
+            for record in new_data_df[list(column_map)].to_dict('records'):
+                add_cells = [{'column_id': column_map[column_name], 'value': value, 'strict': False}
+                             for column_name, value in record.items()]
+                row_specs.append({'add_cells': add_cells,
+                                  'parent_row_id': kwargs.get('parent_row_id'),
+                                  'to_bottom': kwargs.get('to_bottom',True)})
+        else:
+            row_specs = kwargs['row_specs']
+
+        row_ids = [None]*len(row_specs)
+
+        ## Rows in one request must share the same location, so group by parent before chunking
+        location_groups = {}
+        for position, row_spec in enumerate(row_specs):
+            location_groups.setdefault(row_spec.get('parent_row_id'),[]).append(position)
+
+        for parent_row_id, positions in location_groups.items():
+            for start in range(0,len(positions),chunk_size):
+                chunk = positions[start:start+chunk_size]
+                new_rows = [self.build_row(**row_specs[position]) for position in chunk]
+                response = self.retry(self.ss_client.Sheets.add_rows,self.sheet_id,new_rows)
+                self.mirror_write(sheet_id=self.sheet_id,response=response,added_rows=response.result)
+                self.metrics.increment('rows_added',len(new_rows))
+                self.metrics.increment('cells_written',sum(len(new_row.cells) for new_row in new_rows))
+                for position, row in zip(chunk,response.result):
+                    row_ids[position] = row.id
+
+        return(row_ids)
+
+    def add_row_tree(self,**kwargs):
+        ## Insert parent rows and their child rows with a fixed number of bulk requests:
+        ## one add for all parents, one add per parent for its children, then one update
+        ## that chains each child to the previous sibling through the predecessor column.
+        ## child_row_specs[i] holds the children of parent_row_specs[i] in display order.
+        self.sheet_id = kwargs['sheet_id']
+        parent_row_specs = kwargs['parent_row_specs']
+        child_row_specs = kwargs['child_row_specs']
+        predecessor_column_id = kwargs.get('predecessor_column_id')
+        predecessor_type = kwargs.get('predecessor_type','FS')
+        chunk_size = kwargs.get('chunk_size',MAX_ROWS_PER_REQUEST)
+
+        ## A parent left without its children would be taken as already loaded on the next run, so
+        ## when any request fails the parents added so far are deleted (their children go with them)
+        parent_row_ids = [None]*len(parent_row_specs)
+        try:
+            for start in range(0,len(parent_row_specs),chunk_size):
+                parent_row_ids[start:start+chunk_size] = self.add_rows(sheet_id=self.sheet_id,
+                                                                       row_specs=parent_row_specs[start:start+chunk_size],
+                                                                       chunk_size=chunk_size)
+
+            flat_child_specs = []
+            for parent_row_id, children in zip(parent_row_ids,child_row_specs):
+                for child_spec in children:
+                    flat_child_specs.append(dict(child_spec,parent_row_id=parent_row_id,to_bottom=True))
+
+            flat_child_ids = self.add_rows(sheet_id=self.sheet_id,row_specs=flat_child_specs,chunk_size=chunk_size)
+
+            child_row_ids = []
+            position = 0
+            for children in child_row_specs:
+                child_row_ids.append(flat_child_ids[position:position+len(children)])
+                position += len(children)
+
+            if predecessor_column_id!=None:
+                predecessor_rows = []
+                for sibling_ids in child_row_ids:
+                    for predecessor_value, row_id in zip(sibling_ids,sibling_ids[1:]):
+                        row = smartsheet.models.Row()
+                        row.id = row_id
+                        pred_cell_dict = self.build_predecessor_cell(predecessor_column_id=predecessor_column_id,
+                                                                     predecessor_value=predecessor_value,
+                                                                     predecessor_type=predecessor_type)
+                        row = self.add_cell_to_row(pred_cell_dict,row)
+                        predecessor_rows.append(row)
+
+                for start in range(0,len(predecessor_rows),chunk_size):
+                    predecessor_chunk = predecessor_rows[start:start+chunk_size]
+                    response = self.retry(self.ss_client.Sheets.update_rows,self.sheet_id,predecessor_chunk)
+                    self.mirror_write(sheet_id=self.sheet_id,response=response,updated_rows=response.result)
+                    self.metrics.increment('cells_written',len(predecessor_chunk))
+        except Exception:
+            added_parent_row_ids = [row_id for row_id in parent_row_ids if row_id!=None]
+            if len(added_parent_row_ids)>0:
+                print(f"Rolling back due to error - Removing {len(added_parent_row_ids)} incomplete deviation tasks")
+                self.delete_rows_from_sheet(sheet_id=self.sheet_id,row_ids=added_parent_row_ids)
+            raise
+
+        return(parent_row_ids,child_row_ids)
 
     def update_smartsheet_cell(self,**kwargs):
+        ## Returns the updated rows, or a fresh sheet snapshot when return_sheet=True
         self.sheet_id = kwargs['sheet_id']
         row = smartsheet.models.Row()
         row_id = None
@@ -210,10 +650,19 @@ class smartsheet_api:
         
         update_row.append(row)
 
-        self.retry(self.ss_client.Sheets.update_rows,self.sheet_id,update_row)
-        sheet = self.retry(self.ss_client.Sheets.get_sheet,self.sheet_id)
-       
-        return(sheet)
+        updated_rows = []
+        for start in range(0,len(update_row),MAX_ROWS_PER_REQUEST):
+            update_chunk = update_row[start:start+MAX_ROWS_PER_REQUEST]
+            response = self.retry(self.ss_client.Sheets.update_rows,self.sheet_id,update_chunk)
+            updated_rows.extend(response.result)
+            self.metrics.increment('rows_updated',len(update_chunk))
+            self.metrics.increment('cells_written',sum(len(row.cells) for row in update_chunk))
+            self.mirror_write(sheet_id=self.sheet_id,response=response,updated_rows=response.result)
+
+        if kwargs.get('return_sheet')==True:
+            return(self.get_sheet(sheet_id=self.sheet_id))
+
+        return(updated_rows)
     
 
     def set_smartsheet_column_type(self,**kwargs):
@@ -0,0 +1,137 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import smartsheet_api as ssa
+
+## Requests kept in flight at once, well under what the shared rate limiter lets through
+DEFAULT_CONCURRENCY = 8
+
+
+class async_smartsheet_api:
+    ## asyncio companion of smartsheet_api. Every call runs on one of `concurrency` synchronous clients,
+    ## each with its own pooled HTTP session, in a worker thread, so at most that many requests are in
+    ## flight. The clients share one rate limiter, mirror, metadata cache and metrics, so throughput is bounded
+    ## by the API quota instead of the round trip time.
+
+    def __init__(self,ss_creds,concurrency=DEFAULT_CONCURRENCY,limiter=None,mirror=None,cache=None,metrics=None):
+        first_client = ssa.smartsheet_api(ss_creds,limiter=limiter,mirror=mirror,cache=cache,metrics=metrics)
+        self.clients = [first_client]
+        for _ in range(concurrency-1):
+            self.clients.append(ssa.smartsheet_api(ss_creds,limiter=first_client.limiter,mirror=first_client.mirror,cache=first_client.cache,metrics=first_client.metrics))
+        self.limiter = first_client.limiter
+        self.metrics = first_client.metrics
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.idle_clients = None
+
+    async def __aenter__(self):
+        return(self)
+
+    async def __aexit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    async def call(self,method_name,**kwargs):
+        ## Run one smartsheet_api method on an idle client, a client is never used by two calls at once
+        if self.idle_clients==None:
+            ## Created on first use so the queue belongs to the running event loop
+            self.idle_clients = asyncio.Queue()
+            for client in self.clients:
+                self.idle_clients.put_nowait(client)
+
+        client = await self.idle_clients.get()
+        try:
+            loop = asyncio.get_running_loop()
+            return(await loop.run_in_executor(self.executor,functools.partial(getattr(client,method_name),**kwargs)))
+        finally:
+            self.idle_clients.put_nowait(client)
+
+    async def get_all_sheets_in_folder(self):
+        return(await self.call('get_all_sheets_in_folder'))
+
+    async def get_sheet_by_name_in_folder(self,**kwargs):
+        return(await self.call('get_sheet_by_name_in_folder',**kwargs))
+
+    async def create_sheet_in_folder(self,**kwargs):
+        return(await self.call('create_sheet_in_folder',**kwargs))
+
+    async def get_column_name_id_map(self,**kwargs):
+        return(await self.call('get_column_name_id_map',**kwargs))
+
+    async def add_column_to_smartsheet(self,**kwargs):
+        return(await self.call('add_column_to_smartsheet',**kwargs))
+
+    async def get_sheet(self,**kwargs):
+        return(await self.call('get_sheet',**kwargs))
+
+    async def get_sheet_filtered(self,**kwargs):
+        return(await self.call('get_sheet_filtered',**kwargs))
+
+    async def get_rows_from_sheet(self,**kwargs):
+        return(await self.call('get_rows_from_sheet',**kwargs))
+
+    async def add_rows(self,**kwargs):
+        ## Rows under different parents are added concurrently. Chunks under the same parent are added
+        ## one after the other to keep their order in the sheet, unless preserve_order=False.
+        ## new_data_df rows all share one parent, so its chunks are sent concurrently by default
+        ## Same contract as smartsheet_api.add_rows, the new row ids are returned in input order
+        sheet_id = kwargs['sheet_id']
+        chunk_size = kwargs.get('chunk_size',ssa.MAX_ROWS_PER_REQUEST)
+
+        ## Chunk groups, each chunk is (input positions, smartsheet_api.add_rows arguments)
+        if 'new_data_df' in kwargs:
+            new_data_df = kwargs['new_data_df']
+            row_count = len(new_data_df)
+            chunk_groups = [[(list(range(start,min(start+chunk_size,row_count))),
+                              {'new_data_df': new_data_df.iloc[start:start+chunk_size],
+                               'column_map': kwargs['column_map'],
+                               'parent_row_id': kwargs.get('parent_row_id'),
+                               'to_bottom': kwargs.get('to_bottom',True)})
+                             for start in range(0,row_count,chunk_size)]]
+        else:
+            row_specs = kwargs['row_specs']
+            row_count = len(row_specs)
+            location_groups = {}
+            for position, row_spec in enumerate(row_specs):
+                location_groups.setdefault(row_spec.get('parent_row_id'),[]).append(position)
+            chunk_groups = [[(positions[start:start+chunk_size],
+                              {'row_specs': [row_specs[position] for position in positions[start:start+chunk_size]]})
+                             for start in range(0,len(positions),chunk_size)]
+                            for positions in location_groups.values()]
+
+        if kwargs.get('preserve_order','new_data_df' not in kwargs)==False:
+            chunk_groups = [[chunk] for chunk_group in chunk_groups for chunk in chunk_group]
+
+        row_ids = [None]*row_count
+
+        async def add_chunks(chunk_group):
+            for positions, chunk_kwargs in chunk_group:
+                chunk_row_ids = await self.call('add_rows',sheet_id=sheet_id,**chunk_kwargs)
+                for position, row_id in zip(positions,chunk_row_ids):
+                    row_ids[position] = row_id
+
+        await asyncio.gather(*[add_chunks(chunk_group) for chunk_group in chunk_groups])
+        return(row_ids)
+
+    async def update_smartsheet_cell(self,**kwargs):
+        ## Row chunks are updated concurrently, the cells of one row always stay in the same request
+        sheet_id = kwargs['sheet_id']
+        cells_by_row = {}
+        for cell_param in kwargs['update_row_cells']:
+            cells_by_row.setdefault(cell_param['row_id'],[]).append(cell_param)
+        row_cells = list(cells_by_row.values())
+
+        tasks = [self.call('update_smartsheet_cell',sheet_id=sheet_id,
+                           update_row_cells=[cell_param for cells in row_cells[start:start+ssa.MAX_ROWS_PER_REQUEST] for cell_param in cells])
+                 for start in range(0,len(row_cells),ssa.MAX_ROWS_PER_REQUEST)]
+        results = await asyncio.gather(*tasks)
+        return([row for updated_rows in results for row in updated_rows])
+
+    async def delete_rows_from_sheet(self,**kwargs):
+        sheet_id = kwargs['sheet_id']
+        row_ids = kwargs['row_ids']
+        tasks = [self.call('delete_rows_from_sheet',sheet_id=sheet_id,row_ids=row_ids[start:start+ssa.MAX_ROWS_PER_DELETE])
+                 for start in range(0,len(row_ids),ssa.MAX_ROWS_PER_DELETE)]
+        results = await asyncio.gather(*tasks)
+        return([row_id for deleted_row_ids in results for row_id in deleted_row_ids])
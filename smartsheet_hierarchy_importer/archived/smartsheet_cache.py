@@ -0,0 +1,40 @@
+import threading
+
+
+class metadata_cache:
+    ## Folder and column metadata shared by every smartsheet_api instance of a run, kept for the run only.
+    ## Checking a stored column map against the live sheet takes a request as well, so it is not persisted.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.folders = {}
+        self.sheets = {}
+
+    def get_folder_sheets(self,folder_id):
+        with self.lock:
+            sheet_dict = self.folders.get(folder_id)
+            if sheet_dict==None:
+                return(None)
+            return(dict(sheet_dict))
+
+    def set_folder_sheets(self,folder_id,sheet_dict):
+        with self.lock:
+            self.folders[folder_id] = dict(sheet_dict)
+
+    def add_folder_sheet(self,folder_id,sheet_name,sheet_id):
+        with self.lock:
+            if folder_id in self.folders:
+                self.folders[folder_id][sheet_name] = sheet_id
+
+    def get_columns(self,sheet_id):
+        with self.lock:
+            return(self.sheets.get(str(sheet_id)))
+
+    def set_columns(self,sheet_id,columns):
+        with self.lock:
+            self.sheets[str(sheet_id)] = columns
+
+    def invalidate(self,sheet_id):
+        ## Called after our own schema changes
+        with self.lock:
+            self.sheets.pop(str(sheet_id),None)
@@ -0,0 +1,244 @@
+import json
+import gzip
+import re
+import math
+from datetime import datetime
+import pandas as pd
+import smartsheet
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import smartsheet_api as ssa
+
+## A change set lists every write needed to bring a group of sheets in line with the source data.
+## Columns are referenced by title, not id, so the plan stays valid for sheets and columns that are
+## only created when the change set is applied.
+
+
+def new_sheet_change(**kwargs):
+    return({'sheet_name': kwargs['sheet_name'],
+            'sheet_id': kwargs.get('sheet_id'),
+            'primary_key': kwargs.get('primary_key'),
+            'sheet_template': kwargs.get('sheet_template',[]),
+            'add_columns': [],
+            'update_row_cells': [],
+            'delete_row_ids': [],
+            'add_rows': []})
+
+def key_text(value):
+    ## Primary key as text, the sheet returns whole numbers as floats (1.0) where the source has 1
+    if value==None or (not isinstance(value,str) and pd.isna(value)):
+        return(None)
+    return(re.sub(r'\.0$','',str(value)))
+
+def save_change_set(change_set_file,change_set):
+    ## Compact JSON, gzipped when the file name ends with .gz
+    change_set_filepath = Path(change_set_file)
+    content = json.dumps(change_set,separators=(',',':'),default=str)
+    temp_filepath = change_set_filepath.with_name(change_set_filepath.name+'.tmp')
+    if change_set_filepath.suffix=='.gz':
+        with gzip.open(temp_filepath,'wt') as f_out:
+            f_out.write(content)
+    else:
+        with open(temp_filepath,'w') as f_out:
+            f_out.write(content)
+    temp_filepath.replace(change_set_filepath)
+
+def load_change_set(change_set_file):
+    change_set_filepath = Path(change_set_file)
+    if change_set_filepath.suffix=='.gz':
+        with gzip.open(change_set_filepath,'rt') as f_in:
+            return(json.load(f_in))
+    with open(change_set_filepath) as f_in:
+        return(json.load(f_in))
+
+def estimate_api_calls(sheet_change):
+    ## API requests apply_sheet_change will make for this sheet, before retries
+    update_rows = len({cell['row_id'] for cell in sheet_change['update_row_cells']})
+
+    ## A new sheet costs a folder listing and the create
+    calls = {'create_sheet': 2 if sheet_change['sheet_id']==None else 0,
+             'add_columns': len(sheet_change['add_columns']),
+             'column_map': 1,
+             'update_rows': math.ceil(update_rows/ssa.MAX_ROWS_PER_REQUEST),
+             'delete_rows': math.ceil(len(sheet_change['delete_row_ids'])/ssa.MAX_ROWS_PER_DELETE),
+             'add_rows': math.ceil(len(sheet_change['add_rows'])/ssa.MAX_ROWS_PER_REQUEST)}
+    calls['total'] = sum(calls.values())
+    return(calls)
+
+def print_change_set_summary(change_set):
+    total_calls = 0
+    for sheet_change in change_set['sheets']:
+        calls = estimate_api_calls(sheet_change)
+        total_calls += calls['total']
+        print(f"{sheet_change['sheet_name']}: {'new sheet, ' if sheet_change['sheet_id']==None else ''}"
+              f"{len(sheet_change['add_columns'])} columns to add, "
+              f"{len({cell['row_id'] for cell in sheet_change['update_row_cells']})} rows to update, "
+              f"{len(sheet_change['delete_row_ids'])} rows to delete, "
+              f"{len(sheet_change['add_rows'])} rows to add, "
+              f"about {calls['total']} API calls")
+    minutes = total_calls/ssa.DEFAULT_REQUESTS_PER_MINUTE
+    print(f"{len(change_set['sheets'])} sheets, about {total_calls} API calls, at least {minutes:.1f} minutes at {ssa.DEFAULT_REQUESTS_PER_MINUTE} requests per minute")
+    return(total_calls)
+
+def apply_sheet_change(**kwargs):
+    ## Write one planned sheet change: create the sheet, add columns, update, delete, then add rows.
+    ## Writes are made batch by batch, with a journal every finished batch is recorded and skipped
+    ## when the change is applied again after a failure. An add batch is journaled as pending with its
+    ## source keys before it is sent, if the run stops before it is finished the rows already in the
+    ## sheet are looked up by primary key instead of being added again
+    sm = kwargs['smartsheet']
+    sheet_change = kwargs['sheet_change']
+    journal = kwargs.get('journal')
+    sheet_name = sheet_change['sheet_name']
+    sheet_id = sheet_change['sheet_id']
+    is_new_sheet = sheet_id==None
+    start_time = datetime.now()
+    resumed_steps = 0
+
+    def run_step(step,write,pending=None,resume=None):
+        nonlocal resumed_steps
+        if journal!=None:
+            result = journal.get_step(sheet_name,step)
+            if result!=None and result.get('pending')==True:
+                result = resume(result)
+                journal.record_step(sheet_name,step,result)
+                resumed_steps += 1
+                return(result)
+            if result!=None:
+                resumed_steps += 1
+                return(result)
+            if pending!=None:
+                journal.record_step(sheet_name,step,dict(pending,pending=True))
+        result = write()
+        if journal!=None:
+            journal.record_step(sheet_name,step,result)
+        return(result)
+
+    def create_sheet():
+        ## The sheet may have been created by a run that stopped before journaling it
+        existing_sheet_id = sm.get_all_sheets_in_folder().get(sheet_name)
+        if existing_sheet_id!=None:
+            print(f"Smartsheet for {sheet_name} already exists, using it")
+            return({'sheet_id': existing_sheet_id})
+        print(f"Creating new Smartsheet for {sheet_name}")
+        sheet_template = [smartsheet.models.Column(column) for column in sheet_change['sheet_template']]
+        sm.create_sheet_in_folder(new_sheet_name=sheet_name,new_sheet_template=sheet_template)
+        return({'sheet_id': sm.get_sheet_by_name_in_folder(sheet_name=sheet_name)})
+
+    if is_new_sheet:
+        sheet_id = run_step('create_sheet',create_sheet)['sheet_id']
+
+    for column in sheet_change['add_columns']:
+        def add_column():
+            sm.add_column_to_smartsheet(sheet_id=sheet_id,column_name=column['title'],column_type=column['type'],column_index=column['index'])
+            print(f"{column['title']} column added to the {sheet_name} Smartsheet")
+            return({})
+        run_step(f"add_column:{column['title']}",add_column)
+
+    column_map = sm.get_column_name_id_map(sheet_id=sheet_id)['name_to_id']
+
+    ## Cells grouped per row, the cells of one row always go in the same request
+    cells_by_row = {}
+    for cell in sheet_change['update_row_cells']:
+        cells_by_row.setdefault(cell['row_id'],[]).append({'row_id': cell['row_id'],
+                                                           'column_id': column_map[cell['column']],
+                                                           'value': cell['value'],
+                                                           'strict': cell['strict']})
+    row_cells = list(cells_by_row.values())
+    with sm.metrics.phase('update',sheet_name=sheet_name):
+        for batch_index, start in enumerate(range(0,len(row_cells),ssa.MAX_ROWS_PER_REQUEST)):
+            update_row_cells = [cell for cells in row_cells[start:start+ssa.MAX_ROWS_PER_REQUEST] for cell in cells]
+            run_step(f"update:{batch_index}",
+                     lambda: {'row_ids': [row.id for row in sm.update_smartsheet_cell(sheet_id=sheet_id,update_row_cells=update_row_cells)]})
+
+    delete_row_ids = sheet_change['delete_row_ids']
+    with sm.metrics.phase('delete',sheet_name=sheet_name):
+        for batch_index, start in enumerate(range(0,len(delete_row_ids),ssa.MAX_ROWS_PER_DELETE)):
+            run_step(f"delete:{batch_index}",
+                     lambda: {'row_ids': sm.delete_rows_from_sheet(sheet_id=sheet_id,row_ids=delete_row_ids[start:start+ssa.MAX_ROWS_PER_DELETE])})
+
+    ## Source keys are journaled with the new row ids so the written records can be traced
+    add_rows = sheet_change['add_rows']
+    primary_key = sheet_change.get('primary_key')
+    rows_added = 0
+
+    def resume_add(pending,batch):
+        ## Rows of the batch found in the sheet by primary key were written, only the others are added
+        sheet_df = sm.get_sheet_frame(sheet_id=sheet_id,column_ids=[column_map[primary_key]])
+        sheet_row_ids = {key_text(key): int(row_id) for row_id, key in zip(sheet_df['Smartsheet_Row_Id'],sheet_df[primary_key])}
+        row_ids = [sheet_row_ids.get(key_text(key)) for key in pending['keys']]
+        missing = [position for position, row_id in enumerate(row_ids) if row_id==None]
+        print(f"{len(row_ids)-len(missing)} rows of an interrupted add to {sheet_name} already written, adding {len(missing)}")
+        if len(missing)>0:
+            new_row_ids = sm.add_rows(sheet_id=sheet_id,
+                                      new_data_df=pd.DataFrame([batch[position] for position in missing]),
+                                      column_map=column_map,
+                                      to_bottom=True)
+            for position, row_id in zip(missing,new_row_ids):
+                row_ids[position] = row_id
+        return({'keys': pending['keys'], 'row_ids': row_ids})
+
+    with sm.metrics.phase('add',sheet_name=sheet_name):
+        for batch_index, start in enumerate(range(0,len(add_rows),ssa.MAX_ROWS_PER_REQUEST)):
+            batch = add_rows[start:start+ssa.MAX_ROWS_PER_REQUEST]
+            keys = [add_row.get(primary_key) for add_row in batch]
+            ## Without a primary key an interrupted batch can not be matched and is sent again
+            pending = {'keys': keys} if primary_key!=None else None
+            result = run_step(f"add:{batch_index}",
+                              lambda: {'keys': keys,
+                                       'row_ids': sm.add_rows(sheet_id=sheet_id,
+                                                              new_data_df=pd.DataFrame(batch),
+                                                              column_map=column_map,
+                                                              to_bottom=True)},
+                              pending=pending,
+                              resume=lambda pending: resume_add(pending,batch))
+            rows_added += len(result['row_ids'])
+
+    if resumed_steps>0:
+        print(f"{resumed_steps} batches of {sheet_name} already written in an earlier run, skipped")
+
+    sheet_result = {
+        'sheet_name': sheet_name,
+        'sheet_id': sheet_id,
+        'new_sheet': is_new_sheet,
+        'rows_updated': len(row_cells),
+        'rows_deleted': len(delete_row_ids),
+        'rows_added': rows_added,
+        'duration_s': (datetime.now() - start_time).total_seconds()
+    }
+    ## Sync state planned with the change, only stored once the change has been applied
+    if 'row_hashes' in sheet_change:
+        sheet_result['row_hashes'] = sheet_change['row_hashes']
+
+    return(sheet_result)
+
+def apply_change_set(**kwargs):
+    ## Apply every sheet of a change set, workers sheets at a time. Each worker has its own client,
+    ## all of them share one rate limiter, metadata cache and metrics. Returns one result per sheet,
+    ## failed sheets have an 'error' entry instead of the counts. Pass the journal to resume
+    change_set = kwargs['change_set']
+    ss_creds = kwargs['ss_creds']
+    workers = kwargs.get('workers',1)
+    journal = kwargs.get('journal')
+
+    sm = ssa.smartsheet_api(ss_creds,metrics=kwargs.get('metrics'))
+    sm.get_all_sheets_in_folder()
+    sheet_results = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for sheet_change in change_set['sheets']:
+            future = executor.submit(apply_sheet_change,
+                                     smartsheet=ssa.smartsheet_api(ss_creds,limiter=sm.limiter,mirror=sm.mirror,cache=sm.cache,metrics=sm.metrics),
+                                     sheet_change=sheet_change,
+                                     journal=journal)
+            futures[future] = sheet_change['sheet_name']
+
+        for future in as_completed(futures):
+            try:
+                sheet_results.append(future.result())
+            except Exception as ex:
+                print(f"Failed to apply changes to {futures[future]} Smartsheet: {ex}")
+                sheet_results.append({'sheet_name': futures[future], 'error': str(ex)})
+
+    return(sheet_results)
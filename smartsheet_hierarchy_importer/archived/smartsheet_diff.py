@@ -0,0 +1,106 @@
+import numpy as np
+import pandas as pd
+import re
+from datetime import datetime
+
+DATE_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+NUMERIC_SUFFIX_PATTERN = re.compile(r'\.0$')
+
+
+def normalize_key(series):
+    return(series.astype(str).str.replace(NUMERIC_SUFFIX_PATTERN,'',regex=True))
+
+def normalize_new_value(value):
+    return(NUMERIC_SUFFIX_PATTERN.sub('',value))
+
+def normalize_sheet_value(value):
+    ## Smartsheet returns dates as YYYY-MM-DD while the source data uses MM/DD/YYYY
+    if DATE_PATTERN.search(value):
+        return(datetime.strptime(value,'%Y-%m-%d').strftime('%m/%d/%Y'))
+    return(NUMERIC_SUFFIX_PATTERN.sub('',value))
+
+def hash_rows(data_df,columns,pk_field):
+    ## Stable fingerprint per record over the given columns, after the same normalization the
+    ## cell comparison uses. Returned as {normalized key: hash} ready to be stored as JSON
+    columns = sorted(columns)
+    keys = normalize_key(data_df[pk_field])
+    values = data_df[columns].astype(str).replace(NUMERIC_SUFFIX_PATTERN,'',regex=True)
+    hashes = pd.util.hash_pandas_object(values,index=False).to_numpy()
+    first = ~keys.duplicated(keep='first').to_numpy()
+    row_hashes = dict(zip(keys.to_numpy()[first],(str(row_hash) for row_hash in hashes[first])))
+    return(row_hashes)
+
+def diff_sheet_data(**kwargs):
+    ## Compare the rows currently in a sheet with the new source data in one vectorized pass.
+    ## Returns the cell updates for changed values, the row ids to delete and the changed keys.
+    old_data_df = kwargs['old_data_df']
+    new_data_df = kwargs['new_data_df']
+    column_map = kwargs['column_map']
+    pk_field = kwargs['pk_field']
+    delete_flag = kwargs['delete_flag']
+    ## Optional fingerprints of the source records, from the last sync and from this run
+    previous_hashes = kwargs.get('previous_hashes')
+    row_hashes = kwargs.get('row_hashes')
+
+    ## An empty sheet (possibly without any columns) has nothing to update or delete
+    if len(old_data_df)==0:
+        return({'update_row_cells': [], 'delete_row_ids': [], 'updated_keys': [], 'skipped_count': 0})
+
+    compare_columns = [column for column in column_map if column in new_data_df.columns and column != pk_field]
+
+    old_keys = normalize_key(old_data_df[pk_field])
+    new_indexed = new_data_df[compare_columns].set_index(normalize_key(new_data_df[pk_field]))
+    new_indexed = new_indexed[~new_indexed.index.duplicated(keep='first')]
+
+    matched = old_keys.isin(new_indexed.index).to_numpy()
+
+    delete_row_ids = []
+    if delete_flag==True:
+        delete_row_ids = old_data_df['Smartsheet_Row_Id'].to_numpy()[~matched].tolist()
+
+    ## Records whose fingerprint has not changed since the last sync are not compared cell by cell
+    compare_rows = matched
+    skipped_count = 0
+    if previous_hashes!=None and row_hashes!=None:
+        previous = old_keys.map(previous_hashes)
+        unchanged = (previous.notna() & (previous==old_keys.map(row_hashes))).to_numpy()
+        compare_rows = matched & ~unchanged
+        skipped_count = int((matched & unchanged).sum())
+
+    old_matched = old_data_df[compare_rows]
+    matched_keys = old_keys[compare_rows]
+
+    old_values = old_matched.reindex(columns=compare_columns,fill_value='').astype(str).to_numpy()
+    new_values = new_indexed.reindex(matched_keys).astype(str).to_numpy()
+
+    ## Raw string comparison first, normalization is only needed for the cells that differ
+    change_mask = old_values != new_values
+    row_positions, column_positions = np.nonzero(change_mask)
+
+    new_candidates = [normalize_new_value(value) for value in new_values[row_positions, column_positions]]
+    old_candidates = [normalize_sheet_value(value) for value in old_values[row_positions, column_positions]]
+    is_changed = np.array([old != new for old, new in zip(old_candidates, new_candidates)],dtype=bool)
+
+    change_mask[row_positions[~is_changed], column_positions[~is_changed]] = False
+    row_positions = row_positions[is_changed]
+    column_positions = column_positions[is_changed]
+
+    row_ids = old_matched['Smartsheet_Row_Id'].to_numpy()[row_positions]
+    column_ids = np.array([column_map[column] for column in compare_columns])[column_positions]
+    values = [value for value, changed in zip(new_candidates, is_changed) if changed]
+
+    update_row_cells = [
+        {   'row_id': int(row_id),
+            'column_id': int(column_id),
+            'value': value,
+            'strict': False
+        }
+        for row_id, column_id, value in zip(row_ids, column_ids, values)
+    ]
+
+    updated_keys = matched_keys.to_numpy()[change_mask.any(axis=1)].tolist()
+
+    return({'update_row_cells': update_row_cells,
+            'delete_row_ids': delete_row_ids,
+            'updated_keys': updated_keys,
+            'skipped_count': skipped_count})
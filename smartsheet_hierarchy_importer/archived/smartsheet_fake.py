@@ -0,0 +1,362 @@
+import json
+import time
+import random
+import itertools
+import threading
+from datetime import datetime, timezone
+from types import SimpleNamespace
+import smartsheet
+
+## Request limits enforced like the live API, so a batching regression fails here as well
+MAX_ROWS_PER_WRITE = 500
+
+
+class fake_smartsheet_client:
+    ## In-process stand-in for the Smartsheet SDK client, limited to the folder and sheet endpoints
+    ## smartsheet_api uses. Sheets are kept in memory, responses are parsed into the SDK models from
+    ## the same JSON the API would send. Every request is counted with its payload sizes, latency and
+    ## throttling (429 with Retry-After) can be injected. Use it by assigning it to smartsheet_api.ss_client,
+    ## and http_session() to smartsheet_api.http_session for the raw JSON read path.
+
+    def __init__(self,latency_s=0,throttle_rate=0,retry_after=1,seed=None):
+        self.latency_s = latency_s
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1000000)
+        self.folders = {}
+        self.sheets = {}
+        self.Folders = fake_folders(self)
+        self.Sheets = fake_sheets(self)
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {'requests': {}, 'request_bytes': 0, 'response_bytes': 0, 'throttled': 0}
+
+    def request_count(self):
+        return(sum(self.stats['requests'].values()))
+
+    def new_id(self):
+        return(next(self.ids))
+
+    def add_folder(self,folder_id):
+        with self.lock:
+            self.folders.setdefault(folder_id,[])
+
+    def add_sheet(self,**kwargs):
+        ## Seed a sheet without going through the API, columns are titles and rows dicts of title to value
+        folder_id = kwargs['folder_id']
+        columns = kwargs['columns']
+        rows = kwargs.get('rows',[])
+
+        with self.lock:
+            sheet_id = self.new_id()
+            sheet = {'id': sheet_id,
+                     'name': kwargs['sheet_name'],
+                     'version': 1,
+                     'columns': [{'id': self.new_id(), 'title': title, 'type': 'TEXT_NUMBER', 'index': index, 'primary': index==0}
+                                 for index, title in enumerate(columns)],
+                     'rows': {}}
+            column_ids = {column['title']: column['id'] for column in sheet['columns']}
+            modified_at = self.timestamp()
+            for row in rows:
+                row_id = self.new_id()
+                sheet['rows'][row_id] = {'id': row_id,
+                                         'parent_id': None,
+                                         'cells': {column_ids[title]: value for title, value in row.items()},
+                                         'modified_at': modified_at}
+            self.sheets[sheet_id] = sheet
+            self.folders.setdefault(folder_id,[]).append(sheet_id)
+        return(sheet_id)
+
+    def timestamp(self):
+        return(datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+    def request(self,endpoint,request_body,handler):
+        ## One API round trip: count it, wait, maybe throttle, then run the handler under the lock.
+        ## The handler returns (status_code, response body), bodies are sized as compact JSON
+        with self.lock:
+            self.stats['requests'][endpoint] = self.stats['requests'].get(endpoint,0) + 1
+            if request_body!=None:
+                self.stats['request_bytes'] += len(json.dumps(request_body,separators=(',',':'),default=str))
+            throttled = self.throttle_rate>0 and self.random.random()<self.throttle_rate
+            if throttled:
+                self.stats['throttled'] += 1
+
+        if self.latency_s>0:
+            time.sleep(self.latency_s)
+        if throttled:
+            return(self.error_response(429,{'Retry-After': str(self.retry_after)}))
+
+        with self.lock:
+            status_code, response_body = handler()
+            self.stats['response_bytes'] += len(json.dumps(response_body,separators=(',',':'),default=str))
+        if status_code!=200:
+            return(self.error_response(status_code,{}))
+        return(response_body)
+
+    def ok_response(self,result):
+        ## Successful SDK results carry the HTTP response, smartsheet_api.retry checks its status
+        result.request_response = SimpleNamespace(status_code=200,headers={})
+        return(result)
+
+    def error_response(self,status_code,headers):
+        ## Same shape smartsheet_api.retry inspects on a failed call
+        return(SimpleNamespace(request_response=SimpleNamespace(status_code=status_code,headers=headers)))
+
+    def get_sheet_state(self,sheet_id):
+        sheet = self.sheets.get(int(sheet_id))
+        if sheet==None:
+            return(404,{'errorCode': 1006, 'message': 'Not Found'})
+        return(200,sheet)
+
+    def row_body(self,row,column_ids=None):
+        return({'id': row['id'],
+                'parentId': row['parent_id'],
+                'cells': [{'columnId': column_id, 'value': value} for column_id, value in row['cells'].items()
+                          if column_ids==None or column_id in column_ids]})
+
+    def column_body(self,column):
+        return({'id': column['id'], 'title': column['title'], 'type': column['type'], 'index': column['index'], 'primary': column['primary']})
+
+    def sheet_body(self,sheet_id,rows_modified_since,column_ids,row_ids):
+        status_code, sheet = self.get_sheet_state(sheet_id)
+        if status_code!=200:
+            return(status_code,sheet)
+        column_id_filter = None
+        if column_ids!=None:
+            column_id_filter = {int(column_id) for column_id in str(column_ids).split(',')}
+        row_id_filter = None
+        if row_ids!=None:
+            row_id_filter = {int(row_id) for row_id in str(row_ids).split(',')}
+
+        rows = []
+        for row in sheet['rows'].values():
+            if row_id_filter!=None and row['id'] not in row_id_filter:
+                continue
+            if rows_modified_since!=None and row['modified_at']<rows_modified_since:
+                continue
+            rows.append(self.row_body(row,column_id_filter))
+
+        return(200,{'id': sheet['id'],
+                    'name': sheet['name'],
+                    'version': sheet['version'],
+                    'totalRowCount': len(sheet['rows']),
+                    'modifiedAt': self.timestamp(),
+                    'columns': [self.column_body(column) for column in sheet['columns']
+                                if column_id_filter==None or column['id'] in column_id_filter],
+                    'rows': rows})
+
+    def http_session(self):
+        ## Stand-in for the requests session of the raw JSON read path, assign it to smartsheet_api.http_session
+        return(fake_http_session(self))
+
+    def write_rows(self,sheet_id,rows,add):
+        ## Shared by add_rows and update_rows, returns the response rows or an error status
+        status_code, sheet = self.get_sheet_state(sheet_id)
+        if status_code!=200:
+            return(status_code,sheet)
+        if len(rows)>MAX_ROWS_PER_WRITE:
+            return(400,{'errorCode': 1101, 'message': f"Too many rows, the limit is {MAX_ROWS_PER_WRITE}"})
+        if add and len({row.get('parentId') for row in rows})>1:
+            return(400,{'errorCode': 1062, 'message': 'Rows in one request must share a location'})
+
+        modified_at = self.timestamp()
+        written_rows = []
+        for row in rows:
+            cells = {cell['columnId']: cell.get('value') for cell in row.get('cells',[])}
+            if add:
+                row_id = self.new_id()
+                sheet['rows'][row_id] = {'id': row_id, 'parent_id': row.get('parentId'), 'cells': {}, 'modified_at': modified_at}
+            else:
+                row_id = row['id']
+                if row_id not in sheet['rows']:
+                    return(404,{'errorCode': 1006, 'message': f"Row {row_id} not found"})
+            sheet['rows'][row_id]['cells'].update(cells)
+            sheet['rows'][row_id]['modified_at'] = modified_at
+            written_rows.append(self.row_body(sheet['rows'][row_id]))
+
+        sheet['version'] += 1
+        return(200,{'message': 'SUCCESS', 'resultCode': 0, 'version': sheet['version'], 'result': written_rows})
+
+
+class fake_http_session:
+    ## Serves GET sheets/{sheetId} with the query parameters of the REST API, the body is raw JSON bytes
+
+    def __init__(self,client):
+        self.client = client
+
+    def get(self,url,params=None,headers=None,timeout=None):
+        client = self.client
+        params = params or {}
+        path = url.rstrip('/').split('/')
+        if len(path)<2 or path[-2]!='sheets':
+            return(SimpleNamespace(status_code=404,headers={},content=b'{"errorCode":1006,"message":"Not Found"}'))
+
+        response = client.request('get_sheet',None,lambda: client.sheet_body(path[-1],
+                                                                             params.get('rowsModifiedSince'),
+                                                                             params.get('columnIds'),
+                                                                             params.get('rowIds')))
+        if isinstance(response,SimpleNamespace):
+            return(SimpleNamespace(status_code=response.request_response.status_code,headers=response.request_response.headers,content=b'{}'))
+        return(SimpleNamespace(status_code=200,headers={},content=json.dumps(response,separators=(',',':'),default=str).encode()))
+
+
+class fake_folders:
+
+    def __init__(self,client):
+        self.client = client
+
+    def get_folder(self,folder_id):
+        client = self.client
+
+        def handler():
+            if folder_id not in client.folders:
+                return(404,{'errorCode': 1006, 'message': 'Not Found'})
+            return(200,{'id': folder_id,
+                        'sheets': [{'id': sheet_id, 'name': client.sheets[sheet_id]['name']} for sheet_id in client.folders[folder_id]]})
+
+        response = client.request('get_folder',None,handler)
+        if isinstance(response,SimpleNamespace):
+            return(response)
+        return(client.ok_response(smartsheet.models.Folder(response)))
+
+    def create_sheet_in_folder(self,folder_id,sheet):
+        client = self.client
+        request_body = sheet.to_dict()
+
+        def handler():
+            if folder_id not in client.folders:
+                return(404,{'errorCode': 1006, 'message': 'Not Found'})
+            sheet_id = client.new_id()
+            columns = [{'id': client.new_id(),
+                        'title': column['title'],
+                        'type': column.get('type','TEXT_NUMBER'),
+                        'index': index,
+                        'primary': column.get('primary',False)}
+                       for index, column in enumerate(request_body.get('columns',[]))]
+            client.sheets[sheet_id] = {'id': sheet_id, 'name': request_body['name'], 'version': 1, 'columns': columns, 'rows': {}}
+            client.folders[folder_id].append(sheet_id)
+            return(200,{'message': 'SUCCESS', 'resultCode': 0,
+                        'result': {'id': sheet_id, 'name': request_body['name'], 'columns': [client.column_body(column) for column in columns]}})
+
+        response = client.request('create_sheet_in_folder',request_body,handler)
+        if isinstance(response,SimpleNamespace):
+            return(response)
+        return(client.ok_response(SimpleNamespace(result=smartsheet.models.Sheet(response['result']))))
+
+
+class fake_sheets:
+
+    def __init__(self,client):
+        self.client = client
+
+    def get_sheet(self,sheet_id,rows_modified_since=None,column_ids=None,row_ids=None,**kwargs):
+        ## Supports the filters smartsheet_api.get_sheet_filtered passes, ids as comma separated strings
+        client = self.client
+        response = client.request('get_sheet',None,lambda: client.sheet_body(sheet_id,rows_modified_since,column_ids,row_ids))
+        if isinstance(response,SimpleNamespace):
+            return(response)
+        return(client.ok_response(smartsheet.models.Sheet(response)))
+
+    def get_sheet_version(self,sheet_id):
+        client = self.client
+
+        def handler():
+            status_code, sheet = client.get_sheet_state(sheet_id)
+            if status_code!=200:
+                return(status_code,sheet)
+            return(200,{'version': sheet['version']})
+
+        response = client.request('get_sheet_version',None,handler)
+        if isinstance(response,SimpleNamespace):
+            return(response)
+        return(client.ok_response(smartsheet.models.Version(response)))
+
+    def get_columns(self,sheet_id,include_all=False,**kwargs):
+        client = self.client
+
+        def handler():
+            status_code, sheet = client.get_sheet_state(sheet_id)
+            if status_code!=200:
+                return(status_code,sheet)
+            return(200,{'totalCount': len(sheet['columns']), 'data': [client.column_body(column) for column in sheet['columns']]})
+
+        response = client.request('get_columns',None,handler)
+        if isinstance(response,SimpleNamespace):
+            return(response)
+        return(client.ok_response(SimpleNamespace(data=[smartsheet.models.Column(column) for column in response['data']])))
+
+    def add_columns(self,sheet_id,columns):
+        client = self.client
+        if not isinstance(columns,list):
+            columns = [columns]
+        request_body = [column.to_dict() for column in columns]
+
+        def handler():
+            status_code, sheet = client.get_sheet_state(sheet_id)
+            if status_code!=200:
+                return(status_code,sheet)
+            added_columns = []
+            for column in request_body:
+                index = column.get('index',len(sheet['columns']))
+                new_column = {'id': client.new_id(), 'title': column['title'], 'type': column.get('type','TEXT_NUMBER'), 'index': index, 'primary': False}
+                sheet['columns'].insert(index,new_column)
+                added_columns.append(new_column)
+            for index, column in enumerate(sheet['columns']):
+                column['index'] = index
+            sheet['version'] += 1
+            return(200,{'message': 'SUCCESS', 'resultCode': 0, 'result': [client.column_body(column) for column in added_columns]})
+
+        response = client.request('add_columns',request_body,handler)
+        if isinstance(response,SimpleNamespace):
+            return(response)
+        return(client.ok_response(SimpleNamespace(result=[smartsheet.models.Column(column) for column in response['result']])))
+
+    def add_rows(self,sheet_id,rows,**kwargs):
+        client = self.client
+        if not isinstance(rows,list):
+            rows = [rows]
+        request_body = [row.to_dict() for row in rows]
+
+        response = client.request('add_rows',request_body,lambda: client.write_rows(sheet_id,request_body,add=True))
+        if isinstance(response,SimpleNamespace):
+            return(response)
+        return(client.ok_response(SimpleNamespace(version=response['version'],result=[smartsheet.models.Row(row) for row in response['result']])))
+
+    def update_rows(self,sheet_id,rows):
+        client = self.client
+        if not isinstance(rows,list):
+            rows = [rows]
+        request_body = [row.to_dict() for row in rows]
+
+        response = client.request('update_rows',request_body,lambda: client.write_rows(sheet_id,request_body,add=False))
+        if isinstance(response,SimpleNamespace):
+            return(response)
+        return(client.ok_response(SimpleNamespace(version=response['version'],result=[smartsheet.models.Row(row) for row in response['result']])))
+
+    def delete_rows(self,sheet_id,ids,**kwargs):
+        client = self.client
+        row_ids = list(ids)
+
+        def handler():
+            status_code, sheet = client.get_sheet_state(sheet_id)
+            if status_code!=200:
+                return(status_code,sheet)
+            ## Child rows go with their parent, like in the live API
+            deleted_row_ids = set(row_id for row_id in row_ids if row_id in sheet['rows'])
+            for row in sheet['rows'].values():
+                if row['parent_id'] in deleted_row_ids:
+                    deleted_row_ids.add(row['id'])
+            for row_id in deleted_row_ids:
+                del sheet['rows'][row_id]
+            sheet['version'] += 1
+            return(200,{'message': 'SUCCESS', 'resultCode': 0, 'version': sheet['version'], 'result': [row_id for row_id in row_ids if row_id in deleted_row_ids]})
+
+        ## Row ids travel in the query string, sized the same way as a body
+        response = client.request('delete_rows',','.join(str(row_id) for row_id in row_ids),handler)
+        if isinstance(response,SimpleNamespace):
+            return(response)
+        return(client.ok_response(SimpleNamespace(version=response['version'],result=response['result'])))
@@ -0,0 +1,69 @@
+import sqlite3
+import json
+import threading
+from contextlib import contextmanager
+
+
+class progress_journal:
+    ## Durable record of a change set being applied. Every batch written to Smartsheet is committed here
+    ## with its result (row ids, source keys) before the next one starts, so a run that stops halfway
+    ## can be resumed from the last committed batch without reading the source or the sheets again.
+
+    def __init__(self,journal_file):
+        self.journal_file = journal_file
+        self.lock = threading.Lock()
+        with self.connect() as con:
+            con.execute("CREATE TABLE IF NOT EXISTS run_state (name TEXT PRIMARY KEY, value TEXT)")
+            con.execute("CREATE TABLE IF NOT EXISTS steps (sheet_name TEXT, step TEXT, result TEXT, PRIMARY KEY (sheet_name, step))")
+
+    @contextmanager
+    def connect(self):
+        ## One short lived connection per operation, committed on success
+        con = sqlite3.connect(self.journal_file,timeout=30)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def load_change_set(self):
+        with self.lock, self.connect() as con:
+            result = con.execute("SELECT value FROM run_state WHERE name='change_set'").fetchone()
+        if result==None:
+            return(None)
+        return(json.loads(result[0]))
+
+    def begin(self,change_set):
+        ## Start journaling a change set. Progress recorded for the same change set is kept, so applying
+        ## it again resumes, anything recorded for a different change set is dropped
+        stored_change_set = self.load_change_set()
+        if stored_change_set!=None and stored_change_set.get('start_time')==change_set.get('start_time') \
+            and stored_change_set.get('watermark_key')==change_set.get('watermark_key'):
+            return(self.completed_steps())
+
+        with self.lock, self.connect() as con:
+            con.execute("DELETE FROM steps")
+            con.execute("INSERT OR REPLACE INTO run_state VALUES ('change_set',?)",(json.dumps(change_set,separators=(',',':'),default=str),))
+        return(0)
+
+    def completed_steps(self):
+        with self.lock, self.connect() as con:
+            result = con.execute("SELECT COUNT(*) FROM steps").fetchone()
+        return(result[0])
+
+    def get_step(self,sheet_name,step):
+        with self.lock, self.connect() as con:
+            result = con.execute("SELECT result FROM steps WHERE sheet_name=? AND step=?",(sheet_name,step)).fetchone()
+        if result==None:
+            return(None)
+        return(json.loads(result[0]))
+
+    def record_step(self,sheet_name,step,result):
+        with self.lock, self.connect() as con:
+            con.execute("INSERT OR REPLACE INTO steps VALUES (?,?,?)",(sheet_name,step,json.dumps(result,default=str)))
+
+    def clear(self):
+        ## The change set has been applied completely, the next run starts from scratch
+        with self.lock, self.connect() as con:
+            con.execute("DELETE FROM steps")
+            con.execute("DELETE FROM run_state")
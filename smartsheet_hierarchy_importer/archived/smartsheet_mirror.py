@@ -0,0 +1,160 @@
+import sqlite3
+import json
+import threading
+from contextlib import contextmanager
+
+
+class sheet_mirror:
+    ## Local SQLite copy of sheet rows and columns, tagged with the sheet version it reflects.
+    ## It is refreshed on full sheet reads and kept current by our own writes, so a sheet whose
+    ## version has not moved since can be read from here instead of being downloaded again.
+
+    def __init__(self,mirror_file):
+        self.mirror_file = mirror_file
+        self.lock = threading.Lock()
+        with self.connect() as con:
+            con.execute("CREATE TABLE IF NOT EXISTS sheets (sheet_id INTEGER PRIMARY KEY, version INTEGER, modified_at TEXT, synced_at TEXT)")
+            con.execute("CREATE TABLE IF NOT EXISTS columns (sheet_id INTEGER, column_id INTEGER, title TEXT, type TEXT, column_index INTEGER, PRIMARY KEY (sheet_id, column_id))")
+            con.execute("CREATE TABLE IF NOT EXISTS rows (sheet_id INTEGER, row_id INTEGER, parent_id INTEGER, seq INTEGER, cells TEXT, PRIMARY KEY (sheet_id, row_id))")
+
+    @contextmanager
+    def connect(self):
+        ## One short lived connection per operation, committed on success
+        con = sqlite3.connect(self.mirror_file,timeout=30)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def get_version(self,sheet_id):
+        with self.lock, self.connect() as con:
+            result = con.execute("SELECT version FROM sheets WHERE sheet_id=?",(sheet_id,)).fetchone()
+        if result==None:
+            return(None)
+        return(result[0])
+
+    def get_sync_state(self,sheet_id):
+        ## Mirrored version and the time of the last read from Smartsheet, used for delta reads
+        with self.lock, self.connect() as con:
+            result = con.execute("SELECT version, synced_at FROM sheets WHERE sheet_id=?",(sheet_id,)).fetchone()
+        if result==None:
+            return(None,None)
+        return(result[0],result[1])
+
+    def row_count(self,sheet_id):
+        with self.lock, self.connect() as con:
+            result = con.execute("SELECT COUNT(*) FROM rows WHERE sheet_id=?",(sheet_id,)).fetchone()
+        return(result[0])
+
+    def is_current(self,sheet_id,version):
+        return(version!=None and self.get_version(sheet_id)==version)
+
+    def invalidate(self,sheet_id):
+        with self.lock, self.connect() as con:
+            con.execute("UPDATE sheets SET version=NULL WHERE sheet_id=?",(sheet_id,))
+
+    def save_sheet(self,**kwargs):
+        ## Replace the mirrored copy with a full sheet read
+        sheet_id = kwargs['sheet_id']
+        columns = kwargs['columns']
+        rows = kwargs['rows']
+
+        with self.lock, self.connect() as con:
+            con.execute("DELETE FROM columns WHERE sheet_id=?",(sheet_id,))
+            con.execute("DELETE FROM rows WHERE sheet_id=?",(sheet_id,))
+            con.executemany("INSERT INTO columns VALUES (?,?,?,?,?)",
+                            [(sheet_id,column['id'],column['title'],column['type'],column['index']) for column in columns])
+            con.executemany("INSERT INTO rows VALUES (?,?,?,?,?)",
+                            [(sheet_id,row['id'],row['parent_id'],seq,json.dumps(row['cells'])) for seq, row in enumerate(rows)])
+            con.execute("INSERT OR REPLACE INTO sheets VALUES (?,?,?,?)",(sheet_id,kwargs['version'],kwargs.get('modified_at'),kwargs.get('synced_at')))
+
+    def save_columns(self,sheet_id,columns):
+        with self.lock, self.connect() as con:
+            con.execute("DELETE FROM columns WHERE sheet_id=?",(sheet_id,))
+            con.executemany("INSERT INTO columns VALUES (?,?,?,?,?)",
+                            [(sheet_id,column['id'],column['title'],column['type'],column['index']) for column in columns])
+
+    def merge_rows(self,**kwargs):
+        ## Merge rows read with rowsModifiedSince, these are complete rows replacing the mirrored ones
+        sheet_id = kwargs['sheet_id']
+        rows = kwargs['rows']
+
+        with self.lock, self.connect() as con:
+            next_seq = con.execute("SELECT COALESCE(MAX(seq),-1)+1 FROM rows WHERE sheet_id=?",(sheet_id,)).fetchone()[0]
+            for row in rows:
+                current = con.execute("SELECT seq FROM rows WHERE sheet_id=? AND row_id=?",(sheet_id,row['id'])).fetchone()
+                if current==None:
+                    seq = next_seq
+                    next_seq += 1
+                else:
+                    seq = current[0]
+                con.execute("INSERT OR REPLACE INTO rows VALUES (?,?,?,?,?)",(sheet_id,row['id'],row['parent_id'],seq,json.dumps(row['cells'])))
+            con.execute("UPDATE sheets SET version=?, synced_at=? WHERE sheet_id=?",(kwargs['version'],kwargs['synced_at'],sheet_id))
+
+    def prune_rows(self,sheet_id,row_ids):
+        ## Drop mirrored rows that no longer exist in the sheet
+        with self.lock, self.connect() as con:
+            con.execute("CREATE TEMP TABLE keep_rows (row_id INTEGER PRIMARY KEY)")
+            con.executemany("INSERT INTO keep_rows VALUES (?)",[(row_id,) for row_id in row_ids])
+            con.execute("DELETE FROM rows WHERE sheet_id=? AND row_id NOT IN (SELECT row_id FROM keep_rows)",(sheet_id,))
+
+    def load_columns(self,sheet_id):
+        with self.lock, self.connect() as con:
+            result = con.execute("SELECT column_id, title, type, column_index FROM columns WHERE sheet_id=? ORDER BY column_index",(sheet_id,)).fetchall()
+        return([{'id': column_id, 'title': title, 'type': column_type, 'index': column_index}
+                for column_id, title, column_type, column_index in result])
+
+    def load_rows(self,sheet_id):
+        ## Rows in sheet order. Our inserts always go to the bottom of the sheet or of the parent's
+        ## children, so the order is rebuilt depth first from insertion sequence
+        with self.lock, self.connect() as con:
+            result = con.execute("SELECT row_id, parent_id, cells FROM rows WHERE sheet_id=? ORDER BY seq",(sheet_id,)).fetchall()
+
+        children = {}
+        for row_id, parent_id, cells in result:
+            cells = {int(column_id): value for column_id, value in json.loads(cells).items()}
+            children.setdefault(parent_id,[]).append({'id': row_id, 'parent_id': parent_id, 'cells': cells})
+
+        rows = []
+        stack = list(reversed(children.get(None,[])))
+        while len(stack)>0:
+            row = stack.pop()
+            rows.append(row)
+            stack.extend(reversed(children.get(row['id'],[])))
+
+        return(rows)
+
+    def apply_write(self,**kwargs):
+        ## Apply one of our own writes. The mirror only follows along when the write moved the sheet
+        ## exactly one version past the mirrored one, otherwise someone else changed the sheet too
+        sheet_id = kwargs['sheet_id']
+        version = kwargs.get('version')
+        added_rows = kwargs.get('added_rows',[])
+        updated_rows = kwargs.get('updated_rows',[])
+        deleted_row_ids = kwargs.get('deleted_row_ids',[])
+
+        with self.lock, self.connect() as con:
+            result = con.execute("SELECT version FROM sheets WHERE sheet_id=?",(sheet_id,)).fetchone()
+            if result==None or result[0]==None:
+                return
+            if version==None or version!=result[0]+1:
+                con.execute("UPDATE sheets SET version=NULL WHERE sheet_id=?",(sheet_id,))
+                return
+
+            next_seq = con.execute("SELECT COALESCE(MAX(seq),-1)+1 FROM rows WHERE sheet_id=?",(sheet_id,)).fetchone()[0]
+            con.executemany("INSERT OR REPLACE INTO rows VALUES (?,?,?,?,?)",
+                            [(sheet_id,row['id'],row['parent_id'],next_seq+seq,json.dumps(row['cells'])) for seq, row in enumerate(added_rows)])
+
+            for row in updated_rows:
+                current = con.execute("SELECT cells FROM rows WHERE sheet_id=? AND row_id=?",(sheet_id,row['id'])).fetchone()
+                cells = {} if current==None else json.loads(current[0])
+                cells.update({str(column_id): value for column_id, value in row['cells'].items()})
+                con.execute("UPDATE rows SET cells=? WHERE sheet_id=? AND row_id=?",(json.dumps(cells),sheet_id,row['id']))
+
+            con.executemany("DELETE FROM rows WHERE sheet_id=? AND row_id=?",[(sheet_id,row_id) for row_id in deleted_row_ids])
+            ## Deleting a parent row deletes its children as well
+            orphan_count = len(deleted_row_ids)
+            while orphan_count>0:
+                orphan_count = con.execute("DELETE FROM rows WHERE sheet_id=? AND parent_id IS NOT NULL AND parent_id NOT IN (SELECT row_id FROM rows WHERE sheet_id=?)",(sheet_id,sheet_id)).rowcount
+            con.execute("UPDATE sheets SET version=? WHERE sheet_id=?",(version,sheet_id))
@@ -0,0 +1,129 @@
+import json
+import pytest
+import pandas as pd
+from pathlib import Path
+import smartsheet_api as ssa
+import smartsheet_fake as ssf
+import local_smartsheet_odata_etl as odata_etl
+
+## Runs the sync hot paths against the in-process fake Smartsheet API with pytest-benchmark. Besides
+## the wall time every scenario is checked against benchmark_baseline.json: it may not make more
+## requests than the baseline and may not move more than BYTES_TOLERANCE more payload bytes.
+## Refresh the baseline with --update_baseline after an intended change.
+
+pytest.importorskip('pytest_benchmark')
+
+FOLDER_ID = 1
+PRIMARY_KEY = 'Record_Id'
+COLUMN_COUNT = 10
+BYTES_TOLERANCE = 0.05
+BASELINE_FILE = Path(__file__).with_name('benchmark_baseline.json')
+ROW_COUNTS = [1000, 10000, pytest.param(50000, marks=pytest.mark.slow)]
+## Requests per minute for the benchmark client, high enough that the limiter never waits
+BENCHMARK_REQUESTS_PER_MINUTE = 10**9
+
+
+def source_data(row_count,column_count,revision=0):
+    ## Source records as the ETL would read them, revision changes every non key value
+    data = {PRIMARY_KEY: [str(row) for row in range(row_count)]}
+    for column in range(1,column_count):
+        data[f'Column_{column}'] = [f'value {row} {column} r{revision}' for row in range(row_count)]
+    return(pd.DataFrame(data))
+
+def new_smartsheet(client):
+    sm = ssa.smartsheet_api({'api_token': 'benchmark', 'folder_id': FOLDER_ID},
+                            limiter=ssa.rate_limiter(BENCHMARK_REQUESTS_PER_MINUTE,burst=BENCHMARK_REQUESTS_PER_MINUTE))
+    sm.ss_client = client
+    sm.http_session = client.http_session()
+    return(sm)
+
+def seed_sheet(client,data_df):
+    return(client.add_sheet(folder_id=FOLDER_ID,
+                            sheet_name='Benchmark',
+                            columns=list(data_df.columns),
+                            rows=data_df.to_dict('records')))
+
+def read_sheet_df(sm,sheet_id):
+    column_map = sm.get_column_name_id_map(sheet_id=sheet_id)
+    sheet_df = sm.get_rows_frame(sheet_id=sheet_id)
+    return(odata_etl.sheet_frame_to_df(sheet_df,PRIMARY_KEY),column_map['name_to_id'])
+
+def read_sheet_sdk_df(sm,sheet_id):
+    ## The same read through the SDK Sheet, Row and Cell models, to compare with the raw JSON path
+    column_map = sm.get_column_name_id_map(sheet_id=sheet_id)
+    sheet = sm.get_sheet(sheet_id=sheet_id)
+    sheet_df = ssa.build_rows_frame(column_map['id_to_name'],sheet.rows)
+    return(odata_etl.sheet_frame_to_df(sheet_df,PRIMARY_KEY),column_map['name_to_id'])
+
+## Every scenario prepares its sheet and returns the part to measure
+
+def setup_add(sm,client,row_count,column_count):
+    data_df = source_data(row_count,column_count)
+    sheet_id = seed_sheet(client,data_df.iloc[0:0])
+    column_map = sm.get_column_name_id_map(sheet_id=sheet_id)['name_to_id']
+    return(lambda: odata_etl.run_smartsheet_add_data(smartsheet=sm,sheet_id=sheet_id,new_data_df=data_df,column_map=column_map))
+
+def setup_update(sm,client,row_count,column_count):
+    ## Every value changes and one row in twenty is gone from the source
+    sheet_id = seed_sheet(client,source_data(row_count,column_count))
+    old_data_df, column_map = read_sheet_df(sm,sheet_id)
+    new_data_df = source_data(row_count,column_count,revision=1)
+    new_data_df = new_data_df[new_data_df.index%20!=0]
+    return(lambda: odata_etl.run_smartsheet_update_data(smartsheet=sm,
+                                                        sheet_id=sheet_id,
+                                                        old_data_df=old_data_df,
+                                                        new_data_df=new_data_df,
+                                                        column_map=column_map,
+                                                        pk_field=PRIMARY_KEY,
+                                                        delete_flag=True))
+
+def setup_read(sm,client,row_count,column_count):
+    ## A fresh client, so the column map is requested as well
+    sheet_id = seed_sheet(client,source_data(row_count,column_count))
+    return(lambda: read_sheet_df(sm,sheet_id))
+
+def setup_read_sdk(sm,client,row_count,column_count):
+    sheet_id = seed_sheet(client,source_data(row_count,column_count))
+    return(lambda: read_sheet_sdk_df(sm,sheet_id))
+
+SCENARIOS = {'add': setup_add, 'update': setup_update, 'read': setup_read, 'read_sdk': setup_read_sdk}
+
+def load_baseline():
+    with open(BASELINE_FILE) as f_in:
+        return(json.load(f_in))
+
+def save_baseline(key,result):
+    baseline = load_baseline() if BASELINE_FILE.exists() else {}
+    baseline[key] = result
+    with open(BASELINE_FILE,'w') as f_out:
+        json.dump(dict(sorted(baseline.items())),f_out,indent=2)
+        f_out.write('\n')
+
+
+@pytest.mark.parametrize('row_count',ROW_COUNTS)
+@pytest.mark.parametrize('scenario',list(SCENARIOS))
+def test_sync_scenario(benchmark,request,scenario,row_count):
+    client = ssf.fake_smartsheet_client(seed=row_count)
+    client.add_folder(FOLDER_ID)
+    sm = new_smartsheet(client)
+    run = SCENARIOS[scenario](sm,client,row_count,COLUMN_COUNT)
+    ## Setup requests are not counted, a scenario changes its sheet so it is only run once
+    client.reset_stats()
+    benchmark.pedantic(run,rounds=1,iterations=1)
+
+    result = {'requests': client.request_count(),
+              'requests_by_endpoint': dict(client.stats['requests']),
+              'request_bytes': client.stats['request_bytes'],
+              'response_bytes': client.stats['response_bytes']}
+    ## Lower bound on the live run time set by the API quota alone
+    benchmark.extra_info.update(result,quota_s=round(result['requests']*60/ssa.DEFAULT_REQUESTS_PER_MINUTE,1))
+
+    key = f"{scenario}:{row_count}"
+    if request.config.getoption('update_baseline'):
+        save_baseline(key,result)
+        return
+
+    baseline_result = load_baseline()[key]
+    assert result['requests']<=baseline_result['requests'], result['requests_by_endpoint']
+    for measure in ['request_bytes','response_bytes']:
+        assert result[measure]<=baseline_result[measure]*(1+BYTES_TOLERANCE), measure
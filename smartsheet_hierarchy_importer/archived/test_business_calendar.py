@@ -0,0 +1,15 @@
+import numpy as np
+import business_calendar as bc
+
+
+def test_format_business_dates_leaves_missing_dates_empty():
+    calendar = bc.read_holiday_calendar(None,'USGRE')
+    open_dates = bc.to_business_dates(['01/05/2024','not a date'])
+    schedule = bc.format_business_dates(bc.subtask_open_dates(open_dates,[1,2],calendar))
+
+    assert schedule.tolist()==[['01/05/2024','01/08/2024'],[None,None]]
+
+def test_format_business_dates_keeps_shape():
+    dates = np.array([['2024-03-01','NaT']],dtype='datetime64[D]')
+
+    assert bc.format_business_dates(dates,'%Y-%m-%d').tolist()==[['2024-03-01',None]]
@@ -0,0 +1,173 @@
+import pytest
+import requests
+import email.utils
+from datetime import datetime, timedelta, timezone
+import smartsheet_api as ssa
+import smartsheet_fake as ssf
+
+## Runs smartsheet_api against the in-process fake client, no API token or network needed
+
+FOLDER_ID = 1
+
+
+def new_smartsheet(client):
+    sm = ssa.smartsheet_api({'api_token': 'test', 'folder_id': FOLDER_ID},
+                            limiter=ssa.rate_limiter(10**9,burst=10**9))
+    sm.ss_client = client
+    sm.http_session = client.http_session()
+    return(sm)
+
+def new_sheet(client):
+    client.add_folder(FOLDER_ID)
+    return(client.add_sheet(folder_id=FOLDER_ID,sheet_name='Deviations',columns=['QR_Number','Task_Name']))
+
+def fail_call(client,endpoint,call_number,status_code=400):
+    ## Make the call_number-th request to an endpoint of client.Sheets fail with status_code
+    func = getattr(client.Sheets,endpoint)
+    calls = []
+
+    def failing_call(*args,**kwargs):
+        calls.append(args)
+        if len(calls)==call_number:
+            return(client.error_response(status_code,{}))
+        return(func(*args,**kwargs))
+
+    failing_call.__name__ = endpoint
+    setattr(client.Sheets,endpoint,failing_call)
+    return(calls)
+
+
+def sdk_error_session(sm,status_code,error_code):
+    ## Answer every request of the real SDK client with an API error, returns the requests sent
+    sent = []
+
+    def send(prepped_request,**kwargs):
+        sent.append(prepped_request)
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = f'{{"errorCode": {error_code}, "message": "Unexpected error"}}'.encode()
+        response.headers['Content-Type'] = 'application/json'
+        response.request = prepped_request
+        return(response)
+
+    sm.ss_client._session.send = send
+    return(sent)
+
+def add_cells(column_map,values):
+    return([{'add_cells': [{'column_id': column_map['QR_Number'], 'value': value, 'strict': False}]} for value in values])
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(ssa.time,'sleep',lambda seconds: None)
+
+
+def test_parse_retry_after():
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=120)
+    assert ssa.parse_retry_after('3')==3.0
+    assert 100 < ssa.parse_retry_after(email.utils.format_datetime(retry_at,usegmt=True)) <= 120
+    assert ssa.parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT')==0.0
+    assert ssa.parse_retry_after('soon')==None
+    assert ssa.parse_retry_after(None)==None
+
+def test_throttled_add_is_retried(no_sleep):
+    client = ssf.fake_smartsheet_client()
+    sheet_id = new_sheet(client)
+    sm = new_smartsheet(client)
+    column_map = sm.get_column_name_id_map(sheet_id=sheet_id)['name_to_id']
+    calls = fail_call(client,'add_rows',1,status_code=429)
+
+    row_ids = sm.add_rows(sheet_id=sheet_id,row_specs=add_cells(column_map,['QR-1','QR-2']))
+
+    assert len(calls)==2
+    assert sorted(row_ids)==sorted(client.sheets[sheet_id]['rows'])
+
+def test_add_is_not_retried_after_server_error(no_sleep):
+    ## The rows may have been written, sending them again would add them twice
+    client = ssf.fake_smartsheet_client()
+    sheet_id = new_sheet(client)
+    sm = new_smartsheet(client)
+    column_map = sm.get_column_name_id_map(sheet_id=sheet_id)['name_to_id']
+    calls = fail_call(client,'add_rows',1,status_code=503)
+
+    with pytest.raises(ssa.SmartsheetApiError) as error:
+        sm.add_rows(sheet_id=sheet_id,row_specs=add_cells(column_map,['QR-1']))
+
+    assert len(calls)==1
+    assert error.value.status_code==503
+
+def test_update_is_retried_after_server_error(no_sleep):
+    client = ssf.fake_smartsheet_client()
+    sheet_id = new_sheet(client)
+    sm = new_smartsheet(client)
+    column_map = sm.get_column_name_id_map(sheet_id=sheet_id)['name_to_id']
+    row_ids = sm.add_rows(sheet_id=sheet_id,row_specs=add_cells(column_map,['QR-1']))
+    calls = fail_call(client,'update_rows',1,status_code=503)
+
+    sm.update_smartsheet_cell(sheet_id=sheet_id,update_row_cells=[{'row_id': row_ids[0], 'column_id': column_map['Task_Name'], 'value': 'Approve', 'strict': False}])
+
+    assert len(calls)==2
+    assert client.sheets[sheet_id]['rows'][row_ids[0]]['cells'][column_map['Task_Name']]=='Approve'
+
+def test_sdk_does_not_retry_an_add_on_its_own(no_sleep):
+    ## 4004 is one of the errors the SDK would retry itself, an add must only be sent once
+    sm = ssa.smartsheet_api({'api_token': 'test', 'folder_id': FOLDER_ID},limiter=ssa.rate_limiter(10**9,burst=10**9))
+    sent = sdk_error_session(sm,500,4004)
+
+    with pytest.raises(ssa.SmartsheetApiError) as error:
+        sm.add_rows(sheet_id=1,row_specs=[{'add_cells': [{'column_id': 1, 'value': 'QR-1', 'strict': False}]}])
+
+    assert len(sent)==1
+    assert error.value.status_code==500
+
+def test_sdk_http_adapter_does_not_resend():
+    sm = ssa.smartsheet_api({'api_token': 'test', 'folder_id': FOLDER_ID})
+
+    for http_adapter in sm.ss_client._session.adapters.values():
+        assert http_adapter.max_retries.total==0
+        assert http_adapter.max_retries.read==False
+
+def test_sdk_error_status_is_checked(no_sleep):
+    sm = ssa.smartsheet_api({'api_token': 'test', 'folder_id': FOLDER_ID},limiter=ssa.rate_limiter(10**9,burst=10**9))
+    sent = sdk_error_session(sm,404,1006)
+
+    with pytest.raises(ssa.SmartsheetApiError) as error:
+        sm.get_sheet_version(sheet_id=1)
+
+    assert len(sent)==1
+    assert error.value.status_code==404
+
+def test_sdk_throttling_is_retried_by_retry_only(no_sleep):
+    sm = ssa.smartsheet_api({'api_token': 'test', 'folder_id': FOLDER_ID},limiter=ssa.rate_limiter(10**9,burst=10**9))
+    sent = sdk_error_session(sm,429,4003)
+
+    with pytest.raises(ssa.SmartsheetRetryError):
+        sm.get_sheet_version(sheet_id=1)
+
+    assert len(sent)==ssa.MAX_RETRY_ATTEMPTS
+
+def test_response_without_status_raises():
+    client = ssf.fake_smartsheet_client()
+    sm = new_smartsheet(client)
+
+    with pytest.raises(ssa.SmartsheetApiError):
+        sm.retry(lambda: object())
+
+
+def test_add_row_tree_rolls_back_parents_when_children_fail():
+    client = ssf.fake_smartsheet_client()
+    sheet_id = new_sheet(client)
+    sm = new_smartsheet(client)
+    column_map = sm.get_column_name_id_map(sheet_id=sheet_id)['name_to_id']
+    ## The parents are the first add_rows call, the children the second
+    fail_call(client,'add_rows',2)
+
+    parent_row_specs = add_cells(column_map,[f'QR-{index}' for index in range(3)])
+    child_row_specs = [[{'add_cells': [{'column_id': column_map['Task_Name'], 'value': task, 'strict': False}]}
+                        for task in ['Investigate','Approve']]
+                       for index in range(3)]
+
+    with pytest.raises(ssa.SmartsheetApiError):
+        sm.add_row_tree(sheet_id=sheet_id,parent_row_specs=parent_row_specs,child_row_specs=child_row_specs)
+
+    assert client.stats['requests']['delete_rows']==1
+    assert client.sheets[sheet_id]['rows']=={}
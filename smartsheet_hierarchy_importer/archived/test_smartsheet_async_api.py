@@ -0,0 +1,59 @@
+import asyncio
+import time
+import pandas as pd
+import smartsheet_api as ssa
+import smartsheet_async_api as ssaa
+import smartsheet_fake as ssf
+
+## Runs async_smartsheet_api against the in-process fake client, no API token or network needed
+
+FOLDER_ID = 1
+LATENCY_S = 0.05
+CONCURRENCY = 4
+CHUNK_COUNT = 8
+CHUNK_SIZE = 10
+
+
+def new_async_smartsheet(client,concurrency):
+    async_sm = ssaa.async_smartsheet_api({'api_token': 'test', 'folder_id': FOLDER_ID},concurrency=concurrency,
+                                         limiter=ssa.rate_limiter(10**9,burst=10**9))
+    for sm in async_sm.clients:
+        sm.ss_client = client
+        sm.http_session = client.http_session()
+    return(async_sm)
+
+def add_data_frame(concurrency,**kwargs):
+    ## Add CHUNK_COUNT chunks of rows to a fresh sheet, returns the fake client, sheet, row ids and wall time
+    client = ssf.fake_smartsheet_client()
+    client.add_folder(FOLDER_ID)
+    sheet_id = client.add_sheet(folder_id=FOLDER_ID,sheet_name='Deviations',columns=['QR_Number'])
+    new_data_df = pd.DataFrame({'QR_Number': [f'QR-{index}' for index in range(CHUNK_COUNT*CHUNK_SIZE)]})
+
+    async def run():
+        async with new_async_smartsheet(client,concurrency) as async_sm:
+            column_map = (await async_sm.get_column_name_id_map(sheet_id=sheet_id))['name_to_id']
+            client.latency_s = LATENCY_S
+            started = time.perf_counter()
+            row_ids = await async_sm.add_rows(sheet_id=sheet_id,new_data_df=new_data_df,column_map=column_map,
+                                              chunk_size=CHUNK_SIZE,**kwargs)
+            return(row_ids,column_map,time.perf_counter()-started)
+
+    row_ids, column_map, wall_s = asyncio.run(run())
+    return(client,sheet_id,column_map,row_ids,wall_s)
+
+
+def test_data_frame_chunks_are_added_concurrently():
+    client, sheet_id, column_map, row_ids, wall_s = add_data_frame(CONCURRENCY)
+    serial_wall_s = CHUNK_COUNT*LATENCY_S
+
+    assert client.stats['requests']['add_rows']==CHUNK_COUNT
+    assert wall_s < serial_wall_s/CONCURRENCY*2
+    ## Row ids come back in input order whatever order the chunks finished in
+    rows = client.sheets[sheet_id]['rows']
+    assert [rows[row_id]['cells'][column_map['QR_Number']] for row_id in row_ids]==[f'QR-{index}' for index in range(CHUNK_COUNT*CHUNK_SIZE)]
+
+def test_preserve_order_adds_data_frame_chunks_serially():
+    client, sheet_id, column_map, row_ids, wall_s = add_data_frame(CONCURRENCY,preserve_order=True)
+
+    assert wall_s >= CHUNK_COUNT*LATENCY_S
+    assert list(client.sheets[sheet_id]['rows'])==row_ids
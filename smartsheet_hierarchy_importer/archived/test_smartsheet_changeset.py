@@ -0,0 +1,112 @@
+import pytest
+import smartsheet_api as ssa
+import smartsheet_changeset as sscs
+import smartsheet_journal as ssj
+import smartsheet_fake as ssf
+
+## Applies change sets against the in-process fake client, no API token or network needed
+
+FOLDER_ID = 1
+SHEET_NAME = 'Deviations'
+SHEET_TEMPLATE = [{'title': 'Record_Id', 'type': 'TEXT_NUMBER', 'primary': True},
+                  {'title': 'Amount', 'type': 'TEXT_NUMBER'}]
+
+
+def new_smartsheet(client):
+    sm = ssa.smartsheet_api({'api_token': 'test', 'folder_id': FOLDER_ID},
+                            limiter=ssa.rate_limiter(10**9,burst=10**9))
+    sm.ss_client = client
+    sm.http_session = client.http_session()
+    return(sm)
+
+def new_sheet_change(record_ids):
+    sheet_change = sscs.new_sheet_change(sheet_name=SHEET_NAME,sheet_template=SHEET_TEMPLATE,primary_key='Record_Id')
+    sheet_change['add_rows'] = [{'Record_Id': record_id, 'Amount': record_id*10} for record_id in record_ids]
+    return(sheet_change)
+
+def interrupt_after_write(client,endpoint,call_number):
+    ## The call_number-th request to an endpoint is applied, then the connection drops before the response.
+    ## Returns the original endpoint to put back
+    owner = client.Folders if endpoint=='create_sheet_in_folder' else client.Sheets
+    func = getattr(owner,endpoint)
+    calls = []
+
+    def interrupted_call(*args,**kwargs):
+        calls.append(args)
+        response = func(*args,**kwargs)
+        if len(calls)==call_number:
+            raise ConnectionError('Connection reset by peer')
+        return(response)
+
+    interrupted_call.__name__ = endpoint
+    setattr(owner,endpoint,interrupted_call)
+    return(func)
+
+def sheet_record_ids(client):
+    sheet_id = [sheet_id for sheet_id in client.sheets if client.sheets[sheet_id]['name']==SHEET_NAME]
+    assert len(sheet_id)==1
+    record_column_id = client.sheets[sheet_id[0]]['columns'][0]['id']
+    return({row_id: row['cells'][record_column_id] for row_id, row in client.sheets[sheet_id[0]]['rows'].items()})
+
+@pytest.fixture
+def small_batches(monkeypatch):
+    monkeypatch.setattr(ssa,'MAX_ROWS_PER_REQUEST',2)
+
+
+def test_interrupted_add_is_not_added_again(tmp_path,small_batches):
+    client = ssf.fake_smartsheet_client()
+    client.add_folder(FOLDER_ID)
+    journal = ssj.progress_journal(tmp_path/'journal.db')
+    sheet_change = new_sheet_change(range(1,6))
+    add_rows = interrupt_after_write(client,'add_rows',2)
+
+    with pytest.raises(ssa.SmartsheetApiError):
+        sscs.apply_sheet_change(smartsheet=new_smartsheet(client),sheet_change=sheet_change,journal=journal)
+    assert journal.get_step(SHEET_NAME,'add:1')=={'keys': [3,4], 'pending': True}
+
+    client.Sheets.add_rows = add_rows
+    client.reset_stats()
+    sheet_result = sscs.apply_sheet_change(smartsheet=new_smartsheet(client),sheet_change=sheet_change,journal=journal)
+
+    record_ids = sheet_record_ids(client)
+    assert sorted(record_ids.values())==[1,2,3,4,5]
+    ## Only the last batch is sent, the interrupted one is found in the sheet
+    assert client.stats['requests']['add_rows']==1
+    assert 'create_sheet_in_folder' not in client.stats['requests']
+    assert sheet_result['rows_added']==5
+    resumed = journal.get_step(SHEET_NAME,'add:1')
+    assert [record_ids[row_id] for row_id in resumed['row_ids']]==[3,4]
+    assert 'pending' not in resumed
+
+def test_pending_add_that_was_not_written_is_added(tmp_path,small_batches):
+    client = ssf.fake_smartsheet_client()
+    client.add_folder(FOLDER_ID)
+    journal = ssj.progress_journal(tmp_path/'journal.db')
+    sheet_change = new_sheet_change(range(1,4))
+    add_rows = client.Sheets.add_rows
+    client.Sheets.add_rows = lambda *args, **kwargs: client.error_response(400,{})
+
+    with pytest.raises(ssa.SmartsheetApiError):
+        sscs.apply_sheet_change(smartsheet=new_smartsheet(client),sheet_change=sheet_change,journal=journal)
+
+    client.Sheets.add_rows = add_rows
+    sscs.apply_sheet_change(smartsheet=new_smartsheet(client),sheet_change=sheet_change,journal=journal)
+
+    assert sorted(sheet_record_ids(client).values())==[1,2,3]
+
+def test_interrupted_create_sheet_is_not_created_again(tmp_path):
+    client = ssf.fake_smartsheet_client()
+    client.add_folder(FOLDER_ID)
+    journal = ssj.progress_journal(tmp_path/'journal.db')
+    sheet_change = new_sheet_change(range(1,3))
+    create_sheet_in_folder = interrupt_after_write(client,'create_sheet_in_folder',1)
+
+    with pytest.raises(ssa.SmartsheetApiError):
+        sscs.apply_sheet_change(smartsheet=new_smartsheet(client),sheet_change=sheet_change,journal=journal)
+
+    client.Folders.create_sheet_in_folder = create_sheet_in_folder
+    sheet_result = sscs.apply_sheet_change(smartsheet=new_smartsheet(client),sheet_change=sheet_change,journal=journal)
+
+    assert len(client.folders[FOLDER_ID])==1
+    assert sheet_result['sheet_id']==client.folders[FOLDER_ID][0]
+    assert sorted(sheet_record_ids(client).values())==[1,2]
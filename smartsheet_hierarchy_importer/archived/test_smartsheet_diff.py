@@ -0,0 +1,139 @@
+import pandas as pd
+import smartsheet_diff as ssd
+
+## Sheet rows are compared as strings, the way sheet_frame_to_df returns them
+
+PRIMARY_KEY = 'Record_Id'
+COLUMN_MAP = {'Record_Id': 101, 'Amount': 102, 'Due_Date': 103, 'Owner': 104}
+
+
+def sheet_df(rows):
+    ## rows: (row id, key, amount, due date, owner)
+    return(pd.DataFrame(rows,columns=['Smartsheet_Row_Id','Record_Id','Amount','Due_Date','Owner']))
+
+def source_df(rows):
+    return(pd.DataFrame(rows,columns=['Record_Id','Amount','Due_Date','Owner']))
+
+def diff(old_data_df,new_data_df,delete_flag=False,**kwargs):
+    return(ssd.diff_sheet_data(old_data_df=old_data_df,
+                               new_data_df=new_data_df,
+                               column_map=COLUMN_MAP,
+                               pk_field=PRIMARY_KEY,
+                               delete_flag=delete_flag,
+                               **kwargs))
+
+def cell(row_id,column,value):
+    return({'row_id': row_id, 'column_id': COLUMN_MAP[column], 'value': value, 'strict': False})
+
+
+def test_sheet_dates_and_numbers_match_the_source_format():
+    old_data_df = sheet_df([(1,'1','10.0','2024-03-05','ann'),
+                            (2,'2','10.05','2024-12-31','bob')])
+    new_data_df = source_df([(1,'10','03/05/2024','ann'),
+                             (2,'10.05','12/31/2024','bob')])
+
+    result = diff(old_data_df,new_data_df)
+
+    assert result['update_row_cells']==[]
+    assert result['updated_keys']==[]
+
+def test_changed_values_are_sent_as_source_values():
+    ## A trailing .0 is dropped, 10.05 is not touched
+    old_data_df = sheet_df([(1,'1','10.05','2024-03-05','ann'),
+                            (2,'2','7','2024-03-05','bob')])
+    new_data_df = source_df([(1,'105','03/06/2024','ann'),
+                             (2,'8.0','03/05/2024','bob')])
+
+    result = diff(old_data_df,new_data_df)
+
+    assert result['update_row_cells']==[cell(1,'Amount','105'),
+                                        cell(1,'Due_Date','03/06/2024'),
+                                        cell(2,'Amount','8')]
+    assert result['updated_keys']==['1','2']
+
+def test_float_looking_keys_match_integer_keys():
+    old_data_df = sheet_df([(1,'3.0','5','2024-03-05','ann')])
+    new_data_df = source_df([(3,'6','03/05/2024','ann')])
+
+    result = diff(old_data_df,new_data_df,delete_flag=True)
+
+    assert result['update_row_cells']==[cell(1,'Amount','6')]
+    assert result['delete_row_ids']==[]
+
+def test_first_duplicate_source_key_wins():
+    old_data_df = sheet_df([(1,'1','5','2024-03-05','ann')])
+    new_data_df = source_df([(1,'5','03/05/2024','carl'),
+                             (1,'9','03/05/2024','dave')])
+
+    result = diff(old_data_df,new_data_df)
+
+    assert result['update_row_cells']==[cell(1,'Owner','carl')]
+
+def test_rows_missing_from_the_source_are_deleted_only_with_delete_flag():
+    old_data_df = sheet_df([(1,'1','5','2024-03-05','ann'),
+                            (2,'2','5','2024-03-05','bob')])
+    new_data_df = source_df([(1,'5','03/05/2024','ann')])
+
+    assert diff(old_data_df,new_data_df,delete_flag=True)['delete_row_ids']==[2]
+    assert diff(old_data_df,new_data_df,delete_flag=False)['delete_row_ids']==[]
+
+def test_empty_sheet_has_nothing_to_update_or_delete():
+    new_data_df = source_df([(1,'5','03/05/2024','ann')])
+    expected = {'update_row_cells': [], 'delete_row_ids': [], 'updated_keys': [], 'skipped_count': 0}
+
+    assert diff(pd.DataFrame(),new_data_df,delete_flag=True)==expected
+    assert diff(sheet_df([]),new_data_df,delete_flag=True)==expected
+
+def test_row_hashes_do_not_depend_on_column_order():
+    new_data_df = source_df([(1,'5','03/05/2024','ann'),(2,'6.0','03/06/2024','bob')])
+    columns = ['Amount','Due_Date','Owner']
+
+    row_hashes = ssd.hash_rows(new_data_df,columns,PRIMARY_KEY)
+
+    assert set(row_hashes)=={'1','2'}
+    assert ssd.hash_rows(new_data_df[['Owner','Record_Id','Due_Date','Amount']],list(reversed(columns)),PRIMARY_KEY)==row_hashes
+
+def test_row_hashes_follow_the_cell_normalization():
+    ## 6.0 and 6 are the same cell value, so they must give the same fingerprint
+    columns = ['Amount','Due_Date','Owner']
+    assert ssd.hash_rows(source_df([(1,'6.0','03/06/2024','bob')]),columns,PRIMARY_KEY)==ssd.hash_rows(source_df([(1,'6','03/06/2024','bob')]),columns,PRIMARY_KEY)
+    assert ssd.hash_rows(source_df([(1,'6','03/06/2024','bob')]),columns,PRIMARY_KEY)!=ssd.hash_rows(source_df([(1,'7','03/06/2024','bob')]),columns,PRIMARY_KEY)
+
+def test_unchanged_fingerprints_are_skipped():
+    ## The sheet differs from the source, but the source record did not change since the last sync
+    columns = ['Amount','Due_Date','Owner']
+    old_data_df = sheet_df([(1,'1','5','2024-03-05','edited in sheet'),
+                            (2,'2','6','2024-03-06','bob')])
+    new_data_df = source_df([(1,'5','03/05/2024','ann'),
+                             (2,'6','03/06/2024','bob')])
+    row_hashes = ssd.hash_rows(new_data_df,columns,PRIMARY_KEY)
+
+    result = diff(old_data_df,new_data_df,delete_flag=True,previous_hashes=row_hashes,row_hashes=row_hashes)
+
+    assert result['skipped_count']==2
+    assert result['update_row_cells']==[]
+    assert result['delete_row_ids']==[]
+
+def test_changed_column_brings_the_row_back():
+    columns = ['Amount','Due_Date','Owner']
+    old_data_df = sheet_df([(1,'1','5','2024-03-05','ann'),
+                            (2,'2','6','2024-03-06','bob')])
+    previous_hashes = ssd.hash_rows(source_df([(1,'5','03/05/2024','ann'),(2,'6','03/06/2024','bob')]),columns,PRIMARY_KEY)
+    new_data_df = source_df([(1,'5','03/05/2024','ann'),
+                             (2,'6','03/07/2024','bob')])
+
+    result = diff(old_data_df,new_data_df,previous_hashes=previous_hashes,row_hashes=ssd.hash_rows(new_data_df,columns,PRIMARY_KEY))
+
+    assert result['skipped_count']==1
+    assert result['update_row_cells']==[cell(2,'Due_Date','03/07/2024')]
+    assert result['updated_keys']==['2']
+
+def test_rows_without_a_previous_fingerprint_are_compared():
+    columns = ['Amount','Due_Date','Owner']
+    old_data_df = sheet_df([(1,'1','5','2024-03-05','ann')])
+    new_data_df = source_df([(1,'9','03/05/2024','ann')])
+
+    result = diff(old_data_df,new_data_df,previous_hashes={},row_hashes=ssd.hash_rows(new_data_df,columns,PRIMARY_KEY))
+
+    assert result['skipped_count']==0
+    assert result['update_row_cells']==[cell(1,'Amount','9')]
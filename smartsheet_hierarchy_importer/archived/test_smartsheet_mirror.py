@@ -0,0 +1,123 @@
+import smartsheet_api as ssa
+import smartsheet_fake as ssf
+import smartsheet_mirror as ssm
+
+FOLDER_ID = 1
+SHEET_ID = 10
+COLUMNS = [{'id': 1, 'title': 'QR_Number', 'type': 'TEXT_NUMBER', 'index': 0},
+           {'id': 2, 'title': 'Status', 'type': 'TEXT_NUMBER', 'index': 1}]
+
+
+def new_mirror(tmp_path,rows):
+    mirror = ssm.sheet_mirror(str(tmp_path.joinpath('mirror.db')))
+    mirror.save_sheet(sheet_id=SHEET_ID,version=5,columns=COLUMNS,rows=rows,synced_at='2024-01-01T00:00:00Z')
+    return(mirror)
+
+def mirror_row(row_id,parent_id,qr_number,status):
+    return({'id': row_id, 'parent_id': parent_id, 'cells': {1: qr_number, 2: status}})
+
+def new_smartsheet(client,ss_creds=None):
+    sm = ssa.smartsheet_api(dict({'api_token': 'test', 'folder_id': FOLDER_ID},**(ss_creds or {})),
+                            limiter=ssa.rate_limiter(10**9,burst=10**9))
+    sm.ss_client = client
+    sm.http_session = client.http_session()
+    return(sm)
+
+def sheet_state(client,sheet_id):
+    ## Row id to (parent id, cell values by column id) as the fake holds them
+    return({row_id: (row['parent_id'],row['cells']) for row_id, row in client.sheets[sheet_id]['rows'].items()})
+
+
+def test_write_one_version_ahead_is_applied(tmp_path):
+    mirror = new_mirror(tmp_path,[mirror_row(100,None,'QR-1','Open'),mirror_row(101,None,'QR-2','Open')])
+
+    mirror.apply_write(sheet_id=SHEET_ID,
+                       version=6,
+                       added_rows=[mirror_row(102,None,'QR-3','Open')],
+                       updated_rows=[{'id': 100, 'parent_id': None, 'cells': {2: 'Closed'}}],
+                       deleted_row_ids=[101])
+
+    assert mirror.get_version(SHEET_ID)==6
+    assert mirror.load_rows(SHEET_ID)==[mirror_row(100,None,'QR-1','Closed'),mirror_row(102,None,'QR-3','Open')]
+
+def test_write_skipping_a_version_invalidates(tmp_path):
+    ## Version 7 after 5 means someone else wrote version 6, the mirror no longer knows the sheet
+    mirror = new_mirror(tmp_path,[mirror_row(100,None,'QR-1','Open')])
+
+    mirror.apply_write(sheet_id=SHEET_ID,version=7,updated_rows=[{'id': 100, 'parent_id': None, 'cells': {2: 'Closed'}}])
+
+    assert mirror.get_version(SHEET_ID)==None
+    assert not mirror.is_current(SHEET_ID,7)
+
+def test_concurrent_writes_invalidate(tmp_path):
+    ## Two writes answered with the same version, the second cannot be placed after the first
+    mirror = new_mirror(tmp_path,[mirror_row(100,None,'QR-1','Open')])
+
+    mirror.apply_write(sheet_id=SHEET_ID,version=6,updated_rows=[{'id': 100, 'parent_id': None, 'cells': {2: 'Closed'}}])
+    mirror.apply_write(sheet_id=SHEET_ID,version=6,updated_rows=[{'id': 100, 'parent_id': None, 'cells': {2: 'Open'}}])
+
+    assert mirror.get_version(SHEET_ID)==None
+
+def test_write_without_version_invalidates(tmp_path):
+    mirror = new_mirror(tmp_path,[mirror_row(100,None,'QR-1','Open')])
+
+    mirror.apply_write(sheet_id=SHEET_ID,version=None,deleted_row_ids=[100])
+
+    assert mirror.get_version(SHEET_ID)==None
+
+def test_deleting_a_parent_deletes_its_descendants(tmp_path):
+    mirror = new_mirror(tmp_path,[mirror_row(100,None,'QR-1','Open'),
+                                  mirror_row(101,100,'Investigate','Open'),
+                                  mirror_row(102,101,'Interview','Open'),
+                                  mirror_row(200,None,'QR-2','Open'),
+                                  mirror_row(201,200,'Investigate','Open')])
+
+    mirror.apply_write(sheet_id=SHEET_ID,version=6,deleted_row_ids=[100])
+
+    assert [row['id'] for row in mirror.load_rows(SHEET_ID)]==[200,201]
+    assert mirror.row_count(SHEET_ID)==2
+
+def test_rows_are_loaded_depth_first(tmp_path):
+    mirror = new_mirror(tmp_path,[mirror_row(100,None,'QR-1','Open'),mirror_row(200,None,'QR-2','Open')])
+
+    mirror.apply_write(sheet_id=SHEET_ID,version=6,added_rows=[mirror_row(101,100,'Investigate','Open')])
+
+    assert [row['id'] for row in mirror.load_rows(SHEET_ID)]==[100,101,200]
+
+def test_delta_read_merges_changes_and_prunes_deleted_rows(tmp_path):
+    client = ssf.fake_smartsheet_client()
+    client.add_folder(FOLDER_ID)
+    sheet_id = client.add_sheet(folder_id=FOLDER_ID,
+                                sheet_name='Deviations',
+                                columns=['QR_Number','Status'],
+                                rows=[{'QR_Number': f'QR-{index}', 'Status': 'Open'} for index in range(5)])
+    sm = new_smartsheet(client,{'mirror_file': str(tmp_path.joinpath('mirror.db'))})
+    first_rows = sm.get_rows_from_mirror(sheet_id=sheet_id)
+    row_ids = [row.id for row in first_rows]
+
+    ## Someone else edits and deletes rows, the mirror does not see these writes
+    other = new_smartsheet(client)
+    status_column_id = other.get_column_name_id_map(sheet_id=sheet_id)['name_to_id']['Status']
+    other.update_smartsheet_cell(sheet_id=sheet_id,update_row_cells=[{'row_id': row_ids[1], 'column_id': status_column_id, 'value': 'Closed', 'strict': False}])
+    other.delete_rows_from_sheet(sheet_id=sheet_id,row_ids=[row_ids[3]])
+
+    client.reset_stats()
+    rows = sm.get_rows_from_mirror(sheet_id=sheet_id)
+
+    ## Version check, delta read, then the primary column only to find the deleted row
+    assert client.stats['requests']=={'get_sheet_version': 1, 'get_sheet': 2}
+    assert {row.id: (row.parent_id,{cell.column_id: cell.value for cell in row.cells}) for row in rows}==sheet_state(client,sheet_id)
+    assert sm.mirror.get_version(sheet_id)==client.sheets[sheet_id]['version']
+
+def test_unchanged_sheet_is_read_from_the_mirror(tmp_path):
+    client = ssf.fake_smartsheet_client()
+    client.add_folder(FOLDER_ID)
+    sheet_id = client.add_sheet(folder_id=FOLDER_ID,sheet_name='Deviations',columns=['QR_Number','Status'],rows=[{'QR_Number': 'QR-1', 'Status': 'Open'}])
+    sm = new_smartsheet(client,{'mirror_file': str(tmp_path.joinpath('mirror.db'))})
+    sm.get_rows_from_mirror(sheet_id=sheet_id)
+
+    client.reset_stats()
+    rows = sm.get_rows_from_mirror(sheet_id=sheet_id)
+
+    assert client.stats['requests']=={'get_sheet_version': 1}
+    assert [cell.value for cell in rows[0].cells]==['QR-1','Open']